@@ -506,18 +506,12 @@ class Andor:
             - height of ROI (pixels)
             - number of kinetic scans in acquisition (kinetic mode only)"""
         dim = int(dimx*dimy *  self.kscans) 
-        cimage = (c_int * dim)()
-        error = self.dll.GetOldestImage(cimage, dim)
+        imageArray = np.zeros((self.kscans, dimx, dimy), dtype=np.int32)
+        error = self.dll.GetOldestImage(imageArray.ctypes.data_as(POINTER(c_int)), dim)
         self.verbose(error, sys._getframe().f_code.co_name)
-
-        imageArray = []        
-        for i in range(len(cimage)):
-            imageArray.append(cimage[i])
-        imageArray = imageArray[:]
-        imageArray = np.reshape(imageArray, (self.kscans, dimx, dimy))
         return imageArray
 
-    def GetImages(self, first, last, dimx, dimy):
+    def GetImages(self, first, last, dimx, dimy, out=None):
         """Update the data array with the specified series of images from the 
         circular buffer. If the specified series is out of range (i.e. the 
         images have been overwritten or have not yet been acquired then an error
@@ -526,25 +520,26 @@ class Andor:
             first - index of first image in buffer to retrieve.
             last - index of last image in buffer to retrieve.
             dimx - number of pixels in horizontal direction.
-            dimy - number of pixels in vertical direction."""
+            dimy - number of pixels in vertical direction.
+            out - optional C-contiguous int32 array with shape 
+                (>= last-first+1, kscans, dimx, dimy) to copy the images 
+                into, so that no memory is allocated.
+        The indexes of the images that were valid are stored in 
+        self.validfirst and self.validlast."""
+        n = last-first+1
         dim = int(dimx*dimy *  self.kscans) 
+        if out is None:
+            out = np.zeros((n, self.kscans, dimx, dimy), dtype=np.int32)
         cfirst = c_int(first)
         clast = c_int(last)
-        carr = (c_int * dim * (last-first+1))()
-        csize = c_int(dim * (last-first+1))
+        csize = c_int(dim * n)
         cvalidfirst = c_int()
         cvalidlast = c_int()
-        error = self.dll.GetImages(cfirst, clast, carr, csize, 
-                                byref(cvalidfirst), byref(cvalidlast))
+        error = self.dll.GetImages(cfirst, clast, out.ctypes.data_as(POINTER(c_int)), 
+                                csize, byref(cvalidfirst), byref(cvalidlast))
         self.verbose(error, sys._getframe().f_code.co_name)
-        
-        imageArray = []        
-        for i in range(len(carr)):
-            imageArray.append(carr[i])
-        imageArray = imageArray[:]
-        imageArray = np.reshape(imageArray, 
-                            ((last-first+1), self.kscans, dimx, dimy))
-        return imageArray
+        self.validfirst, self.validlast = cvalidfirst.value, cvalidlast.value
+        return out[:n]
         
     def GetNumberAvailableImages(self):
         """Return the number of available images in the circular buffer. 
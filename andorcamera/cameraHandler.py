@@ -6,16 +6,25 @@ Use these to build more complex functions for running a sequence.
 Some info on what the triggering options do:
     Z:\Mixture\Experimental\Design_overview\Imaging
 
+Use camera(simulate=True) to run with simAndor.SimAndor instead of the 
+Andor SDK, e.g. for testing without the camera.
+
 """
 import os
 import time
 import numpy as np
-import win32event
+import threading
 import sys
 if '.' not in sys.path: sys.path.append('.')
 if '..' not in sys.path: sys.path.append('..')
 from strtypes import error, warning, info
 from AndorFunctions import Andor, ERROR_CODE, Sensitivity, ReadNoise
+from simAndor import SimAndor
+from networking.linkstats import get_link
+try:
+    import win32event
+except ImportError:
+    win32event = None # only the simulated camera can be used
 
 try:
     from PyQt4.QtCore import QThread, pyqtSignal, QEvent, pyqtSlot, QObject
@@ -29,18 +38,33 @@ class camera(QThread):
     Initiate the Andor camera. An external TTL should be connected
     to the StartAcquisition slot to take an image. The Andor SDK is 
     connected to the signal AcquisitionEvent which is emitted when
-    an acquisition is completed or aborted, or temperature updates."""
-    AcquisitionEvent = win32event.CreateEvent(None, 0, 0, 'Acquisition')
+    an acquisition is completed or aborted, or temperature updates.
+    Keyword arguments:
+    config_file -- file to load the acquisition settings from.
+    simulate    -- use a simulated camera instead of the Andor SDK. Either
+        True or a dictionary of keyword arguments for simAndor.SimAndor."""
+    AcquisitionEvent = win32event.CreateEvent(None, 0, 0, 'Acquisition') if win32event else None
     AcquireEnd = pyqtSignal(np.ndarray) # send to image analysis 
+    FrameReady = pyqtSignal(np.ndarray, int) # image and its index in the camera buffer
     # emit (EM gain, preamp gain, readout noise) when the acquisition settings are updated
     SettingsChanged = pyqtSignal([float, float, float, bool])
     # emit the smallest dimension of image height/width when ROI is updated
     ROIChanged = pyqtSignal([int, int])
 
-    def __init__(self, config_file=".\\ExExposure_config.dat"):
+    def __init__(self, config_file=".\\ExExposure_config.dat", simulate=False):
         super().__init__()   # Initialise the parent classes
         self.lastImage   = np.zeros((32,32)) # last acquired image
         self.BufferSize  = 0 # number of images that can fit in the buffer
+        # images are copied from the camera buffer into a pool of frames that is 
+        # reused, so receivers must finish with an image before pool_size more arrive
+        self.pool_size   = 128
+        self.pool        = np.zeros((0,1,1,1), dtype=np.int32)
+        self.slot        = 0 # next position in the pool to copy into
+        self.next_ind    = 1 # buffer index of the next image expected
+        self.occupancy   = 0 # number of new images in the buffer at the last drain
+        self.dropped     = 0 # number of images overwritten before they were retrieved
+        self.crop        = 0 # whether the sensor window was set with isolated crop mode
+        self.stats = get_link('Camera') # retrieval latency and buffer occupancy
 
         self.emg = 1.0  # applied EM gain
         self.pag = 4.50 # preamp gain sensitivity (e- per AD count)
@@ -55,15 +79,18 @@ class camera(QThread):
         
         self.initialised = 0 # check whether the camera functions were loaded 
         try: 
-            self.AF = Andor() # functions for Andor camera
+            if simulate:
+                self.AF = SimAndor(**(simulate if isinstance(simulate, dict) else {}))
+                self.AcquisitionEvent = threading.Event() # set by the simulation for each frame
+            else: self.AF = Andor() # functions for Andor camera
             self.AF.verbosity = False  # Set True for debugging
             self.AF.connected = False
             self.initialised  = 1 # functions loaded but camera not connected
-            if self.AF.OS == "Windows" and self.AF.architecture == "64bit":
+            if simulate or (self.AF.OS == "Windows" and self.AF.architecture == "64bit"):
                 self.CameraConnect()
                 self.initialised = 2 # camera connected, default config
                 if self.AF.connected == True:
-                    self.AF.SetDriverEvent(int(self.AcquisitionEvent))
+                    self.AF.SetDriverEvent(self.AcquisitionEvent if simulate else int(self.AcquisitionEvent))
                     self.ApplySettingsFromConfig(config_file=config_file) 
                     # self.StabiliseTemperature()
                     self.initialised = 3 # fully initialised
@@ -308,14 +335,76 @@ class camera(QThread):
         self.AF.ROIheight = (vend - vstart + 1) // vbin
         if crop:
             error = self.AF.SetIsolatedCropModeEx(
-                crop, self.AF.ROIheight, self.AF.ROIwidth, 
-                hbin, vbin, hstart, vstart)
+                crop, self.AF.ROIheight, self.AF.ROIwidth,
+                vbin, hbin, hstart, vstart)
             self.AF.SetIsolatedCropModeType(slowcrop)
+            # SetImage isn't used in crop mode, so store the window here
+            self.AF.hbin, self.AF.vbin = hbin, vbin
+            self.AF.hstart, self.AF.hend = hstart, hend
+            self.AF.vstart, self.AF.vend = vstart, vend
         else:
             error = self.AF.SetImage(hbin,vbin,hstart,hend,vstart,vend)
+        if ERROR_CODE[error] == 'DRV_SUCCESS': self.crop = crop
         self.ROIChanged.emit(self.AF.ROIwidth, self.AF.ROIheight)
         return error
-            
+
+    def SensorWindow(self):
+        """Return the part of the sensor that is read out, in binned
+        pixels of the full sensor: (x0, y0, x1, y1) for an image that
+        is the window im[x0:x1, y0:y1] of a full image."""
+        x0 = (self.AF.hstart - 1) // self.AF.hbin
+        y0 = (self.AF.vstart - 1) // self.AF.vbin
+        return (x0, y0, x0 + self.AF.ROIwidth, y0 + self.AF.ROIheight)
+
+    def CropToROIs(self, boxes, margin=4, slowcrop=1):
+        """Crop the sensor to the smallest window that covers all of the
+        boxes plus a margin, so that only the pixels that are analysed
+        are read out. The binning stays the same. If isolated crop mode
+        isn't available, the window is set with SetImage instead.
+        Keyword arguments:
+        boxes    -- list of (x0, y0, x1, y1) covering im[x0:x1, y0:y1] in
+            pixels of the current image. If empty, read out the full sensor.
+        margin   -- number of pixels to add around the boxes.
+        slowcrop -- 0: high speed, 1: low latency. See SetROI.
+        Returns the error and (dx, dy): the shift to add to coordinates
+        in the current image to get the same pixels in the new image.
+        If the window can't be set, the previous window is restored and 
+        the shift is (0, 0)."""
+        prev = {key: getattr(self.AF, key) for key in ['ROI', 'ROIwidth', 'ROIheight',
+            'hbin', 'vbin', 'hstart', 'hend', 'vstart', 'vend']}
+        prev_crop = self.crop
+        hbin, vbin = self.AF.hbin, self.AF.vbin
+        hstart, vstart = self.AF.hstart, self.AF.vstart
+        # image pixel x starts at sensor pixel hstart + x*hbin
+        xlim = (-((hstart - 1)//hbin), (self.AF.DetectorWidth - hstart + 1)//hbin)
+        ylim = (-((vstart - 1)//vbin), (self.AF.DetectorHeight - vstart + 1)//vbin)
+        if len(boxes):
+            b = np.array(boxes, dtype=int)
+            x0, x1 = max(int(b[:,0].min()) - margin, xlim[0]), min(int(b[:,2].max()) + margin, xlim[1])
+            y0, y1 = max(int(b[:,1].min()) - margin, ylim[0]), min(int(b[:,3].max()) + margin, ylim[1])
+            crop = 1
+        else: (x0, x1), (y0, y1), crop = xlim, ylim, 0
+        ROI = (hstart + x0*hbin, hstart + x1*hbin - 1, vstart + y0*vbin, vstart + y1*vbin - 1)
+        err = self.SetROI(ROI, hbin, vbin, crop, slowcrop)
+        if crop and ERROR_CODE[err] != 'DRV_SUCCESS':
+            warning('Andor camera isolated crop mode failed: %s. '%ERROR_CODE[err] +
+                'Setting the image window instead.')
+            self.AF.SetIsolatedCropModeEx(0, self.AF.ROIheight, self.AF.ROIwidth,
+                vbin, hbin, ROI[0], ROI[2])
+            err = self.SetROI(ROI, hbin, vbin, 0)
+        if ERROR_CODE[err] != 'DRV_SUCCESS':
+            warning('Andor camera failed to set the window %s: %s. '%(ROI, ERROR_CODE[err]) +
+                'Keeping the previous window.')
+            self.SetROI(prev['ROI'], hbin, vbin, prev_crop, slowcrop)
+            for key, val in prev.items(): # SetROI stores the window before the SDK call
+                setattr(self.AF, key, val)
+            self.crop = prev_crop
+            return err, (0, 0)
+        self.AF.ROI = ROI
+        info('Andor camera reading out %sx%s pixels, readout time %.3g ms'%(
+            self.AF.ROIwidth, self.AF.ROIheight, self.AF.GetReadOutTime()*1e3))
+        return err, (-x0, -y0)
+
     def CheckCurrentSettings(self):
         """Check what the camera is currently set to."""
         print("\nCamera status: " + self.AF.GetStatus())
@@ -351,6 +440,17 @@ class camera(QThread):
                 + " Stabilising...")
             time.sleep(10)
         
+    def WaitForEvent(self, timeout=None):
+        """Wait for the driver to set the acquisition event. Returns True if
+        it was set, False if the timeout (ms) passed. None waits forever."""
+        if isinstance(self.AcquisitionEvent, threading.Event): # simulated camera
+            result = self.AcquisitionEvent.wait(None if timeout is None else timeout*1e-3)
+            self.AcquisitionEvent.clear() # auto-reset like the win32 event
+            return result
+        result = win32event.WaitForSingleObject(self.AcquisitionEvent, 
+            win32event.INFINITE if timeout is None else int(timeout))
+        return result == win32event.WAIT_OBJECT_0
+
     def Acquire(self):
         """Retrieve a single image from the EMCCD.
         This is a slot to be triggered by an acquisition completed event.
@@ -371,11 +471,9 @@ class camera(QThread):
         to take an acquisition."""
         for i in range(n):
             self.AF.StartAcquisition()
-            result = win32event.WaitForSingleObject(
-                            self.AcquisitionEvent, self.timeout)
-            if result == win32event.WAIT_OBJECT_0:
+            if self.WaitForEvent(self.timeout):
                 self.Acquire()
-            elif result == win32event.WAIT_TIMEOUT and self.AF.verbosity:
+            elif self.AF.verbosity:
                 print('Acquisition timeout ', i)
         self.finished.emit()
         
@@ -392,23 +490,60 @@ class camera(QThread):
                                             self.AF.ROIheight)
         else: return []
             
+    def DrainBuffer(self):
+        """Copy all of the new images from the camera's circular buffer into
+        the frame pool with one GetImages call (two if the pool wraps 
+        around), then emit copies of them in order with their buffer indexes. Images
+        that were overwritten before they could be retrieved are counted
+        in self.dropped. Returns the number of images retrieved."""
+        t = time.time()
+        first, last = self.AF.GetNumberNewImages()
+        if last < first: return 0
+        self.occupancy = last - first + 1
+        self.stats.set_queue_depth(self.occupancy)
+        w, h = self.AF.ROIwidth, self.AF.ROIheight
+        shape = (self.pool_size, self.AF.kscans, w, h)
+        if self.pool.shape != shape:
+            self.pool = np.zeros(shape, dtype=np.int32)
+            self.slot = 0
+        n = 0
+        while first <= last:
+            k = min(last - first + 1, self.pool_size - self.slot)
+            frames = self.AF.GetImages(first, first+k-1, w, h, 
+                out=self.pool[self.slot:self.slot+k])
+            self.t1 = time.time()
+            self.stats.record('retrieval', self.t1 - t)
+            lo, hi = max(self.AF.validfirst, first), min(self.AF.validlast, first+k-1)
+            start = min(lo, first+k) # first valid image, or the end of the chunk if none are
+            if start > self.next_ind: # the camera overwrote images
+                self.dropped += start - self.next_ind
+                warning('Camera buffer overflowed: lost images %s - %s'%(self.next_ind, start-1))
+            for i in range(lo, hi+1):
+                # copy, since the slot is reused while receivers may still hold the image
+                im = frames[i - first].copy()
+                if im.any(): # sometimes the image is empty
+                    self.lastImage = im
+                    self.AcquireEnd.emit(im[0]) # emit signals
+                    self.FrameReady.emit(im[0], i)
+                    self.ind += 1
+            self.next_ind = max(self.next_ind, start, hi + 1)
+            self.slot = (self.slot + k) % self.pool_size
+            first += k
+            n += k
+        self.stats.record('drain', time.time() - t)
+        return n
+
     # run method is called when the thread is started     
     def run(self):
-        """Start an Acquisition and wait for a signal to abort"""
+        """Start an Acquisition and wait for a signal to abort. Each time the
+        driver event is set, all of the new images are retrieved."""
         self.idle_time = time.time() - self.t2 # time since last acquisition
+        self.next_ind = 1 # the buffer indexes restart with each acquisition
         self.AF.StartAcquisition()
         while self.AF.GetStatus() == 'DRV_ACQUIRING':
             self.t0 = time.time() 
-            result = win32event.WaitForSingleObject(
-                            self.AcquisitionEvent, win32event.INFINITE)
-            if result == win32event.WAIT_OBJECT_0: # get image
-                self.lastImage = self.AF.GetOldestImage(
-                        self.AF.ROIwidth, self.AF.ROIheight)
-                self.t1 = time.time() 
-                if self.lastImage.any(): # sometimes last image is empty
-                    self.AcquireEnd.emit(self.lastImage[0]) # emit signals
-                    # print(self.ind, ' ', np.sum(self.lastImage), end=' ')
-                    self.ind += 1
+            if self.WaitForEvent(): # get images
+                self.DrainBuffer()
             self.t2 = time.time()
         
     def PrintTimes(self, unit="s"):
@@ -424,6 +559,8 @@ class camera(QThread):
                 self.idle_time*scale)+unit)
         print("Last time taken to acquire image: %.4g "%(
                 (self.t1 - self.t0)*scale)+unit)
+        print("Images in buffer at last retrieval: %s, images lost: %s"%(
+                self.occupancy, self.dropped))
         print("Last time taken to emit signals: %.4g "%(
                 (self.t2 - self.t1)*scale)+unit)
         print("Readout time: %.4g "%(
@@ -0,0 +1,334 @@
+"""PyDex - simulated Andor camera
+
+ - Stand in for AndorFunctions.Andor so that the acquisition chain
+ (cameraHandler -> runid -> imsaver -> image analysis) can run and be
+ profiled without the camera or the Andor SDK.
+ - Implements the functions that cameraHandler uses, with the same return
+ values: error codes from ERROR_CODE, status strings, and image arrays
+ with shape (# kinetic scans, ROI width, ROI height).
+ - Images have a Poissonian background, EM gain noise, read noise and a
+ bias offset. Atoms are placed at the tweezer positions: each tweezer is
+ loaded with the loading probability in the first image of a run, then
+ the atom survives into the next image with the survival probability.
+ - While acquiring, frames are taken at a fixed rate, or one at a time
+ with SendSoftwareTrigger() (e.g. from the DExTer emulator). They are
+ stored in a circular buffer and the driver event is set for each one,
+ like the SDK.
+ Usage: cam = cameraHandler.camera(config_file, simulate=True)
+"""
+import sys
+import time
+import threading
+import numpy as np
+from math import erf, sqrt
+if '.' not in sys.path: sys.path.append('.')
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info
+from AndorFunctions import ERROR_CODE, Sensitivity, ReadNoise
+
+CODE = {val: key for key, val in ERROR_CODE.items()} # look up the code from its name
+SUCCESS = CODE['DRV_SUCCESS']
+
+class SimAndor:
+    """Simulated Andor iXon EMCCD with the same functions as
+    AndorFunctions.Andor.
+    Keyword arguments:
+    tweezers   -- list of (x, y) positions of the tweezers on the sensor
+        in pixels, numbered from 1 like the SDK's image settings.
+    loading    -- probability that a tweezer is loaded in the first image of a run.
+    survival   -- probability that an atom is still there in the next image.
+    nims       -- number of images in a run.
+    signal     -- mean number of photoelectrons collected from an atom.
+    psf        -- standard deviation (pixels) of the spot from an atom.
+    background -- mean number of background photoelectrons per pixel.
+    bias       -- offset (counts) added to every pixel.
+    rate       -- frames per second while acquiring. 0 to only take frames
+        when SendSoftwareTrigger() is called.
+    size       -- (width, height) of the sensor in pixels.
+    buffer     -- number of images the circular buffer holds.
+    seed       -- seed for the random number generator."""
+    simulated = True
+
+    def __init__(self, tweezers=[(256,256)], loading=0.5, survival=0.9, nims=2,
+            signal=200, psf=1.0, background=0.2, bias=697, rate=0, size=(512,512),
+            buffer=256, seed=None):
+        self.tweezers   = tweezers
+        self.loading    = loading
+        self.survival   = survival
+        self.nims       = nims
+        self.signal     = signal
+        self.psf        = psf
+        self.background = background
+        self.bias       = bias
+        self.rate       = rate
+        self.rng = np.random.default_rng(seed)
+        self.OS, self.architecture = 'Simulated', '64bit'
+        self.dll = None
+        self.verbosity      = False
+        self.connected      = False
+        self.serial         = 0
+        self.coolerStatus   = 0
+        self.coolerMode     = 1
+        self.shutterStatus  = 0
+        self.temperatureSetpoint = -60
+        self.outamp         = 0
+        self.gain           = 1
+        self.preampgain     = 3
+        self.noADChannels   = 1
+        self.channel        = 0
+        self.noHSSpeeds     = 4
+        self.HSSpeeds       = [17.0, 10.0, 5.0, 1.0]
+        self.hsspeed        = 2
+        self.noVSSpeeds     = 5
+        self.VSSpeeds       = [0.3, 0.5, 0.9, 1.7, 3.3]
+        self.vsspeed        = 4
+        self.ReadMode       = 4
+        self.AcquisitionMode = 5
+        self.TriggerMode    = 7
+        self.PrevTrigger    = 7
+        self.exposure       = 70e-6
+        self.accumulate     = 0
+        self.kinetic        = 0
+        self.DetectorWidth, self.DetectorHeight = size
+        self.ROI            = None
+        self.hbin, self.vbin = 1, 1
+        self.hstart, self.hend = 1, size[0]
+        self.vstart, self.vend = 1, size[1]
+        self.ROIwidth, self.ROIheight = size
+        self.kscans         = 1
+        self.naccumulate    = 1
+        self.status         = 'DRV_IDLE'
+        self.BufferSize     = buffer
+        self.validfirst, self.validlast = 0, 0 # valid images from the last GetImages
+        self.event  = None # driver event, set for each frame
+        self.lock   = threading.Lock()
+        self.ring   = np.zeros((0, 1, 1, 1), dtype=np.int32) # circular buffer
+        self.last   = 0 # index of the last image acquired (from 1)
+        self.got    = 0 # index of the last image retrieved
+        self.imn    = 0 # image number in the current run
+        self.occupied = np.zeros(len(tweezers), dtype=bool)
+        self._stop = threading.Event()
+        self._timer = None
+
+    def verbose(self, errorcode, function=''):
+        if self.verbosity:
+            print("[%s]: %s" %(function, ERROR_CODE[errorcode]))
+
+    def set(self, function, **kwargs):
+        """Store the settings as attributes and return success."""
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+        self.verbose(SUCCESS, function)
+        return SUCCESS
+
+    #### #### camera settings #### ####
+
+    def Initialize(self): return self.set('Initialize')
+    def ShutDown(self):
+        self.AbortAcquisition()
+        return self.set('ShutDown', connected=False)
+    def GetCameraSerialNumber(self): return self.set('GetCameraSerialNumber')
+    def CoolerON(self): return self.set('CoolerON', coolerStatus=1)
+    def CoolerOFF(self): return self.set('CoolerOFF', coolerStatus=0)
+    def SetCoolerMode(self, mode): return self.set('SetCoolerMode', coolerMode=mode)
+    def SetTemperature(self, setpoint): return self.set('SetTemperature', temperatureSetpoint=setpoint)
+    def GetTemperatureF(self): return (float(self.temperatureSetpoint), CODE['DRV_TEMP_STABILIZED'])
+    def GetTemperature(self): return (int(self.temperatureSetpoint), CODE['DRV_TEMP_STABILIZED'])
+    def GetTemperatureRange(self): return (-100, 20)
+    def SetShutter(self, typ, mode, closingtime=0, openingtime=0):
+        return self.set('SetShutter', shutterStatus=mode)
+    def SetTriggerMode(self, mode): return self.set('SetTriggerMode', TriggerMode=mode)
+    def SetFastExtTrigger(self, mode): return self.set('SetFastExtTrigger')
+    def SetPreAmpGain(self, PAG): return self.set('SetPreAmpGain', preampgain=PAG)
+    def GetCurrentPreAmpGain(self): return self.preampgain
+    def GetEMCCDGain(self): return self.gain
+    def SetEMGainMode(self, gainMode=0): return self.set('SetEMGainMode')
+    def SetEMCCDGain(self, gain): return self.set('SetEMCCDGain', gain=gain)
+    def SetOutputAmplifier(self, index=0): return self.set('SetOutputAmplifier', outamp=index)
+    def GetNumberADChannels(self): return self.set('GetNumberADChannels')
+    def SetADChannel(self, index=0): return self.set('SetADChannel', channel=index)
+    def GetBitDepth(self): return 16
+    def GetNumberHSSpeeds(self): return self.set('GetNumberHSSpeeds')
+    def GetHSSpeed(self): return self.set('GetHSSpeed')
+    def SetHSSpeed(self, itype, index): return self.set('SetHSSpeed', hsspeed=index)
+    def GetNumberVSSpeeds(self): return self.set('GetNumberVSSpeeds')
+    def GetVSSpeed(self): return self.set('GetVSSpeed')
+    def SetVSSpeed(self, index=4): return self.set('SetVSSpeed', vsspeed=index)
+    def SetReadMode(self, mode=4): return self.set('SetReadMode', ReadMode=mode)
+    def GetDetector(self): return self.set('GetDetector')
+    def SetAcquisitionMode(self, mode): return self.set('SetAcquisitionMode', AcquisitionMode=mode)
+    def SetExposureTime(self, time): return self.set('SetExposureTime', exposure=time)
+    def SetNumberKinetics(self, numKinScans): return self.set('SetNumberKinetics', kscans=numKinScans)
+    def SetKineticCycleTime(self, time): return self.set('SetKineticCycleTime', kinetic=time)
+    def SetNumberAccumulations(self, number): return self.set('SetNumberAccumulations', naccumulate=number)
+    def SetFrameTransferMode(self, mode): return self.set('SetFrameTransferMode')
+    def SetDriverEvent(self, driverEvent): return self.set('SetDriverEvent', event=driverEvent)
+    def SetIsolatedCropModeType(self, mode): return self.set('SetIsolatedCropModeType')
+    def SetDMAParameters(self, MaxImagesPerDMA, SecondsPerDMA): return self.set('SetDMAParameters')
+    def GetAcquisitionTimings(self): return self.set('GetAcquisitionTimings')
+    def GetSizeOfCircularBuffer(self): return self.BufferSize
+    def GetKeepCleanTime(self): return 1e-4
+
+    def GetReadOutTime(self):
+        """Time to shift out the rows and then the pixels in the ROI."""
+        rows = self.vend - self.vstart + 1
+        return (rows * self.VSSpeeds[self.vsspeed] * 1e-6 +
+            self.ROIwidth * self.ROIheight / self.HSSpeeds[self.hsspeed] * 1e-6)
+
+    def SetImage(self, hbin, vbin, hstart, hend, vstart, vend):
+        """Define the extent of the CCD and the binning."""
+        if not (1 <= hstart <= hend <= self.DetectorWidth and 1 <= vstart <= vend <= self.DetectorHeight):
+            return CODE['DRV_P1INVALID']
+        return self.set('SetImage', hbin=hbin, vbin=vbin, hstart=hstart, hend=hend,
+            vstart=vstart, vend=vend, ROIwidth=(hend-hstart+1)//hbin, ROIheight=(vend-vstart+1)//vbin)
+
+    def SetIsolatedCropModeEx(self, active, cropheight, cropwidth,
+            vbin, hbin, cropleft, cropbottom):
+        """Crop the sensor to the given width and height."""
+        if not active: return self.set('SetIsolatedCropModeEx')
+        return self.SetImage(hbin, vbin, cropleft, cropleft + cropwidth*hbin - 1,
+            cropbottom, cropbottom + cropheight*vbin - 1)
+
+    #### #### simulated images #### ####
+
+    def pixel_weights(self, x, start, n, binning):
+        """Fraction of an atom's light at position x that falls in each of
+        the n binned pixels starting at sensor pixel start."""
+        edges = start - 0.5 + binning*np.arange(n+1)
+        cdf = np.array([0.5*(1 + erf((e - x)/sqrt(2)/self.psf)) for e in edges])
+        return np.diff(cdf)
+
+    def make_frame(self):
+        """Simulate one image from the current ROI, shape (width, height)."""
+        w, h = self.ROIwidth, self.ROIheight
+        if self.imn == 0: # load the tweezers at the start of a run
+            self.occupied = self.rng.random(len(self.tweezers)) < self.loading
+        else: # some atoms are lost between images
+            self.occupied &= self.rng.random(len(self.tweezers)) < self.survival
+        self.imn = (self.imn + 1) % max(self.nims, 1)
+        electrons = np.full((w, h), self.background * self.hbin * self.vbin)
+        for (x, y), atom in zip(self.tweezers, self.occupied):
+            if atom:
+                electrons += self.signal * np.outer(self.pixel_weights(x, self.hstart, w, self.hbin),
+                    self.pixel_weights(y, self.vstart, h, self.vbin))
+        electrons = self.rng.poisson(electrons)
+        gain = self.gain if self.outamp == 0 and self.gain > 1 else 1
+        if gain > 1: # EM register: output for n electrons is gamma distributed
+            electrons = self.rng.gamma(np.maximum(electrons, 1e-12), gain) * (electrons > 0)
+        try:
+            ind = 12*self.outamp + 3*self.hsspeed + self.preampgain - 1
+            pag, Nr = Sensitivity[ind], ReadNoise[ind]
+        except (IndexError, TypeError): pag, Nr = 4.5, 8.8
+        im = electrons / pag + self.rng.normal(self.bias, Nr, (w, h))
+        return np.clip(np.rint(im), 0, 2**16 - 1).astype(np.int32)
+
+    def take_frame(self):
+        """Acquire an image (of kscans frames) into the circular buffer and
+        set the driver event. Ends the acquisition if it isn't continuous."""
+        frames = np.array([self.make_frame() for i in range(self.kscans)])
+        with self.lock:
+            if self.status != 'DRV_ACQUIRING': return
+            self.ring[self.last % len(self.ring)] = frames
+            self.last += 1
+            self.got = max(self.got, self.last - len(self.ring)) # overwritten
+            if self.AcquisitionMode != 5: # single scan, accumulate, kinetics
+                self.status = 'DRV_IDLE'
+        self.set_event()
+
+    def set_event(self):
+        if self.event is not None:
+            try: self.event.set()
+            except AttributeError: pass # a win32 event handle
+
+    def run_timer(self):
+        """Take frames at the set rate until the acquisition stops."""
+        t = time.time()
+        while not self._stop.wait(max(t + 1/self.rate - time.time(), 0)):
+            t += 1/self.rate
+            self.take_frame()
+            if self.status != 'DRV_ACQUIRING': break
+
+    #### #### acquisition #### ####
+
+    def GetStatus(self):
+        return self.status
+
+    def StartAcquisition(self):
+        """Start acquiring into an empty circular buffer."""
+        with self.lock:
+            if self.status == 'DRV_ACQUIRING': return CODE['DRV_ACQUIRING']
+            shape = (self.BufferSize, self.kscans, self.ROIwidth, self.ROIheight)
+            if self.ring.shape != shape:
+                self.ring = np.zeros(shape, dtype=np.int32)
+            self.last, self.got = 0, 0
+            self.status = 'DRV_ACQUIRING'
+        if self.rate > 0:
+            self._stop.clear()
+            self._timer = threading.Thread(target=self.run_timer, daemon=True)
+            self._timer.start()
+        return self.set('StartAcquisition')
+
+    def SendSoftwareTrigger(self):
+        """Take an image now, as if the camera received a trigger."""
+        if self.status != 'DRV_ACQUIRING': return CODE['DRV_IDLE']
+        self.take_frame()
+        return self.set('SendSoftwareTrigger')
+
+    def AbortAcquisition(self):
+        """Stop acquiring and set the driver event so that waiting threads wake up."""
+        self._stop.set()
+        with self.lock:
+            if self.status != 'DRV_ACQUIRING': return CODE['DRV_IDLE']
+            self.status = 'DRV_IDLE'
+        self.set_event()
+        return self.set('AbortAcquisition')
+
+    def shape(self, dimx, dimy):
+        if (dimx, dimy) != (self.ROIwidth, self.ROIheight):
+            warning('Simulated camera: requested image size (%s, %s) '%(dimx, dimy) +
+                "doesn't match the ROI (%s, %s)"%(self.ROIwidth, self.ROIheight))
+
+    def GetAcquiredData(self, dimx, dimy):
+        """Return the last image acquired."""
+        self.shape(dimx, dimy)
+        with self.lock:
+            if not self.last: return np.zeros((self.kscans, dimx, dimy), dtype=np.int32)
+            self.got = self.last
+            return self.ring[(self.last - 1) % len(self.ring)].copy()
+
+    def GetOldestImage(self, dimx, dimy, numKinScans=1):
+        """Return the oldest image that hasn't been retrieved, or zeros if
+        there are no new images."""
+        self.shape(dimx, dimy)
+        with self.lock:
+            if self.got >= self.last:
+                return np.zeros((self.kscans, dimx, dimy), dtype=np.int32)
+            self.got += 1
+            return self.ring[(self.got - 1) % len(self.ring)].copy()
+
+    def GetImages(self, first, last, dimx, dimy, out=None):
+        """Return the images with indexes first to last (from 1), shape
+        (# images, # kinetic scans, width, height). If out is given, the
+        images are copied into it. The indexes of the images that were
+        valid are stored in self.validfirst and self.validlast."""
+        self.shape(dimx, dimy)
+        n = max(last - first + 1, 0)
+        if out is None:
+            out = np.zeros((n, self.kscans, dimx, dimy), dtype=np.int32)
+        with self.lock:
+            self.validfirst = max(first, self.last - len(self.ring) + 1, 1)
+            self.validlast = min(last, self.last)
+            if self.validlast >= self.validfirst:
+                out[self.validfirst-first:self.validlast-first+1] = self.ring[
+                    np.arange(self.validfirst - 1, self.validlast) % len(self.ring)]
+                self.got = max(self.got, self.validlast)
+        return out[:n]
+
+    def GetNumberAvailableImages(self):
+        with self.lock:
+            return (max(self.last - len(self.ring) + 1, 1), self.last)
+
+    def GetNumberNewImages(self):
+        """Return the indexes of the first and last images not yet retrieved."""
+        with self.lock:
+            return (self.got + 1, self.last)
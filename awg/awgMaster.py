@@ -16,6 +16,8 @@ Stefan Spence 27.06.20
 """
 import time
 import os
+import ast
+import threading
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 import sys
 sys.path.append('..')
@@ -37,10 +39,16 @@ from pyspcm import spcm_dwGetParam_i32, byref, int32
 import fileWriter as fw
 from networking.networker import PyServer, reset_slot
 from networking.client import PyClient
+from networking.awgcmd import AWGCommandServer
+from networking.occupancy import OccupancyListener
 import rearrHandler
 
 ####    ####    ####    ####
 
+def strip_file_url(path):
+    """Remove the file:/// prefix that a path dragged from a file browser has."""
+    return path[len('file:///'):] if path.startswith('file:///') else path
+
 class awg_window(QMainWindow):
     """A basic GUI to take in commands from the user.
     
@@ -63,6 +71,17 @@ class awg_window(QMainWindow):
         self.rr = rearrHandler.rearrange(AWG_channels) # opens AWG card via rearr class and initiates
         self.rr.awg.load(default_seq) # load basic data
         self.auto_plot = False # whether to automatically display the new sequence
+        self.awg_lock = threading.RLock() # commands can come from the GUI or the command server
+        self.cmds = AWGCommandServer({'load':self.load_data, 'rload':self.rload_data,
+            'save':self.save_data, 'set_data':self.set_data, 'set_step':self.set_steps, 
+            'rearrange':self.rearrange, 'start_awg':self.start_awg, 
+            'stop_awg':self.stop_awg, 'auto_plot':self.set_auto_plot,
+            'reset_awg':self.reset_awg, 'rearr_on':self.rearr_on, 
+            'rearr_off':self.rearr_off}, port=8628)
+        self.cmds.status[str].connect(self.set_status)
+        self.cmds.start() # binary commands from PyDex, handled on the server thread
+        self.occ = OccupancyListener(self.rearrange, port=8629) # fast path for rearrangement
+        self.occ.start()
         self.idle_state()
 
     def init_UI(self):
@@ -131,29 +150,12 @@ class awg_window(QMainWindow):
 
         if 'load' in cmd and 'rload' not in cmd:
             self.set_status('Loading AWG data...')
-            try:     
-                path = cmd.split('=')[1].strip('file:///')
-                if self.rr.rearrToggle == False:
-                    self.rr.awg.load(path)    # NB load is defined differently in rearrHandler, depending if rearrToggle is true/false
-                elif self.rr.rearrToggle == True:
-                    self.rr.rearr_load(path)
-                if self.auto_plot:
-                    plot_playback(self.rr.awg.filedata)
-                self.set_status('File loaded from '+path)
-            except Exception as e:
-                self.set_status('Failed to load AWG data from '+cmd.split('=')[1])
-                logger.error('Failed to load AWG data from '+cmd.split('=')[1]+'\n'+str(e))
+            if self.run_handler(self.load_data, cmd.split('=')[1], 
+                    'Failed to load AWG data from '+cmd.split('=')[1]) and self.auto_plot:
+                plot_playback(self.rr.awg.filedata)
         elif 'save' in cmd:
-            try: 
-                path = cmd.split('=')[1]
-                if self.rr.rearrToggle==False:
-                    self.rr.awg.saveData(path)
-                elif self.rr.rearrToggle == True: 
-                    self.rr.rearr_saveData(path)
-                    
-                self.set_status('File saved to '+path)                    
-            except Exception as e:
-                logger.error('Failed to save AWG data to '+cmd.split('=')[1]+'\n'+str(e))
+            self.run_handler(self.save_data, cmd.split('=')[1],
+                'Failed to save AWG data to '+cmd.split('=')[1])
         elif 'reset_server' in cmd:
             self.reset_tcp()
             if self.server.isRunning(): status = 'Server running.'
@@ -166,39 +168,24 @@ class awg_window(QMainWindow):
             self.set_status('Triggering DExTer not yet supported.')
         elif 'auto_plot' in cmd:
             try:
-                self.auto_plot = eval(cmd.split('=')[1])
+                self.set_auto_plot(ast.literal_eval(cmd.split('=')[1]))
                 plot_playback(self.rr.awg.filedata)
             except Exception as e: 
                 logger.error('Failed to evaluate command:\t%s\n'%cmd + str(e))
         elif 'start_awg' in cmd:
-            self.rr.awg.start()
-            if spcm_dwGetParam_i32 (AWG.hCard, AWG.registers[3], byref(int32(0))) == 0:
-                self.set_status('AWG started.')
-            else:
-                self.set_status('AWG crashed. Use the reset_awg coommand.')
-                print(spcm_dwGetParam_i32 (AWG.hCard, AWG.registers[3], byref(int32(0))))
+            self.run_handler(self.start_awg, None, 'AWG crashed. Use the reset_awg coommand.')
         elif 'stop_awg' in cmd:
-            self.rr.awg.stop()
-            self.set_status('AWG stopped.')
+            self.run_handler(self.stop_awg, None, 'Failed to stop the AWG.')
         elif 'set_data' in cmd:    
             self.set_status('Received string = '+cmd.replace('#','').split('=')[1])  # print what occupancy string is received
-
-            #try:
-            t = time.time()
-            if self.rr.rearrToggle == False:
-                self.rr.awg.loadSeg(eval(cmd.split('=')[1])) # NB loadSeg defined differently in rearrHandler if rearrToggle = true/false
-            elif self.rr.rearrToggle == True:
-                self.rr.rearr_loadSeg(eval(cmd.split('=')[1]))
-
-            self.set_status('Set data: '+cmd.split('=')[1])
-            self.t_load = time.time() - t
-          #  except Exception as e:
-            #logger.error('Failed to set AWG data: '+cmd.split('=')[1]+'\n'+str(e))
+            try:
+                self.set_status(self.set_data(ast.literal_eval(cmd.split('=')[1])))
+            except Exception as e:
+                logger.error('Failed to set AWG data: '+cmd.split('=')[1]+'\n'+str(e))
             self.server.add_message(1,'go'*1000)
         elif 'set_step' in cmd:  
             try:
-                self.rr.awg.setStep(*eval(cmd.split('=')[1]))
-                self.set_status('Set step: '+cmd.split('=')[1])
+                self.set_status(self.set_steps([ast.literal_eval(cmd.split('=')[1])]))
             except Exception as e:
                 logger.error('Failed to set AWG step: '+cmd.split('=')[1]+'\n'+str(e))
         elif 'reset_awg' in cmd:
@@ -208,77 +195,169 @@ class awg_window(QMainWindow):
         
         
         elif 'rearrange' in cmd:   # recevive occupancy string from Pydex
-            if self.rr.rearrToggle==True:
-                try:
-                    self.rr.setRearrSeg(cmd.replace('#','').split('=')[1])
-                #  self.set_status('Received string = '+cmd.replace('#','').split('=')[1])  # print what occupancy string is received
-                except Exception as e:
-                    logger.error('Failed to calculate steps: '+cmd.replace('#','').split('=')[1]+'\n'+str(e))
-            elif self.rr.rearrToggle == False:
-                pass   # If rearr mode is off, ignore rearr TCP strings from AWG
+            try:
+                self.rearrange(cmd.replace('#','').split('=')[1])
+            except Exception as e:
+                logger.error('Failed to calculate steps: '+cmd.replace('#','').split('=')[1]+'\n'+str(e))
 
-        elif 'rearr_on' in cmd:
-         #   try:   
-            self.renewAWG('chans=[0]')
-            self.rr.awg.load(r'Z:\Tweezer\Code\Python 3.5\PyDex\awg\AWG template sequences\rearr_base.txt') # load basic data
-            self.rr.activate_rearr(toggle=True)
-            if '=' in cmd:  # if equals, then load in the specified rearragement config file.
-                self.rr.rr_config = cmd.partition('=')[2].strip('file:///')
+        elif 'rearr_on' in cmd: # rearr_on=config_path also loads the rearrangement config file
             self.set_status('Calculating moves...')
-            self.rr.calculateAllMoves()
-            self.set_status('Moves uploaded') 
-            #self.rr.awg.start().
-            if spcm_dwGetParam_i32 (AWG.hCard, AWG.registers[3], byref(int32(0))) == 0:
-                self.set_status('AWG started.')
-            else:
-                self.set_status('AWG crashed. Use the reset_awg coommand.')
-                print(spcm_dwGetParam_i32 (AWG.hCard, AWG.registers[3], byref(int32(0))))
-                
-           # except Exception as e:
-           #     logger.error('Failed to calculate all rearrangement segments: '+cmd.split('=')[1]+'\n'+str(e))               
+            self.run_handler(self.rearr_on, cmd.partition('=')[2].strip(),
+                'Failed to calculate all rearrangement segments: '+cmd.partition('=')[2])
         
         elif 'rearr_off' in cmd:
-            self.rr.activate_rearr(toggle=False)
-            self.set_status('Rearrangement is now off.')
-            if self.rr.OGfile is not None:
-                self.rr.awg.load(self.rr.OGfile)
-                self.set_status('Loaded: '+self.rr.OGfile)
+            self.run_handler(self.rearr_off, None, 'Failed to turn off rearrangement.')
         
         elif cmd.split('=')[0] == 'rload':    # required in order to overwrite the original file saved in rearrHandler.
-            try:
-                path = cmd.split('=')[1].strip('file:///')
-                self.rr.OGfile = None
-                self.rr.rearr_load(path)
-            except Exception as e:
-                self.set_status('Failed to load AWG data from '+cmd.split('=')[1])
-                logger.error('Failed to load AWG data from '+cmd.split('=')[1]+'\n'+str(e))
+            self.run_handler(self.rload_data, cmd.split('=')[1],
+                'Failed to load AWG data from '+cmd.split('=')[1])
             
         else:
             self.set_status('Command not recognised:\t %s'%cmd)
         self.edit.setText('') # reset cmd edit
        # self.set_status(cmd)
                         
+    def run_handler(self, handler, arg, fail_msg):
+        """Call a command handler for a text command, showing the status it
+        returns. If it raises, show fail_msg and log the error. Returns
+        whether the command succeeded."""
+        try:
+            msg = handler(arg)
+            if msg: self.set_status(msg)
+            return True
+        except Exception as e:
+            self.set_status(fail_msg)
+            logger.error(fail_msg+'\n'+str(e))
+            return False
+
+    #### #### command handlers: called from respond or the command server #### ####
+    # every handler that touches the AWG holds awg_lock
+
+    def load_data(self, path):
+        """Load AWG data from the file at path."""
+        path = strip_file_url(path)
+        with self.awg_lock:
+            if self.rr.rearrToggle == False:
+                self.rr.awg.load(path)    # NB load is defined differently in rearrHandler, depending if rearrToggle is true/false
+            elif self.rr.rearrToggle == True:
+                self.rr.rearr_load(path)
+        return 'File loaded from '+path
+
+    def rload_data(self, path):
+        """Load AWG data, overwriting the original file saved in rearrHandler."""
+        path = strip_file_url(path)
+        with self.awg_lock:
+            self.rr.OGfile = None
+            self.rr.rearr_load(path)
+        return 'File loaded from '+path
+
+    def save_data(self, path):
+        """Save the AWG data to the file at path."""
+        with self.awg_lock:
+            if self.rr.rearrToggle==False:
+                self.rr.awg.saveData(path)
+            elif self.rr.rearrToggle == True: 
+                self.rr.rearr_saveData(path)
+        return 'File saved to '+path
+
+    def set_data(self, rows):
+        """Change segment data: rows = [[channel, segment, parameter, value, list index], ...]"""
+        t = time.time()
+        with self.awg_lock:
+            if self.rr.rearrToggle == False:
+                self.rr.awg.loadSeg(rows) # NB loadSeg defined differently in rearrHandler if rearrToggle = true/false
+            elif self.rr.rearrToggle == True:
+                self.rr.rearr_loadSeg(rows)
+        self.t_load = time.time() - t
+        return 'Set data: '+str(rows)
+
+    def set_steps(self, rows):
+        """Set steps: rows = [[step, segment, # loops, next step, condition], ...]"""
+        with self.awg_lock:
+            for row in rows:
+                self.rr.awg.setStep(*row)
+        return 'Set step: '+str(rows)
+
+    def rearrange(self, occupancy):
+        """Set the rearrangement segment from the occupancy string, e.g. '0110'."""
+        if self.rr.rearrToggle==True:
+            with self.awg_lock:
+                self.rr.setRearrSeg(occupancy)
+        # If rearr mode is off, ignore rearr TCP strings from AWG
+        return ''
+
+    def start_awg(self, *args):
+        with self.awg_lock:
+            self.rr.awg.start()
+            if spcm_dwGetParam_i32 (AWG.hCard, AWG.registers[3], byref(int32(0))) == 0:
+                return 'AWG started.'
+        raise RuntimeError('AWG crashed. Use the reset_awg coommand.')
+
+    def stop_awg(self, *args):
+        with self.awg_lock:
+            self.rr.awg.stop()
+        return 'AWG stopped.'
+
+    def set_auto_plot(self, toggle):
+        """Whether to plot the sequence when it's loaded. Plots are only
+        made from the GUI thread."""
+        self.auto_plot = bool(toggle)
+        return 'auto_plot = %s'%self.auto_plot
+        
+    def reset_awg(self, channels=[0]):
+        """Create a new AWG instance with the list of channels activated."""
+        with self.awg_lock:
+            self.rr.awg.restart()
+            self.rr.awg.newCard()
+            self.rr.awg = None
+            self.rr.awg = AWG(list(channels))
+            self.rr.awg.setNumSegments(8)
+            # self.awg.setTrigger(0) # 0 software, 1 ext0
+            self.rr.awg.setSegDur(0.002)
+        return 'New instance of AWG created.'
+
+    def rearr_on(self, path=''):
+        """Activate rearrangement and calculate all of the moves. If path is
+        given, use it as the rearrangement config file. To refresh
+        rearrangement, call rearr_on again."""
+        with self.awg_lock: # reentrant, so reset_awg can take it again
+            self.reset_awg([0])
+            self.rr.awg.load(r'Z:\Tweezer\Code\Python 3.5\PyDex\awg\AWG template sequences\rearr_base.txt') # load basic data
+            self.rr.activate_rearr(toggle=True)
+            if path:
+                self.rr.rr_config = strip_file_url(path)
+            self.rr.calculateAllMoves()
+            #self.rr.awg.start().
+            if spcm_dwGetParam_i32 (AWG.hCard, AWG.registers[3], byref(int32(0))) != 0:
+                raise RuntimeError('Moves uploaded, but the AWG crashed. Use the reset_awg coommand.')
+        return 'Moves uploaded. AWG started.'
+
+    def rearr_off(self, *args):
+        """Deactivate rearrangement and reload the original AWG data."""
+        with self.awg_lock:
+            self.rr.activate_rearr(toggle=False)
+            if self.rr.OGfile is not None:
+                self.rr.awg.load(self.rr.OGfile)
+                return 'Rearrangement is now off. Loaded: '+self.rr.OGfile
+        return 'Rearrangement is now off.'
+        
     def renewAWG(self, cmd="chans=[0]"):
+        """Text command for reset_awg, e.g. 'reset_awg=[0,1]'"""
         try: 
-            eval(cmd.split('=')[1])
+            chans = ast.literal_eval(cmd.split('=')[1])
         except Exception as e:
             self.set_status('Invalid renew command: '+cmd)
             logger.error('Could not renew AWG.\n'+str(e))
             return 0
-        self.rr.awg.restart()
-        self.rr.awg.newCard()
-        self.rr.awg = None
-        self.rr.awg = AWG(eval(cmd.split('=')[1]))#
-        self.rr.awg.setNumSegments(8)
-        # self.awg.setTrigger(0) # 0 software, 1 ext0
-        self.rr.awg.setSegDur(0.002)
-        self.set_status('New instance of AWG created.')
+        self.run_handler(self.reset_awg, chans, 'Could not renew AWG.')
         
     def closeEvent(self, event):
         """Safely shut down when the user closes the window."""
         self.rr.awg.restart()
         self.client.close()
         self.server.close()
+        self.cmds.close()
+        self.occ.close()
         event.accept()        
 
 if __name__ == "__main__":
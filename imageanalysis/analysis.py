@@ -17,12 +17,148 @@ if '..' not in sys.path: sys.path.append('..')
 from strtypes import BOOL, error, warning, info
 
 ####    ####    ####    ####
+
+def col_dtype(t):
+    """Return the numpy dtype used to store values of type t."""
+    if t is int: return np.dtype(np.int64)
+    elif t is float: return np.dtype(np.float64)
+    elif t is BOOL or t is bool: return np.dtype(bool)
+    return np.dtype(object) # strings and anything else
+
+class Column:
+    """A growing column of stats stored in a numpy array.
+    Behaves like a list (append, extend, +=, indexing, iteration) so the
+    analysis classes can keep using stats[key], but the values are stored
+    in a preallocated array of fixed type that doubles in size when full.
+    np.array(col) or np.asarray(col) give a view of the filled part
+    without converting every element.
+    Keyword arguments:
+    type_    -- the type of the values, as in the Analysis types dict.
+    values   -- initial values.
+    capacity -- initial size of the array."""
+    def __init__(self, type_=float, values=(), capacity=64):
+        self.type = type_
+        self.dtype = col_dtype(type_)
+        vals = self.convert(values)
+        self.n = len(vals)
+        self.data = np.empty(max(capacity, 2*self.n), dtype=self.dtype)
+        self.data[:self.n] = vals
+
+    def convert(self, values):
+        """Return values as an array of the column dtype."""
+        if isinstance(values, Column): values = values.view()
+        if self.dtype.kind in 'if':
+            vals = np.asarray(values)
+            if vals.dtype.kind == 'f' and self.dtype.kind == 'i' and not np.all(np.isfinite(vals)):
+                raise ValueError('Cannot store NaN or inf in an int column')
+            try: return vals.astype(self.dtype)
+            except (ValueError, TypeError): pass # e.g. strings like '1.0' for an int
+        vals = list(map(self.type, values))
+        arr = np.empty(len(vals), dtype=self.dtype)
+        arr[:] = vals
+        return arr
+
+    def view(self):
+        """Array of the filled part of the column, without copying."""
+        data, n = self.data, self.n # take n after data in case of a resize
+        return data[:n]
+
+    def reserve(self, size):
+        """Make sure the array can hold size values."""
+        if size > len(self.data):
+            data = np.empty(max(size, 2*len(self.data)), dtype=self.dtype)
+            data[:self.n] = self.data[:self.n]
+            self.data = data
+
+    def append(self, value):
+        if self.dtype.kind == 'b': value = self.type(value)
+        self.reserve(self.n + 1)
+        self.data[self.n] = value
+        self.n += 1
+
+    def extend(self, values):
+        vals = self.convert(values)
+        self.reserve(self.n + len(vals))
+        self.data[self.n:self.n+len(vals)] = vals
+        self.n += len(vals)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def take(self, inds):
+        """Return a new Column with the values at inds (indexes or a mask)."""
+        return Column(self.type, self.view()[inds])
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        return iter(self.view().tolist())
+
+    def __contains__(self, value):
+        return value in self.view().tolist()
+
+    def __getitem__(self, i):
+        val = self.view()[i]
+        return val.item() if isinstance(val, np.generic) else val
+
+    def __setitem__(self, i, value):
+        self.view()[i] = value
+
+    def __array__(self, dtype=None, copy=None):
+        v = self.view()
+        if dtype is not None: v = v.astype(dtype)
+        return v.copy() if copy else v
+
+    def tolist(self):
+        return self.view().tolist()
+
+    def __repr__(self):
+        return 'Column(%s, %s)'%(self.type.__name__, self.tolist())
+
+class Stats(OrderedDict):
+    """An ordered dictionary of Columns, one for each key in types. 
+    Assigning a list or array to a key stores it as a Column of that type.
+    Keyword arguments:
+    types -- ordered dictionary of the type for each key.
+    items -- initial (key, values) pairs. Keys in types that aren't given
+        start as empty columns."""
+    def __init__(self, types=(), items=()):
+        self.types = OrderedDict(types)
+        super().__init__()
+        for key, t in self.types.items():
+            self[key] = []
+        for key, val in items:
+            self[key] = val
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, Column):
+            value = Column(self.types.get(key, float), value)
+        super().__setitem__(key, value)
+
+    def copy(self):
+        """Shallow copy: the new dictionary shares the same columns."""
+        return Stats(self.types, self.items())
+
+    def select(self, inds):
+        """Return new Stats with only the rows at inds (indexes or a mask)."""
+        inds = np.asarray(inds)
+        if inds.dtype == bool: # columns might have grown since the mask was made
+            inds = np.flatnonzero(inds)
+        return Stats(self.types, [(key, c.take(inds)) for key, c in self.items()])
+
+    def where_ids(self, ids, key='File ID'):
+        """Return a boolean mask of the rows whose File ID is in ids."""
+        return np.isin(np.asarray(self[key]), np.asarray(ids))
+
+####    ####    ####    ####
         
 class Analysis(QThread):
     """A template for analysis classes.
     It is recommended that properties which will have many elements
-    (e.g. collecting counts from series of images) are stored in lists.
-    These are collected in an ordered dictionary to keep them labelled.
+    (e.g. collecting counts from series of images) are stored in columns.
+    These are collected in a Stats ordered dictionary to keep them labelled.
     Also store the type for use when loading from file.
     These inherited properties must be initiated with super().__init__(...)
     so that the methods load() and save() can access them
@@ -33,9 +169,9 @@ class Analysis(QThread):
 
     def __init__(self, type_labels=[('File ID', str)]):
         super().__init__()
-        # note: all lists in the stats dictionary should have the same length.
+        # note: all columns in the stats dictionary should have the same length.
         self.types = OrderedDict(type_labels)
-        self.stats = OrderedDict([(key, []) for key in self.types.keys()])
+        self.stats = Stats(self.types)
         
         # class-specific properties:
 
@@ -52,8 +188,12 @@ class Analysis(QThread):
         Keyword arguments:
         lead -- a key in the stats that defines the item to sort by."""
         idxs = np.argsort(self.stats[lead])
-        for key in self.stats.keys():
-            self.stats[key] = [self.stats[key][i] for i in idxs]
+        for key, col in self.stats.select(idxs).items():
+            self.stats[key] = col
+
+    def select_ids(self, ids):
+        """Return a copy of the stats with only the rows whose File ID is in ids."""
+        return self.stats.select(self.stats.where_ids(ids))
         
     def process(self, data, *args, **kwargs):
         """React to a single instance of incoming data.
@@ -87,26 +227,28 @@ class Analysis(QThread):
         for key in self.stats.keys():
             index = np.where([k == key for k in head[2]])[0]
             if np.size(index): # if the key is in the header
-                self.stats[key] += list(map(self.types[key], data[:,index[0]]))
-            else: # keep lists the same size: fill with zeros.
-                self.stats[key] += list(map(self.types[key], [0]*n))
+                self.stats[key].extend(data[:,index[0]])
+            else: # keep columns the same size: fill with zeros.
+                self.stats[key].extend([0]*n)
         self.ind = np.size(self.stats[key]) # length of last array
         return head # success
 
-    def save(self, file_name, meta_head=[], meta_vals=[], *args, **kwargs):
+    def save(self, file_name, meta_head=[], meta_vals=[], stats=None, *args, **kwargs):
         """Save the processed data to csv. 
         First row is metadata column headings as list
         Second row is metadata values as list
         Third row is data column headings
         Then data follows.
+        stats -- a copy of the stats to save instead of the current ones.
         """
-        # data converted to the correct type
-        out_arr = np.array([list(map(self.types[key], val))
-                for key, val in self.stats.items()], dtype=str).T
+        if stats is None: stats = self.stats
+        # columns are already stored as the correct type
+        out_arr = np.array([np.asarray(val).astype(str)
+                for val in stats.values()]).T
 
         header = ','.join(meta_head) + '\n'
         header += ','.join(meta_vals) + '\n'
-        header += ','.join(list(self.stats.keys()))
+        header += ','.join(list(stats.keys()))
         
         try:
             np.savetxt(file_name, out_arr, fmt='%s', delimiter=',', header=header)
@@ -0,0 +1,262 @@
+"""Single Atom Image Analysis
+
+Process the images for the main analysis windows in worker processes
+ - each worker process owns an image_handler for each of the windows
+ assigned to it. The ROI integration and the histogram and threshold
+ updates for each image are done there instead of in the GUI process.
+ - the image_handler in each main_window is kept as a copy that is
+ filled in from the results, so the re-image and comparison windows,
+ fitting, and saving use it as before. The GUI only draws the histograms.
+ - a window is only ever handled by one worker, and each worker takes
+ its messages in order, so the results for a window arrive in the same
+ order as the images (i.e. ordered by File ID).
+ - when the data in a window is changed in the GUI (e.g. reset, or loaded
+ from files), the data is sent to the worker again and any results that
+ were computed before the change are ignored.
+ - sync() waits until the workers have finished every image that was sent,
+ so that the histograms are complete before they're fitted or saved.
+"""
+import sys
+import time
+import queue
+import multiprocessing as mp
+import numpy as np
+from PyQt5.QtCore import QObject, QTimer
+from analysis import Stats
+from imageHandler import image_handler
+if '.' not in sys.path: sys.path.append('.')
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info
+from networking.linkstats import get_link
+
+# image_handler attributes that are sent back with each result
+ATTRS = ['thresh', 'fidelity', 'err_fidelity', 'peak_indexes',
+    'peak_heights', 'peak_widths', 'peak_centre']
+# image_handler settings that are sent to the worker when they change
+CONFIG = ['xc', 'yc', 'roi_size', 'pic_width', 'pic_height', 'bias',
+    'thresh_every', 'shift_tol']
+
+def get_config(ih, fixed=False):
+    """Return the settings from image_handler ih that a worker needs.
+    If fixed, the threshold is set by the user so it's included too."""
+    cfg = {key: getattr(ih, key) for key in CONFIG}
+    cfg['bin_array'] = tuple(np.ravel(ih.bin_array))
+    if fixed: cfg['thresh'] = ih.thresh
+    return cfg
+
+def apply_result(ih, row, attrs, mode='thresh'):
+    """Add the row of stats from a worker to image_handler ih. In 'thresh'
+    mode, also take the threshold and peaks and fill in Atom detected."""
+    for key, val in row.items():
+        ih.stats[key].append(val)
+    ih.ind += 1
+    if mode == 'thresh':
+        for key, val in attrs.items():
+            setattr(ih, key, val)
+        ih.update_atoms()
+
+def worker(inq, outq):
+    """Take messages from inq in order and put the results on outq.
+    Runs in a worker process. The messages are tuples:
+    ('config', key, mask, cfg)  -- settings for the window's image_handler.
+        mask is None if it hasn't changed.
+    ('state', key, gen, cols)   -- replace the window's data with cols.
+    ('image', key, gen, im, fid, include, mode) -- process an image. im is
+        None to use the last image sent to this worker. mode is 'thresh' to
+        update the threshold, 'fixed' to keep it, or 'count' for no histogram.
+    ('remove', key)             -- forget the window.
+    ('sync', token)             -- reply once everything before it is done.
+    ('stop',)
+    Results are ('result', key, gen, mode, row, attrs, hist, time taken),
+    or ('error', message type, message)."""
+    handlers = {} # key: image_handler for each window
+    im = None
+    while True:
+        msg = inq.get()
+        kind = msg[0]
+        try:
+            if kind == 'stop': break
+            elif kind == 'sync': outq.put(msg)
+            elif kind == 'remove': handlers.pop(msg[1], None)
+            elif kind == 'config':
+                _, key, mask, cfg = msg
+                ih = handlers.setdefault(key, image_handler())
+                if mask is not None: ih.mask = mask
+                for k, val in cfg.items():
+                    setattr(ih, k, list(val) if k == 'bin_array' else val)
+            elif kind == 'state':
+                _, key, gen, cols = msg
+                ih = handlers.setdefault(key, image_handler())
+                ih.stats = Stats(ih.stats.types, cols.items())
+                ih.ind = len(ih.stats['Counts'])
+                ih.thresh_ind = -1 # estimate the threshold again
+            elif kind == 'image':
+                _, key, gen, new_im, fid, include, mode = msg
+                if new_im is not None: im = new_im
+                t0 = time.time()
+                ih = handlers[key]
+                ih.fid = fid
+                ih.process(im, include)
+                hist = None
+                if mode == 'thresh': hist = ih.hist_and_thresh()
+                elif mode == 'fixed': hist = ih.histogram()
+                row = {k: col[-1] for k, col in ih.stats.items() if k != 'Atom detected'}
+                outq.put(('result', key, gen, mode, row, 
+                    {k: getattr(ih, k) for k in ATTRS}, hist, time.time() - t0))
+        except Exception as e:
+            outq.put(('error', kind, 'Analysis worker failed on %s message: %s'%(kind, e)))
+
+####    ####    ####    ####
+
+class analysis_pool(QObject):
+    """Send the images for the main analysis windows to worker processes,
+    then fill in the windows' image_handlers and plot the histograms
+    with the results. A timer checks for results in the Qt event loop.
+    Keyword arguments:
+    n_workers -- the number of worker processes.
+    interval  -- time in ms between checking for results."""
+    def __init__(self, n_workers=2, interval=20):
+        super().__init__()
+        ctx = mp.get_context('spawn') # workers don't inherit the Qt app
+        self.outq = ctx.Queue()
+        self.inqs = [ctx.Queue() for i in range(n_workers)]
+        self.procs = [ctx.Process(target=worker, args=(q, self.outq), daemon=True)
+            for q in self.inqs]
+        for p in self.procs: p.start()
+        self.windows = {} # main_window: dict of what has been sent to the worker
+        self.keys = {}    # key: main_window
+        self.next_key = 0 # keys are never reused so results can't go to the wrong window
+        self.last_im = [None]*n_workers # count of the last image sent to each worker
+        self.im, self.im_count = None, 0 # the last image sent and how many there have been
+        self.pending = 0  # number of images waiting for results
+        self.token = 0    # ID for sync messages
+        self.stats = get_link('Analysis workers')
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(interval)
+
+    def assign(self, mws):
+        """Set the main_windows whose images are processed by the workers.
+        Windows are shared between the workers in turn."""
+        for mw in list(self.windows.keys()):
+            if mw not in mws: self.remove(mw)
+        for mw in mws:
+            if mw in self.windows: continue
+            loads = [0 if p is not None else np.inf for p in self.procs]
+            for w in self.windows.values(): loads[w['worker']] += 1
+            if min(loads) == np.inf: break # all the workers have stopped
+            self.windows[mw] = {'key':self.next_key, 'worker':loads.index(min(loads)),
+                'gen':0, 'mask':None, 'cfg':None, 'col':None, 'n':-1}
+            self.keys[self.next_key] = mw
+            self.next_key += 1
+            mw.pool = self
+
+    def remove(self, mw):
+        """Stop using the workers for main_window mw."""
+        w = self.windows.pop(mw, None)
+        if w is not None:
+            self.keys.pop(w['key'], None)
+            self.inqs[w['worker']].put(('remove', w['key']))
+        mw.pool = None
+
+    def submit(self, mw, im, include=True, mode='thresh'):
+        """Send an image for main_window mw to its worker. Data and settings
+        that have changed in the GUI since the last image are sent first.
+        Returns False if mw isn't assigned to a worker.
+        Keyword arguments:
+        mw      -- the main_window that received the image.
+        im      -- image array to be processed.
+        include -- whether to include the image in further analysis.
+        mode    -- 'thresh': update the histogram and threshold,
+                   'fixed': update the histogram but not the threshold,
+                   'count': don't update the histogram."""
+        w = self.windows.get(mw)
+        if w is None: return False
+        ih = mw.image_handler
+        q = self.inqs[w['worker']]
+        if ih.stats['Counts'] is not w['col'] or len(ih.stats['Counts']) != w['n']:
+            w['gen'] += 1 # data was changed in the GUI
+            w['col'], w['n'] = ih.stats['Counts'], len(ih.stats['Counts'])
+            q.put(('state', w['key'], w['gen'], {k: np.array(c) for k, c in ih.stats.items()}))
+        cfg = get_config(ih, mode == 'fixed')
+        if ih.mask is not w['mask'] or cfg != w['cfg']:
+            q.put(('config', w['key'], None if ih.mask is w['mask'] else ih.mask, cfg))
+            w['mask'], w['cfg'] = ih.mask, cfg
+        if im is not self.im: # the same image is sent once to each worker
+            self.im, self.im_count = im, self.im_count + 1
+            new_im = True
+        else: new_im = self.last_im[w['worker']] != self.im_count
+        self.last_im[w['worker']] = self.im_count
+        # copy, since the queue pickles it later and the camera reuses its arrays
+        q.put(('image', w['key'], w['gen'], np.array(im) if new_im else None,
+            ih.fid, include, mode))
+        self.pending += 1
+        self.stats.set_queue_depth(self.pending)
+        return True
+
+    def poll(self, timeout=0):
+        """Apply the results that have arrived, then plot the latest
+        histogram for each window. Returns the sync tokens received."""
+        plots, tokens = {}, []
+        end = time.time() + timeout
+        while True:
+            try:
+                msg = self.outq.get(timeout=end - time.time()) if timeout else self.outq.get_nowait()
+            except (queue.Empty, ValueError): break
+            if msg[0] == 'sync':
+                tokens.append(msg[1])
+                if len(tokens) == len(self.inqs): break
+            elif msg[0] == 'error':
+                if msg[1] == 'image': self.pending = max(self.pending - 1, 0)
+                error(msg[2])
+            elif msg[0] == 'result':
+                self.pending = max(self.pending - 1, 0)
+                _, key, gen, mode, row, attrs, hist, dt = msg
+                mw = self.keys.get(key)
+                if mw is None or gen != self.windows[mw]['gen']: continue # stale
+                apply_result(mw.image_handler, row, attrs, mode)
+                self.windows[mw]['n'] += 1
+                mw.int_time = dt
+                self.stats.record('process', dt)
+                if hist is not None: plots[mw] = hist
+        self.stats.set_queue_depth(self.pending)
+        for mw, hist in plots.items(): # only plot the latest histogram
+            mw.show_result(hist)
+        self.check_workers()
+        return tokens
+
+    def sync(self, timeout=10):
+        """Wait until the workers have sent back the results for all of
+        the images sent so far, so the image_handlers are up to date.
+        Returns False if the workers didn't finish within timeout (s)."""
+        self.token += 1
+        for q in self.inqs: q.put(('sync', self.token))
+        tokens, end = [], time.time() + timeout
+        while time.time() < end:
+            tokens += [t for t in self.poll(end - time.time()) if t == self.token]
+            if len(tokens) == len(self.inqs): return True
+        warning('Analysis workers did not finish within %s s, %s images still pending.'%(
+            timeout, self.pending))
+        return False
+
+    def check_workers(self):
+        """If a worker process has stopped, process its windows in the GUI again."""
+        for i, p in enumerate(self.procs):
+            if p is not None and not p.is_alive():
+                warning('Analysis worker %s stopped (exit code %s). Its windows '%(i, p.exitcode) +
+                    'will process images in the GUI. Results that were pending are lost.')
+                self.procs[i] = None
+                for mw, w in list(self.windows.items()):
+                    if w['worker'] == i: self.remove(mw)
+
+    def close(self):
+        """Stop the worker processes."""
+        self.timer.stop()
+        for mw in list(self.windows.keys()): self.remove(mw)
+        for q, p in zip(self.inqs, self.procs):
+            if p is not None: q.put(('stop',))
+        for p in self.procs:
+            if p is not None:
+                p.join(2)
+                if p.is_alive(): p.terminate()
+        self.procs = [None]*len(self.inqs)
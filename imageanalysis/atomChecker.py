@@ -17,12 +17,15 @@ from PyQt5.QtCore import pyqtSignal, QTimer
 from PyQt5.QtGui import QIcon, QFont
 from PyQt5.QtWidgets import (QMenu, QFileDialog, QMessageBox, QLineEdit, 
         QGridLayout, QWidget, QApplication, QPushButton, QAction, QMainWindow, 
-        QLabel)
+        QLabel, QInputDialog)
 if '.' not in sys.path: sys.path.append('.')
 if '..' not in sys.path: sys.path.append('..')
 from strtypes import intstrlist, listlist, error, warning, info
 from maingui import reset_slot, int_validator, double_validator # single atom image analysis
 from roiHandler import ROI, roi_handler
+from saveimages.imformat import iter_images
+from renderScheduler import get_scheduler, downsample
+from pixelStats import pixel_stats
 
 ####    ####    ####    ####
 
@@ -47,6 +50,7 @@ class atom_window(QMainWindow):
         self.setObjectName(name)
         self.last_im_path = last_im_path
         self.rh = roi_handler(rois, image_shape)
+        self.pixel_stats = pixel_stats(image_shape) # running average of the live images
         self.init_UI(num_plots) # adjust widgets from main_window
         self.event_im.connect(self.rh.process)
         self.event_im.connect(self.update_plots)
@@ -77,6 +81,23 @@ class atom_window(QMainWindow):
         make_im.triggered.connect(self.make_ave_im)
         file_menu.addAction(make_im)
 
+        # keep per-pixel stats of the images as they arrive
+        live_menu = QMenu('Live average image', self)
+        self.live_toggle = QAction('Accumulate images', self, checkable=True)
+        self.live_toggle.triggered[bool].connect(self.set_accumulate)
+        live_menu.addAction(self.live_toggle)
+        for label in ['Show mean image', 'Show variance image', 'Show atom probability image']:
+            action = QAction(label, self)
+            action.triggered.connect(self.show_pixel_stats)
+            live_menu.addAction(action)
+        for label, func in [('Set decay', self.set_decay), ('Set pixel threshold', self.set_pixel_thresh),
+                ('Reset', self.reset_pixel_stats), ('Save', self.save_pixel_stats),
+                ('Load', self.load_pixel_stats)]:
+            action = QAction(label, self)
+            action.triggered.connect(func)
+            live_menu.addAction(action)
+        file_menu.addMenu(live_menu)
+
         save_hist = QAction('Save Histograms', self)
         save_hist.triggered.connect(self.save_roi_hists)
         file_menu.addAction(save_hist)
@@ -193,7 +214,27 @@ class atom_window(QMainWindow):
 
     def set_im_show(self, toggle):
         """If the toggle is True, always update the display with the last image."""
-        reset_slot(self.event_im, self.update_im, toggle)
+        reset_slot(self.event_im, self.schedule_im, toggle)
+
+    def set_accumulate(self, toggle):
+        """If the toggle is True, add each image to the per-pixel stats."""
+        reset_slot(self.event_im, self.pixel_stats.add, toggle)
+
+    def set_decay(self):
+        """Ask the user for the fraction of the weight of the previous images
+        that is lost with each new image in the live average."""
+        decay, ok = QInputDialog.getDouble(self, 'Live average image', 
+            'Decay per image (0 to weight all images equally): ', 
+            self.pixel_stats.decay, 0, 1, 4)
+        if ok: self.pixel_stats.set_decay(decay)
+
+    def set_pixel_thresh(self):
+        """Ask the user for the count above the bias that a pixel has to
+        exceed to be counted in the atom probability image."""
+        t = self.pixel_stats.thresh - self.rh.bias if self.pixel_stats.thresh is not None else 0
+        t, ok = QInputDialog.getDouble(self, 'Live average image', 
+            'Pixel threshold (counts above bias): ', t, -1e9, 1e9, 1)
+        if ok: self.pixel_stats.set_thresh(t + self.rh.bias)
 
     def change_timeout(self, newval):
         """Time in seconds to wait before sending the trigger to continue the 
@@ -258,8 +299,10 @@ class atom_window(QMainWindow):
                             pos[0], pos[1], self.rh.shape[0], (shape[0], shape[1]))
                         + 'Calculated width - %s, height - %s.\n'%(X, Y) + str(e))
         elif method == '2D Gaussian masks':
-            try: 
-                im = self.im_canvas.image.copy() - self.rh.bias
+            try: # use the live average image if it's being accumulated
+                if self.live_toggle.isChecked() and self.pixel_stats.n:
+                    im = self.pixel_stats.mean() - self.rh.bias
+                else: im = self.im_canvas.image.copy() - self.rh.bias
                 if np.size(np.shape(im)) == 2:
                     for r in self.rh.ROIs:
                         r.create_gauss_mask(im) # fit 2D Gaussian to max pixel region
@@ -283,7 +326,7 @@ class atom_window(QMainWindow):
                     item not in [r.roi for r in self.rh.ROIs] + [r.label for r in self.rh.ROIs]):
                 viewbox.removeItem(item)
         layout = self.centre_widget.layout()
-        k = np.sqrt(len(self.plots))
+        k = int(np.sqrt(len(self.plots)))
         for i, r in enumerate(self.rh.ROIs):
             if r.roi not in viewbox.allChildren():
                 reset_slot(r.roi.sigRegionChangeFinished, self.user_roi, True) 
@@ -298,11 +341,19 @@ class atom_window(QMainWindow):
                 except IndexError as e: pass # warning('Atom Checker has more plots than ROIs')
     
     def update_plots(self, im=0, include=1):
-        """Plot the history of counts in each ROI in the associated plots"""
+        """Update the thresholds of the ROIs, then mark the plots of the 
+        counts to be redrawn by the render scheduler."""
+        for r in self.rh.ROIs:
+            if r.autothresh.isChecked(): r.thresh() # update threshold
+        get_scheduler().mark((self, 'plots'), self.draw_plots, self)
+
+    def draw_plots(self):
+        """Plot the history of counts in each ROI in the associated plots.
+        The history is in time order and downsampled if it's long."""
         for i, r in enumerate(self.rh.ROIs):
             try:
-                self.plots[i]['counts'].setData(r.c[:r.i]) # history of counts
-                if r.autothresh.isChecked(): r.thresh() # update threshold
+                c = np.roll(r.c, -(r.i % r.c.size)) if r.i > r.c.size else r.c[:r.i]
+                self.plots[i]['counts'].setData(*downsample(c)) # history of counts
                 self.plots[i]['thresh'].setValue(r.t) # plot threshold
                 self.plots[i]['plot'].setTitle('ROI %s, LP=%.3g'%(r.id, r.LP()))
             except IndexError: pass
@@ -320,6 +371,10 @@ class atom_window(QMainWindow):
         """Display the image in the image canvas."""
         self.im_canvas.setImage(im)
 
+    def schedule_im(self, im):
+        """Mark the image canvas to be redrawn with the latest image."""
+        get_scheduler().mark((self, 'im'), lambda: self.update_im(im), self)
+
     def show_ROI_masks(self, toggle=True):
         """Make an image out of all of the masks from the ROIs and display it."""
         im = np.zeros(self.rh.shape)
@@ -351,27 +406,28 @@ class atom_window(QMainWindow):
             return file_name
         except OSError: return '' # probably user cancelled
 
-    def load_from_files(self, trigger=None):
+    def load_from_files(self, trigger=None, acc=None):
         """Prompt the user to select image files to process using the file
         browser.
         Keyword arguments:
             trigger:        Boolean passed from the QObject that triggers
-                            this function."""
+                            this function.
+            acc:            add the images to this pixel_stats instead of 
+                            returning them."""
         im_list = []
         file_list = self.try_browse(title='Select Files', 
-                file_type='Images(*.asc);;all (*)', 
+                file_type='Images(*.asc *.pdx);;all (*)', 
                 open_func=QFileDialog.getOpenFileNames)
-        for file_name in file_list:
-            try:
-                im_vals = self.rh.load_full_im(file_name)
-                im_list.append(im_vals)
-            except Exception as e: # probably file size was wrong
-                warning("Failed to load image file: "+file_name+'\n'+str(e)) 
+        for file_name, im_vals in iter_images(file_list, self.rh.load_full_im):
+            if isinstance(im_vals, Exception): # probably file size was wrong
+                warning("Failed to load image file: "+file_name+'\n'+str(im_vals)) 
+            elif acc is not None: acc.add(im_vals)
+            else: im_list.append(im_vals)
         return im_list
 
     def load_image(self, trigger=None):
         """Prompt the user to select an image file to display"""
-        file_name = self.try_browse(file_type='Images (*.asc);;all (*)')
+        file_name = self.try_browse(file_type='Images (*.asc *.pdx);;all (*)')
         if file_name:  # avoid crash if the user cancelled
             self.last_im_path = file_name
             self.rh.set_pic_size(file_name) # get image size
@@ -380,16 +436,43 @@ class atom_window(QMainWindow):
         
     def make_ave_im(self):
         """Make an average image from the files selected by the user and 
-        display it."""
-        im_list = self.load_from_files()
-        if len(im_list):
-            aveim = np.zeros(np.shape(im_list[0]))
-        else: return 0 # no images selected
-        for im in im_list:
-            aveim += im
-        self.update_im(aveim / len(im_list))
+        display it. The images are added to the average as they're loaded."""
+        ps = pixel_stats()
+        self.load_from_files(acc=ps)
+        if not ps.n: return 0 # no images selected
+        self.update_im(ps.mean())
         return 1
 
+    def show_pixel_stats(self, toggle=True, stat=''):
+        """Display the mean, variance, or atom probability image of the
+        images that have been accumulated."""
+        stat = stat if stat else self.sender().text()
+        if 'mean' in stat: im = self.pixel_stats.mean()
+        elif 'variance' in stat: im = self.pixel_stats.var()
+        else: im = self.pixel_stats.prob()
+        if im is None:
+            warning('Atom checker: not enough images accumulated for the '+stat.lower()+
+                ('. Set the pixel threshold first.' if 'probability' in stat else ''))
+        else: self.update_im(im)
+
+    def reset_pixel_stats(self):
+        """Clear the live average image."""
+        self.pixel_stats.reset(self.pixel_stats.shape)
+
+    def save_pixel_stats(self, file_name=''):
+        """Save the live average image maps to a .npz file."""
+        if not file_name:
+            file_name = self.try_browse(title='Save File', file_type='npz(*.npz);;all (*)', 
+                open_func=QFileDialog.getSaveFileName)
+        if file_name: self.pixel_stats.save(file_name)
+
+    def load_pixel_stats(self, file_name=''):
+        """Load the live average image maps from a .npz file and display the mean."""
+        if not file_name:
+            file_name = self.try_browse(file_type='npz(*.npz);;all (*)')
+        if file_name and self.pixel_stats.load(file_name):
+            self.update_im(self.pixel_stats.mean())
+
     def save_roi_hists(self, file_name='AtomCheckerHist.csv'):
         """Save the histogram data from the ROIs"""
         if not file_name:
@@ -2,11 +2,14 @@
 Stefan Spence 23/03/21
 
 a class to compare histograms
+ - the occupancy of every ROI is kept in an occupancy_table indexed by 
+ File ID, so the conditions are bitwise operations on the table.
 
 """
 import numpy as np
 from collections import OrderedDict
-from analysis import Analysis, BOOL
+from analysis import Analysis, Stats, BOOL
+from occupancyTable import occupancy_table, popcount
 from astropy.stats import binom_conf_interval
 
 class comp_handler(Analysis):
@@ -40,13 +43,14 @@ class comp_handler(Analysis):
         ('Condition met', float),
         ('Error in Condition met', float),
         ('Include', BOOL)])
-        self.stats = OrderedDict([(key, []) for key in self.types.keys()])
+        self.stats = Stats(self.types)
         # variables that won't be saved for plotting:
         self.temp_vals = OrderedDict([(key,0) for key in self.stats.keys()])
 
         self.hist_ids = OrderedDict([('%s survival'%x.name, []) for x in afters] + 
             [('%s atom'%i, []) for i in range(nhists+1)] + 
             [('Condition met', [])]) # file IDs to recreate histograms
+        self.occ = occupancy_table(befores + afters) # which ROIs have atoms in each image
         self.xvals = [] # variables to plot on the x axis
         self.yvals = [] # variables to plot on the y axis
 
@@ -68,60 +72,49 @@ class comp_handler(Analysis):
         natoms: include files where natoms were loaded (instead of fixed condition)
         include: whether to include the values in further analysis.
         """
-        try: 
-            s = self.befores[0].stats['File ID']
-            ids = np.arange(min(s), max(s)+1) # list of all file IDs (hopefully)
-            loading = np.empty((self.nhists, len(ids)))
-        except (IndexError, ValueError): return 0
+        self.occ.set_handlers(self.befores + self.afters)
+        for s in self.befores + self.afters:
+            s.update_atoms() # recalculate atom detected if the threshold changed
+        self.occ.update()
+        span = self.occ.span(0) # all file IDs in the first histogram (hopefully)
+        if span is None: return 0
+        ids = self.occ.ids(span)
+        nb = len(self.befores)
         
         if natoms >= 0: # don't mind which ROIs the atoms are in
             c0 = [1]*self.nhists
         else: c0 = self.c0 # a specific condition
             
-        for i, s in enumerate(self.befores): # find the file IDs that have atoms in all before histograms
-            name = s.name
-            s.stats['Atom detected'] = [x // s.thresh for x in s.stats['Counts']] # recalculate atom detected
-            s = s.stats
-            t = int(c0[i])
-            # if i == 0:
-            #     ids = set(np.array(s['File ID'])[np.where(np.array(s['Atom detected']) > 0, t, not t)])
-            # else: 
-            #     ids = ids & set(np.array(s['File ID'])[np.where(np.array(s['Atom detected']) > 0, t, not t)])
-            self.temp_vals['Loading probability %s'%name] = (np.array(s['Atom detected']) > 0).sum() / len(s['Atom detected'])
-            beforeids = np.array(s['File ID'])[np.where(np.array(s['Atom detected']) > 0, t, not t).astype(bool)]
-            loading[i] = np.isin(ids, beforeids).astype(int)
-
-        loading = loading.sum(axis=0) # number of atoms in each image
+        for i, s in enumerate(self.befores): 
+            self.temp_vals['Loading probability %s'%s.name] = self.occ.natoms[i] / self.occ.done[i]
+        # number of before histograms that meet their condition in each image
+        loading = popcount(self.occ.matches(range(nb), [bool(int(c)) for c in c0[:nb]], span))
         if natoms >= 0: # files containing natoms
-            ids = ids[loading==natoms]
+            keep = loading==natoms
         else: # files satisfying all the conditions
-            ids = ids[loading==np.max(loading)]
+            keep = loading==np.max(loading)
+        ids = ids[keep]
+        rows = np.arange(span.start, span.stop)[keep]
         
         self.temp_vals['Number of images processed'] = len(ids)
-        survive = np.empty((self.nhists, len(ids)), dtype=bool)
-        condition = set(ids)
-
-        for i, s in enumerate(self.afters): 
-            name = s.name
-            s.stats['Atom detected'] = [x // s.thresh for x in s.stats['Counts']] # recalculate atom detected
-            s = s.stats
-            afterids = np.array(s['File ID'])[np.array(s['Atom detected']) > 0]
-            survive[i] = np.isin(ids, afterids)
-            sp, _, _, err = self.conf(survive[i].sum(), len(ids))
-            self.temp_vals['Survival probability %s'%name] = sp
-            self.temp_vals['Error in Survival probability %s'%name] = err
-            if not self.c1[i]: afterids = np.array(s['File ID'])[np.array(s['Atom detected']) <= 0]
-            condition = condition & set(ids[np.isin(ids, afterids)])
-
-        for i, x in enumerate(survive):
-            self.hist_ids['%s survival'%self.afters[i].name] = ids[x]
+        ainds = range(nb, nb + len(self.afters))
+        survive = self.occ.atoms[rows] # after histograms with an atom in each image
+        for i, s in zip(ainds, self.afters): 
+            w, b = self.occ.bit(i)
+            x = (survive[:, w] & b) > 0
+            sp, _, _, err = self.conf(x.sum(), len(ids))
+            self.temp_vals['Survival probability %s'%s.name] = sp
+            self.temp_vals['Error in Survival probability %s'%s.name] = err
+            self.hist_ids['%s survival'%s.name] = ids[x]
+        m, _ = self.occ.masks(ainds)
+        condition = popcount(self.occ.matches(ainds, [bool(c) for c in self.c1[:len(ainds)]], rows)) == len(ainds)
             
         try:
-            sp, _, _, err = self.conf(len(condition), len(ids))
+            sp, _, _, err = self.conf(condition.sum(), len(ids))
             self.temp_vals['Condition met'] = sp
             self.temp_vals['Error in Condition met'] = err
-            self.hist_ids['Condition met'] = np.array(list(condition))
-            numatoms = survive.sum(axis=0)
+            self.hist_ids['Condition met'] = ids[condition]
+            numatoms = popcount(survive & m)
             for i in range(self.nhists+1):
                 self.hist_ids['%s atom'%i] = ids[numatoms == i]
                 sp, _, _, err = self.conf(len(self.hist_ids['%s atom'%i]), len(numatoms))
@@ -17,6 +17,7 @@ from PyQt5.QtGui import QFont, QIntValidator
 from PyQt5.QtWidgets import (QLabel, QMessageBox, QPushButton,
         QCheckBox, QComboBox, QLineEdit, QAction, QFileDialog)
 from maingui import main_window, reset_slot
+from renderScheduler import get_scheduler # limit the rate of redrawing plots
 from compHandler import comp_handler
 
 # main GUI window contains all the widgets                
@@ -218,9 +219,9 @@ class compim_window(main_window):
             hist_type = self.hist_type.currentText()
             if 'Survival' in hist_type:
                 hist_type = names[ind] + ' survival'
-            incl = np.isin(self.histo_handler.afters[ind].stats['File ID'], self.histo_handler.hist_ids[hist_type])
+            after = self.histo_handler.afters[ind].select_ids(self.histo_handler.hist_ids[hist_type])
             for key in self.image_handler.stats.keys():
-                self.image_handler.stats[key] = list(np.array(self.histo_handler.afters[ind].stats[key])[incl])
+                self.image_handler.stats[key] = after[key]
             self.image_handler.ind = self.histo_handler.afters[ind].ind
             self.image_handler.thresh = self.histo_handler.afters[ind].thresh
             t2 = time.time()
@@ -246,13 +247,17 @@ class compim_window(main_window):
     
     def update_plot(self, im, include=True):
         """Same as update_plot_only."""
-        t2 = self.get_histogram()
-        self.plot_current_hist(self.image_handler.histogram, self.hist_canvas) # update the displayed plot
-        self.plot_time = time.time() - t2
+        self.get_histogram()
+        get_scheduler().mark((self, 'hist'), self.draw_hist, self)
 
     def update_plot_only(self, im, include=True):
         """Show the histogram on the canvas."""
-        t2 = self.get_histogram()
+        self.get_histogram()
+        get_scheduler().mark((self, 'hist'), self.draw_hist, self)
+
+    def draw_hist(self):
+        """Plot the histogram. Called by the render scheduler."""
+        t2 = time.time()
         self.plot_current_hist(self.image_handler.histogram, self.hist_canvas) # update the displayed plot
         self.plot_time = time.time() - t2
 
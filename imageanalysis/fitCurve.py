@@ -92,4 +92,15 @@ class fit:
                                 maxfev=80000, **kwargs)
         self.ps = popt
         self.perrs = np.sqrt(np.diag(pcov))
-        self.rchisq = chisquare(self.y, fn(self.x, *self.ps))[0] / (np.size(self.y) - np.size(self.ps))
\ No newline at end of file
+        self.rchisq = chisquare(self.y, fn(self.x, *self.ps))[0] / (np.size(self.y) - np.size(self.ps))
+
+    def setFit(self, fn, ps, perrs=None):
+        """Store best fit parameters that were found some other way (e.g. 
+        with mixtureFit) and get the reduced chi-squared for fn on the data."""
+        self.bffunc = fn
+        self.ps = ps
+        self.perrs = perrs
+        yfit = fn(self.x, *ps)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chisq = np.sum(np.where(yfit > 0, (self.y - yfit)**2 / yfit, 0))
+        self.rchisq = chisq / max(np.size(self.y) - np.size(ps), 1)
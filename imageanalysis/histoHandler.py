@@ -7,8 +7,9 @@ a class to collect and calculate histogram statistics
 import numpy as np
 from collections import OrderedDict
 from astropy.stats import binom_conf_interval
-from analysis import Analysis, BOOL
+from analysis import Analysis, Stats, BOOL
 import fitCurve as fc
+from mixtureFit import mixture
 
 class histo_handler(Analysis):
     """Manage statistics from several histograms.
@@ -53,7 +54,7 @@ class histo_handler(Analysis):
         ('Error in S/N', float),
         ('Threshold', float),
         ('Include', BOOL)])
-        self.stats = OrderedDict([(key, []) for key in self.types.keys()])
+        self.stats = Stats(self.types)
         # variables that won't be saved for plotting:
         self.temp_vals = OrderedDict([(key,0) for key in self.stats.keys()])
 
@@ -64,6 +65,8 @@ class histo_handler(Analysis):
         self.emg = 1.0  # EM gain applied by EMCCD
         self.dg  = 2.0 if self.emg > 1 else 1.0 # multiplicative noise factor
         self.bf = None
+        # mixture fits keep their last parameters to start the next fit from
+        self.mix = {'double gaussian':mixture('gauss'), 'double poissonian':mixture('poisson')}
         
     def process(self, ih, user_var, fix_thresh=False, method='quick', include=True):
         """Calculate the statistics from the current histogram.
@@ -72,9 +75,9 @@ class histo_handler(Analysis):
         user_var: the user variable associated with this calculation
         fix_thresh: True - keep old threshold value, False - update the threshold value
         method: 'quick' - image_handler uses a peak finding algorithm 
-                'double gaussian' - fit a double Guassian function
+                'double gaussian' - fit a double Guassian function to the counts
                 'separate gaussians' - split the histogram at the threshold and fit Gaussians
-                'double poissonian' - fit a double Poissonian function
+                'double poissonian' - fit a double Poissonian function to the counts
                 'single gaussian' - fit a single Gaussian to background peak
         include: whether to include the values in further analysis.
         """
@@ -96,21 +99,18 @@ class histo_handler(Analysis):
                 mu0, mu1 = ih.peak_centre
                 sig0, sig1 = ih.peak_widths
             elif method == 'double gaussian':
-                # parameters: Total num images, loading prob, centre, s.d., centre, s.d.
-                self.bf.p0 = [ih.ind, 0.6, ih.peak_centre[0], ih.peak_widths[0],
-                        ih.peak_centre[1], ih.peak_widths[1]]
-                try:
-                    if fix_thresh: # bound the lower peak to below threshold
-                        self.bf.getBestFit(self.bf.double_gauss, bounds=(
-                            np.array([0, 0, 0, 0, ih.thresh, 0]),
-                            np.array([np.inf, 1, ih.thresh, np.inf, np.inf, np.inf]))) 
-                    else: # get unbounded best fit parameters
-                        self.bf.getBestFit(self.bf.double_gauss)
-                except: return 0  # fit failed, do nothing
-                if self.bf.ps[1] < self.bf.ps[4]:
-                    N, A1, mu0, sig0, mu1, sig1 = self.bf.ps
-                else: N, A1, mu1, sig1, mu0, sig0 = self.bf.ps
-                A0, A1 = N*(1-A1), N*A1
+                # fit to the counts, starting from the peak estimates or the last fit
+                counts = np.asarray(ih.stats['Counts'])
+                mf = self.mix[method]
+                # parameters: loading prob, centre, s.d., centre, s.d.
+                start = [np.clip(np.mean(counts > thresh), 0.01, 0.99), ih.peak_centre[0], 
+                        max(ih.peak_widths[0], 1), ih.peak_centre[1], max(ih.peak_widths[1], 1)]
+                if mf.fit(counts, [start], thresh=ih.thresh if fix_thresh else None) is None:
+                    return 0  # fit failed, do nothing
+                w, mu0, sig0, mu1, sig1 = mf.ps
+                A0, A1 = mf.heights(np.size(counts), bin_mid*2)
+                self.bf.p0 = start
+                self.bf.setFit(self.bf.double_gauss, [A0+A1, A1/(A0+A1), mu0, sig0, mu1, sig1])
             elif method == 'separate gaussians': # separate Gaussian fit for bg/signal
                 diff = abs(bins - thresh)   # minimum is at the threshold
                 thresh_i = np.argmin(diff)  # index of the threshold
@@ -129,13 +129,17 @@ class histo_handler(Analysis):
                 self.bf.bffunc = self.bf.double_gauss # plot as double gaussian for consistency
 
             elif method == 'double poissonian':
-                self.bf.p0 = [ih.peak_heights[0], ih.peak_centre[0],
-                        ih.peak_heights[1], ih.peak_centre[1]]
-                try:
-                    # parameters are: mean, amplitude
-                    self.bf.getBestFit(self.bf.double_poisson) 
-                except: return 0  
-                A0, mu0, A1, mu1 = self.bf.ps
+                counts = np.asarray(ih.stats['Counts'])
+                mf = self.mix[method]
+                # parameters: loading prob, mean, mean
+                start = [np.clip(np.mean(counts > thresh), 0.01, 0.99), max(ih.peak_centre[0], 1), 
+                        max(ih.peak_centre[1], 2)]
+                if mf.fit(counts, [start]) is None: return 0
+                w, mu0, mu1 = mf.ps
+                A0, A1 = mf.heights(np.size(counts), bin_mid*2)
+                self.bf.p0 = start
+                # parameters are: mean, amplitude
+                self.bf.setFit(self.bf.double_poisson, [mu0, A0, mu1, A1])
                 sig0, sig1 = np.sqrt(mu0), np.sqrt(mu1)
 
             elif method == 'single gaussian':
@@ -162,14 +166,13 @@ class histo_handler(Analysis):
                 ih.hist_and_thresh()
 
             # update atom statistics
-            ih.stats['Atom detected'] = [count // ih.thresh for count in ih.stats['Counts']]
-
-            above_idxs = np.where(np.array(ih.stats['Atom detected']) > 0)[0] # index of images with counts above threshold
-            atom_count = np.size(above_idxs)  # number of images with counts above threshold
-            above = np.array(ih.stats['Counts'])[above_idxs] # counts above threshold
-            below_idxs = np.where(np.array(ih.stats['Atom detected']) <= 0)[0] # index of images with counts below threshold
-            empty_count = np.size(below_idxs) # number of images with counts below threshold
-            below = np.array(ih.stats['Counts'])[below_idxs] # counts below threshold
+            counts = np.asarray(ih.stats['Counts'])
+            ih.stats['Atom detected'] = counts // ih.thresh
+            atom = np.asarray(ih.stats['Atom detected']) > 0
+            above = counts[atom] # counts above threshold
+            atom_count = np.size(above)  # number of images with counts above threshold
+            below = counts[~atom] # counts below threshold
+            empty_count = np.size(below) # number of images with counts below threshold
             # use the binomial distribution to get 1 sigma confidence intervals:
             conf = binom_conf_interval(atom_count, atom_count + empty_count, interval='jeffreys')
             loading_prob = atom_count/ih.ind # fraction of images above threshold
@@ -178,8 +181,8 @@ class histo_handler(Analysis):
 
             # store the calculated histogram statistics as temp
             self.temp_vals['File ID'] = int(self.ind)
-            self.temp_vals['Start file #'] = min(ih.stats['File ID'])
-            self.temp_vals['End file #'] = max(ih.stats['File ID'])
+            self.temp_vals['Start file #'] = int(np.min(ih.stats['File ID']))
+            self.temp_vals['End file #'] = int(np.max(ih.stats['File ID']))
             self.temp_vals['ROI xc ; yc ; size'] = ' ; '.join(list(map(str, [ih.xc, ih.yc, ih.roi_size])))
             self.temp_vals['User variable'] = self.types['User variable'](user_var) if user_var else 0.0
             self.temp_vals['Number of images processed'] = ih.ind
@@ -3,10 +3,12 @@ Stefan Spence 14/03/19
 
 Separate out the imageHandler class for processing single atom images from the
 director watcher and Qt GUI. This allows it to be imported for other purposes.
-Assuming that image files are ASCII and the first column is the row number.
+Image files are either ASCII, where the first column is the row number, or
+the binary format from saveimages.imformat.
 """
 import os
 import sys
+import copy
 import numpy as np
 from collections import OrderedDict
 import time
@@ -14,10 +16,11 @@ from scipy.signal import find_peaks
 from scipy.stats import norm
 from skimage.filters import threshold_minimum
 from astropy.stats import binom_conf_interval
-from analysis import Analysis, BOOL
+from analysis import Analysis, Stats, BOOL
 if '.' not in sys.path: sys.path.append('.')
 if '..' not in sys.path: sys.path.append('..')
 from strtypes import error, warning, info
+from saveimages.imformat import load_image, image_shape
 
 def est_param(h):
     """Generator function to estimate the parameters for a Guassian fit. 
@@ -35,6 +38,95 @@ def est_param(h):
 
     return peak_inds, properties['prominences'], properties['widths']
 
+_frame = [None, None] # the last image array and its totals
+
+def frame_totals(im):
+    """Return the number of pixels, sum, sum of squares, and (x, y) position
+    of the max pixel for an image. The result for the last image is cached
+    so that when the same array is sent to several analysers it's only
+    scanned once. Assumes that the array isn't changed in place."""
+    if _frame[0] is not im:
+        flat = np.asarray(im, dtype=float).ravel()
+        _frame[:] = [im, (flat.size, np.sum(flat), np.dot(flat, flat),
+            np.unravel_index(np.argmax(im), np.shape(im)))]
+    return _frame[1]
+
+class RunningHistogram:
+    """Keep the histogram of a growing column of counts up to date by only
+    binning the values added since the last update. If the bin edges 
+    change (e.g. the range grows) all of the values are binned again.
+    Also keep running sums for the values below and above a threshold,
+    so that the mean and standard deviation of each peak is updated
+    without splitting all of the counts again."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self, col=None):
+        self.col   = col     # the column of counts being followed
+        self.n     = 0       # number of values included in the min and max
+        self.min   = np.inf
+        self.max   = -np.inf
+        self.edges = None    # bin edges for the occupancy
+        self.occ   = None    # occupancy of the bins
+        self.nbin  = 0       # number of values that have been binned
+        self.thresh = None   # threshold for the running sums
+        self.sums  = np.zeros((2,3)) # n, sum, sum of squares of (value - thresh) below, above
+        self.nsum  = 0       # number of values included in the sums
+
+    def update(self, col):
+        """Update the running min and max with the new values in col.
+        Returns True if col was replaced, so that everything starts again."""
+        vals = np.asarray(col)
+        restart = col is not self.col or len(vals) < self.n
+        if restart: self.reset(col)
+        if len(vals) > self.n:
+            self.min = min(self.min, np.min(vals[self.n:]))
+            self.max = max(self.max, np.max(vals[self.n:]))
+            self.n = len(vals)
+        return restart
+
+    def bin(self, edges):
+        """Return the occupancy of the bins with the given edges. Returns
+        the occupancy and True if the values were binned again."""
+        vals = np.asarray(self.col)
+        edges = np.asarray(edges, dtype=float)
+        rebin = self.edges is None or np.shape(edges) != np.shape(self.edges
+            ) or np.any(edges != self.edges)
+        if rebin:
+            self.edges = edges
+            self.occ = np.histogram(vals, edges)[0]
+        elif len(vals) > self.nbin:
+            self.occ += np.histogram(vals[self.nbin:], edges)[0]
+        self.nbin = len(vals)
+        return self.occ.copy(), rebin
+
+    def copy(self):
+        """Return a copy that follows the same column but can be updated
+        separately."""
+        h = copy.copy(self)
+        h.occ = None if self.occ is None else self.occ.copy()
+        h.sums = self.sums.copy()
+        return h
+
+    def split(self, thresh):
+        """Return (number, mean, standard deviation) for the values below 
+        and above thresh. Values equal to thresh aren't in either."""
+        vals = np.asarray(self.col)
+        if thresh != self.thresh or len(vals) < self.nsum:
+            self.thresh, self.nsum = thresh, 0
+            self.sums[:] = 0
+        if len(vals) > self.nsum:
+            x = vals[self.nsum:] - thresh
+            for i, v in enumerate([x[x < 0], x[x > 0]]):
+                self.sums[i] += [np.size(v), np.sum(v), np.dot(v, v)]
+            self.nsum = len(vals)
+        pops = []
+        for n, s1, s2 in self.sums:
+            mean = thresh + s1/n if n else 0
+            sd = np.sqrt(max(s2 - s1*s1/n, 0) / (n - 1)) if n > 1 else 0
+            pops.append((int(n), mean, sd))
+        return pops
+
 ####    ####    ####    ####
         
 # convert an image into its pixel counts to put into a histogram
@@ -56,7 +148,7 @@ class image_handler(Analysis):
             ('Mean bg count', float), # mean counts outside ROI - estimate bg
             ('Bg s.d.', float),# standard deviation outside of ROI
             ('Include', BOOL)])# whether to include in further analysis
-        self.stats = OrderedDict([(key, []) for key in self.types.keys()]) # standard deviation of counts outside ROI
+        self.stats = Stats(self.types)
         
         self.delim = ' '                # delimieter to use when opening image files
         self.bias = 697                 # bias offset from EMCCD
@@ -66,7 +158,7 @@ class image_handler(Analysis):
         self.peak_centre  = [0,0]       # peak position in counts in histogram
         self.fidelity     = 0           # fidelity of detecting atom presence
         self.err_fidelity = 0           # error in fidelity
-        self.mask      = np.zeros((1,1))# normalised mask to apply to image for ROI
+        self.mask      = np.zeros((1,1))# normalised mask to apply to image for ROI. Also sets box
         self.xc        = 1              # ROI centre x position 
         self.yc        = 1              # ROI centre y position
         self.roi_size  = 1              # ROI length in pixels. default 1 takes top left pixel
@@ -77,14 +169,78 @@ class image_handler(Analysis):
         self.ind       = 0              # number of images processed
         self.im_vals   = np.array([])   # the data from the last image is accessible to an image_handler instance
         self.bin_array = []             # if bins for the histogram are supplied, plotting can be faster
+        self.hist      = RunningHistogram() # histogram and peak statistics updated with each image
+        self.thresh_every = 20          # re-estimate the threshold at least every N images
+        self.shift_tol = 0.2            # or when a peak moves by this fraction of its width
+        self.thresh_ind = -1            # number of images when the threshold was last estimated
+        self.thresh_pops = None         # peak statistics when the threshold was last estimated
+        self.thresh_est = None          # the threshold from the last estimate
+        self.hist_changed = True        # whether the histogram was rebinned in the last update
+        self.atom_thresh = None         # threshold used for the Atom detected column
+        self.atom_col  = None           # the Atom detected column that was filled in
+        self.fid_params = None          # threshold and peaks used to calculate the fidelity
     
+    @property
+    def mask(self):
+        return self._mask
+
+    @mask.setter
+    def mask(self, mask):
+        """Store the mask along with the slices for its bounding box, so 
+        that the ROI can be integrated without using the whole image."""
+        self._mask = mask
+        xs, ys = np.nonzero(mask)
+        if np.size(xs):
+            self.box = (slice(xs.min(), xs.max()+1), slice(ys.min(), ys.max()+1))
+        else: self.box = (slice(0,0), slice(0,0))
+        self.box_mask = mask[self.box]
+        self.mask_sum = np.sum(self.box_mask)
+
+    def detach(self):
+        """Return a copy that keeps the current data and histogram, then
+        reset the arrays of this image handler. The copy can be fitted and
+        saved on another thread while new images are added to this one."""
+        ih = image_handler() # QThreads can't be copied with copy.copy
+        ih.__dict__.update(self.__dict__)
+        ih.stats = self.stats.copy() # reset_arrays replaces the columns
+        ih.hist = self.hist.copy()
+        self.reset_arrays()
+        return ih
+
     def process(self, im, include=True):
         """Fill in the next index of counts by integrating over
         the ROI. Append file ID, xc, yc, mean, stdv as well.
+        The ROI is integrated inside the bounding box of the mask. The
+        background statistics use the totals over the whole image, which 
+        are shared between all the analysers that receive the same image.
         Keyword arguments:
         im      -- image array to be processed
         include -- whether to include the image in further analysis
         """
+        if np.shape(im) != np.shape(self.mask):
+            return self.process_full(im, include)
+        n, r1, r2, (xmax, ymax) = frame_totals(im)
+        b = self.bias
+        t1 = r1 - b*n              # sum of (im - bias) over the whole image
+        t2 = r2 - 2*b*r1 + b*b*n   # sum of (im - bias)**2
+        box_im = im[self.box] - b
+        self.im_vals = box_im * self.box_mask # the ROI, within its bounding box
+        counts = np.sum(self.im_vals)
+        # background statistics: mean count and standard deviation across image
+        N = n - self.mask_sum      # = sum(1 - mask)
+        bg_sum = t1 - counts       # = sum(im * (1 - mask))
+        bg_sq  = t2 - np.sum(box_im**2) + np.sum((box_im - self.im_vals)**2)
+        mean = bg_sum / N
+        self.stats['Mean bg count'].append(mean)
+        # equivalent to the sum of (im*(1-mask) - mean)**2 over every pixel
+        self.stats['Bg s.d.'].append(np.sqrt(max(bg_sq - 2*mean*bg_sum + n*mean**2, 0) / (N - 1)))
+        # sum of counts in the ROI of the image gives the signal
+        self.stats['Counts'].append(counts)
+        self.append_stats(im, include, xmax, ymax)
+
+    def process_full(self, im, include=True):
+        """Process the image using masks over the whole image. This is
+        used when the image and mask aren't the same shape."""
         full_im = im - self.bias # remove the bias offset, it's arbitrary
         try:
             self.im_vals = full_im * self.mask # get the ROI
@@ -104,17 +260,21 @@ class image_handler(Analysis):
             np.sqrt(np.sum((not_roi - self.stats['Mean bg count'][-1])**2) / (N - 1)))
         # sum of counts in the ROI of the image gives the signal
         self.stats['Counts'].append(np.sum(self.im_vals)) 
+        # position of the (first) max intensity pixel
+        xmax, ymax = np.unravel_index(np.argmax(full_im), full_im.shape)
+        self.append_stats(im, include, xmax, ymax)
+
+    def append_stats(self, im, include, xmax, ymax):
+        """Append the stats that don't depend on the ROI integration."""
         # file ID number should be updated externally before each event
         self.stats['File ID'].append(self.fid)
         # the pixel value at the centre of the ROI
         try:
-            self.stats['ROI centre count'].append(full_im[self.xc, self.yc])
+            self.stats['ROI centre count'].append(im[self.xc, self.yc] - self.bias)
         except IndexError as e:
             error('ROI centre (%s, %s) outside of image size (%s, %s)'%(
                 self.xc, self.yc, self.pic_width, self.pic_height))
             self.stats['ROI centre count'].append(0)
-        # position of the (first) max intensity pixel
-        xmax, ymax = np.unravel_index(np.argmax(full_im), full_im.shape)
         self.stats['Max xpos'].append(xmax)
         self.stats['Max ypos'].append(ymax)
         self.stats['Include'].append(include)
@@ -168,38 +328,81 @@ class image_handler(Analysis):
             
     def hist_and_thresh(self):
         """Make a histogram of the photon counts and determine a threshold for 
-        single atom presence by iteratively checking the fidelity."""
+        single atom presence by iteratively checking the fidelity.
+        The threshold is only estimated again after thresh_every images,
+        or if the bins changed or a peak has shifted since the last estimate.
+        Otherwise, only the new images are compared to the threshold."""
         bins, occ, _ = self.histogram()
-        self.thresh = np.mean(bins) # initial guess
-        self.peaks_and_thresh() # in case peak calculation fails
-        # if np.size(self.peak_indexes) == 2: # est_param will only find one peak if the number of bins is small
-        #     # set the threshold where the fidelity is max
-        #     self.search_fidelity(self.peak_centre[0], self.peak_widths[0] ,self.peak_centre[1])
-        try: 
-            thresh = threshold_minimum(np.array(self.stats['Counts']), len(bins))
-            int(np.log(thresh)) # if thresh <= 0 this gives ValueError
-            self.thresh = thresh
-        except (ValueError, RuntimeError, OverflowError): pass
+        if self.thresh_due():
+            self.thresh = np.mean(bins) # initial guess
+            self.peaks_and_thresh() # in case peak calculation fails
+            # if np.size(self.peak_indexes) == 2: # est_param will only find one peak if the number of bins is small
+            #     # set the threshold where the fidelity is max
+            #     self.search_fidelity(self.peak_centre[0], self.peak_widths[0] ,self.peak_centre[1])
+            try: 
+                thresh = threshold_minimum(np.asarray(self.stats['Counts']), len(bins))
+                int(np.log(thresh)) # if thresh <= 0 this gives ValueError
+                self.thresh = thresh
+            except (ValueError, RuntimeError, OverflowError): pass
+            self.thresh_ind, self.thresh_est = self.ind, self.thresh
+            self.thresh_pops = self.hist.split(self.thresh)
         try:
             # atom is present if the counts are above threshold
-            self.stats['Atom detected'] = [x // self.thresh for x in self.stats['Counts']]
-            self.fidelity, self. err_fidelity = np.around(self.get_fidelity(), 4)
+            self.update_atoms()
+            params = (self.thresh, np.size(self.peak_indexes), *np.ravel(self.peak_centre),
+                *np.ravel(self.peak_widths))
+            if params != self.fid_params: # only changes with the threshold or peaks
+                self.fidelity, self. err_fidelity = np.around(self.get_fidelity(), 4)
+                self.fid_params = params
         except (ValueError, OverflowError): pass
         return bins, occ, self.thresh
 
+    def thresh_due(self):
+        """Check whether the threshold should be estimated again: if it's 
+        been thresh_every images, the histogram was rebinned, the threshold
+        was set elsewhere, or the mean of either peak has moved by more 
+        than shift_tol of its width."""
+        if (self.hist_changed or self.thresh != self.thresh_est or self.ind < self.thresh_ind
+                or self.ind - self.thresh_ind >= self.thresh_every):
+            return True
+        for (n0, m0, s0), (n, m, sd) in zip(self.thresh_pops, self.hist.split(self.thresh)):
+            if n0 > 1 and n > 1 and abs(m - m0) > self.shift_tol * s0:
+                return True
+        return False
+
+    def update_atoms(self):
+        """Compare the counts to the threshold to fill the Atom detected 
+        column. Only new counts are compared unless the threshold changed."""
+        counts = np.asarray(self.stats['Counts'])
+        n = len(self.stats['Atom detected'])
+        if (self.thresh != self.atom_thresh or n > len(counts) or 
+                self.stats['Atom detected'] is not self.atom_col):
+            self.stats['Atom detected'] = counts // self.thresh
+            self.atom_thresh = self.thresh
+            self.atom_col = self.stats['Atom detected']
+        elif n < len(counts):
+            self.stats['Atom detected'].extend(counts[n:] // self.thresh)
+
     def histogram(self):
-        """Make a histogram of the photon counts but don't update the threshold"""
+        """Make a histogram of the photon counts but don't update the threshold.
+        Only the counts added since the last call are binned, unless the 
+        bins change because the range of counts has grown."""
+        self.hist_changed = self.hist.update(self.stats['Counts'])
         if np.size(self.stats['Counts']): # don't do anything to an empty list
             if np.size(self.bin_array) > 0: 
-                occ, bins = np.histogram(self.stats['Counts'], self.bin_array) # fixed bins. 
+                occ, rebin = self.hist.bin(self.bin_array) # fixed bins. 
+                bins = self.hist.edges
             else:
                 try:
-                    lo, hi = min(self.stats['Counts'])*0.97, max(self.stats['Counts'])*1.02
+                    lo, hi = self.hist.min*0.97, self.hist.max*1.02
                     # scale number of bins with number of files in histogram and with separation of peaks
                     num_bins = int(15 + self.ind//100 + (abs(hi - abs(lo))/hi)**2*15) 
-                    occ, bins = np.histogram(self.stats['Counts'], bins=np.linspace(lo, hi, num_bins+1)) # no bins provided by user
+                    bins = np.linspace(lo, hi, num_bins+1) # no bins provided by user
+                    occ, rebin = self.hist.bin(bins)
                 except: 
                     occ, bins = np.histogram(self.stats['Counts'])
+                    self.hist.edges, rebin = None, True
+            self.hist_changed |= rebin
         else: occ, bins = np.zeros(10), np.arange(0,1.1,0.1)
         return bins, occ, self.thresh
 
@@ -218,8 +421,8 @@ class image_handler(Analysis):
             self.peak_centre = [0.25, 0.75]
             self.peak_widths = [0.1, 0.1]
         else: 
-            cs = np.sort(self.stats['Counts']) 
-            mid = len(cs) // 2 # index of the middle of the counts array
+            mid = len(self.stats['Counts']) // 2 # index of the middle of the counts array
+            cs = np.partition(self.stats['Counts'], mid) # lower half before mid, no need to sort
             self.peak_heights = [np.max(occ), np.max(occ)]
             self.peak_centre = [np.mean(cs[:mid]), np.mean(cs[mid:])]
             self.peak_widths = [np.std(cs[:mid]), np.std(cs[mid:])]  
@@ -227,21 +430,15 @@ class image_handler(Analysis):
     def peaks_and_thresh(self):
         """Get an estimate of the peak positions and standard deviations given a set threshold
         Then set the threshold as 5 standard deviations above background.
-        Sort the counts in ascending order, then split at the threshold, take means and widths."""
+        Split the counts at the threshold, take means and widths. The running
+        sums are used so that the counts don't have to be sorted."""
         # split histograms at threshold then get mean and stdev:
-        ascend = np.sort(self.stats['Counts'])
-        bg = ascend[ascend < self.thresh]     # background
-        signal = ascend[ascend > self.thresh] # signal above threshold
-        try:
-            1//np.size(bg) # raises ZeroDivisionError if size == 0
-            1//(np.size(bg)-1) # need > 1 images to get std dev
-            1//np.size(signal)
-            1//(np.size(signal)-1)
+        (nbg, mbg, sbg), (nsig, msig, ssig) = self.hist.split(self.thresh)
+        if nbg > 1 and nsig > 1: # need > 1 images to get std dev
             self.peak_heights = [1, 1]
-            self.peak_centre = [np.mean(bg), np.mean(signal)]
-            self.peak_widths = [np.std(bg, ddof=1), np.std(signal, ddof=1)]
+            self.peak_centre = [mbg, msig]
+            self.peak_widths = [sbg, ssig]
             self.thresh = self.peak_centre[0] + 5*self.peak_widths[0] # update threshold
-        except ZeroDivisionError: pass
 
     def create_rect_mask(self):
         """Use the current ROI dimensions to create a mask for the image.
@@ -250,23 +447,19 @@ class image_handler(Analysis):
                 self.xc - self.roi_size//2 >= 0 and 
                 self.yc + self.roi_size//2 < self.pic_height and 
                 self.yc - self.roi_size//2 >= 0):
-            self.mask = np.zeros((self.pic_width, self.pic_height))
-            self.mask[self.xc - self.roi_size//2 : (
+            mask = np.zeros((self.pic_width, self.pic_height))
+            mask[self.xc - self.roi_size//2 : (
                 self.xc + self.roi_size//2 + self.roi_size%2),
                 self.yc - self.roi_size//2 : (
                 self.yc + self.roi_size//2 + self.roi_size%2)
                 ] = np.ones((self.roi_size, self.roi_size))
+            self.mask = mask # set the whole mask so that the bounding box updates
 
     def set_pic_size(self, im_name):
         """Set the pic size by looking at the number of columns in a file
         Keyword arguments:
         im_name    -- absolute path to the image file to load"""
-        im_vals = np.genfromtxt(im_name, delimiter=self.delim)
-        self.pic_width = int(np.size(im_vals[0]) - 1) # the first column of ASCII image is row number
-        try: self.pic_height = int(np.size(im_vals[:,0])) 
-        except IndexError: 
-            self.pic_width = int(np.size(im_vals) - 1)
-            self.pic_height = 1
+        self.pic_width, self.pic_height = image_shape(im_name, self.delim)
         self.create_rect_mask()
         return self.pic_width, self.pic_height
 
@@ -297,10 +490,8 @@ class image_handler(Analysis):
         Assume that the first column is the column number.
         Keyword arguments:
         im_name    -- absolute path to the image file to load"""
-        # return np.genfromtxt(im_name, delimiter=self.delim)#[:,1:] # first column gives column number
         try: 
-            return np.loadtxt(im_name, delimiter=self.delim,
-                              usecols=range(1,self.pic_width+1))
-        except IndexError as e:
+            return load_image(im_name, self.delim, self.pic_width)
+        except (IndexError, ValueError) as e:
             error('Image analysis failed to load image '+im_name+'\n'+str(e))
             return np.zeros((self.pic_width, self.pic_height))
\ No newline at end of file
@@ -9,6 +9,7 @@ Stefan Spence 26/02/19
 __version__ = '1.3'
 import os
 import sys
+import copy
 import time
 import numpy as np
 import pyqtgraph as pg    # not as flexible as matplotlib but works a lot better with qt
@@ -21,9 +22,13 @@ from PyQt5.QtWidgets import (QActionGroup, QVBoxLayout, QMenu,
         QLabel, QTabWidget, QInputDialog)
 if '..' not in sys.path: sys.path.append('..')
 from strtypes import error, warning, info
+from saveimages.imformat import find_image, parse_name, iter_images
+from saveimages.imarchive import ImageArchive, find_archives
 import imageHandler as ih # process images to build up a histogram
 import histoHandler as hh # collect data from histograms together
 import fitCurve as fc   # custom class to get best fit parameters using curve_fit
+from renderScheduler import get_scheduler # limit the rate of redrawing plots
+from pixelStats import pixel_stats # running average image
 
 ####    ####    ####    ####
 
@@ -61,6 +66,7 @@ class main_window(QMainWindow):
      - The histoHandler module manages variables associated with the 
         collection of files in several histograms
      - The fitCurve module stores common functions for curve fitting.
+     - The mixtureFit module fits double Gaussian/Poissonian peaks to the counts.
     This GUI was produced with help from http://zetcode.com/gui/pyqt5/.
     Keyword arguments:
     results_path  -- directory to save log file and results to.
@@ -91,6 +97,7 @@ class main_window(QMainWindow):
         self.t0 = time.time() # time of initiation
         self.int_time = 0     # time taken to process an image
         self.plot_time = 0    # time taken to plot the graph
+        self.pool = None      # analysis_pool of worker processes, if used
         self.set_bins() # connect signals
 
     def init_log(self, results_path='.'):
@@ -595,12 +602,27 @@ class main_window(QMainWindow):
     def display_fit(self, toggle=True, fit_method='quick'):
         """Plot the best fit calculated by histo_handler.process
         and display the histogram statistics in the stat_labels"""
-        success = self.update_fit(fit_method=fit_method)
+        return self.show_fit(self.update_fit(fit_method=fit_method))
+
+    def show_fit(self, success, im_handler=None, hist_handler=None):
+        """Display the histogram statistics and best fit from the last 
+        histo_handler.process if it was successful.
+        Keyword arguments:
+        success      -- whether the fit was successful
+        im_handler   -- image handler that was fitted, if not the current one
+        hist_handler -- copy of the histogram handler that did the fit. Its
+            results are kept in the histogram handler."""
+        if im_handler is None: im_handler = self.image_handler
+        if hist_handler is not None: # fitted on another thread
+            for key in ['temp_vals', 'bf', 'mix']:
+                setattr(self.histo_handler, key, getattr(hist_handler, key))
+            if success: # histograms might have been added since the copy was made
+                self.histo_handler.temp_vals['File ID'] = int(self.histo_handler.ind)
         if success: 
             for key in self.histo_handler.stats.keys(): # update the text labels
                 self.stat_labels[key].setText(str(self.histo_handler.temp_vals[key]))
-            self.plot_current_hist(self.image_handler.histogram, self.hist_canvas)
-            if len(self.image_handler.stats['Counts']) > 50 and not any(self.image_handler.stats['Atom detected'][-50:]):
+            self.plot_current_hist(im_handler.histogram, self.hist_canvas)
+            if len(im_handler.stats['Counts']) > 50 and not any(im_handler.stats['Atom detected'][-50:]):
                 warning('Zero atoms detected in the last 50 shots of analysis '
                     +self.name+' '+self.multirun+' histogram %s.'%self.histo_handler.temp_vals['File ID']) 
             bf = self.histo_handler.bf # short hand
@@ -623,6 +645,32 @@ class main_window(QMainWindow):
         return self.histo_handler.process(self.image_handler, self.stat_labels['User variable'].text(), 
             fix_thresh=self.thresh_toggle.isChecked(), method=fit_method)
 
+    def fit_job(self, fit_method='check action'):
+        """Move the data to a copy of the image handler, which is reset for
+        the next histogram, and return a function that gets the best fit of 
+        the copy like display_fit, but without touching the widgets, so that 
+        it can run on another thread while new images arrive. 
+        The fit is done twice, then twice with 'quick' if it fails.
+        Returns the function, the image handler copy, and the histogram 
+        handler copy that does the fit, to pass on to show_fit."""
+        if fit_method == 'check action':
+            try: fit_method = self.fit_options.checkedAction().text()
+            except AttributeError: fit_method = 'quick'
+        user_var = self.stat_labels['User variable'].text()
+        fix_thresh = self.thresh_toggle.isChecked()
+        im_handler = self.image_handler.detach()
+        hist_handler = hh.histo_handler() # QThreads can't be copied with copy.copy
+        hist_handler.__dict__.update(self.histo_handler.__dict__)
+        hist_handler.temp_vals = self.histo_handler.temp_vals.copy()
+        hist_handler.mix = copy.deepcopy(self.histo_handler.mix)
+        def job():
+            for method in [fit_method, 'quick']:
+                success = hist_handler.process(im_handler, user_var, fix_thresh=fix_thresh, method=method)
+                success = hist_handler.process(im_handler, user_var, fix_thresh=fix_thresh, method=method)
+                if success: break
+            return success
+        return job, im_handler, hist_handler
+
     def update_varplot_axes(self, label=''):
         """The user selects which variable they want to display on the plot
         The variables are read from the x and y axis QComboBoxes
@@ -671,7 +719,7 @@ class main_window(QMainWindow):
 
     def set_im_show(self, toggle):
         """If the toggle is True, always update the widget with the last image."""
-        reset_slot(self.event_im, self.update_im, toggle)
+        reset_slot(self.event_im, self.schedule_im, toggle)
 
     def swap_signals(self):
         """Disconnect the image_handler process signal from the signal
@@ -704,7 +752,7 @@ class main_window(QMainWindow):
             reset_slot(self.event_im, self.show_recent_file, True) # might need a better label
             # just process the image
             if self.bin_actions[2].isChecked():
-                reset_slot(self.event_im, self.image_handler.process, True)
+                reset_slot(self.event_im, self.process_image, True)
                 
             
     #### #### canvas functions #### #### 
@@ -742,42 +790,74 @@ class main_window(QMainWindow):
         except ValueError as e:
             error('Cannot plot image. Probably CCD saturated.\n'+str(e))
 
+    def process_image(self, im, include=True):
+        """Process the image without updating the histogram, either in
+        a worker process if there is an analysis pool, or here.
+        event_im: [image (np.ndarray), include? (bool)]"""
+        if self.pool is None or not self.pool.submit(self, im, include, 'count'):
+            self.image_handler.process(im, include)
+
+    def show_result(self, hist):
+        """Plot the histogram sent back by an analysis worker process.
+        hist -- (bins, occurrences, threshold)"""
+        self.schedule_hist(hist, self.image_handler.stats['File ID'][-1])
+
+    def schedule_hist(self, hist, fid):
+        """Mark the histogram to be redrawn by the render scheduler, which
+        only draws the latest one when the window is visible. The draw is
+        skipped if the histogram was reset in the meantime.
+        hist -- (bins, occurrences, threshold)
+        fid  -- file ID of the last image in the histogram"""
+        col = self.image_handler.stats['Counts']
+        def draw():
+            if self.image_handler.stats['Counts'] is not col: return
+            t1 = time.time()
+            self.recent_label.setText('Just processed image ' + str(fid))
+            self.plot_current_hist(lambda: hist, self.hist_canvas)
+            self.plot_time = time.time() - t1
+        get_scheduler().mark((self, 'hist'), draw, self)
+
+    def schedule_im(self, im, include=True):
+        """Mark the image canvas to be redrawn with the latest image.
+        event_im: [image (np.ndarray), include? (bool)]"""
+        get_scheduler().mark((self, 'im'), lambda: self.update_im(im), self)
+
     def update_plot(self, im, include=True):
         """Receive the event image and whether it's valid emitted from the 
         camera. Process the image array with the image handler and update
-        the figure.
+        the figure. If there's an analysis pool, the image is processed in 
+        a worker process and the figure is updated by show_result.
         event_im: [image (np.ndarray), include? (bool)]"""
+        if self.pool is not None and self.pool.submit(self, im, include, 'thresh'):
+            return
         # add the count
         t1 = time.time()
         self.image_handler.process(im, include)
-        t2 = time.time()
-        self.int_time = t2 - t1
-        # display the name of the most recent file
-        self.recent_label.setText('Just processed image '
-                            + str(self.image_handler.fid))
-        self.plot_current_hist(self.image_handler.hist_and_thresh, self.hist_canvas) # update the displayed plot
-        self.plot_time = time.time() - t2
+        hist = self.image_handler.hist_and_thresh()
+        self.int_time = time.time() - t1
+        # display the name of the most recent file and the plot when it's redrawn
+        self.schedule_hist(hist, self.image_handler.fid)
 
     def update_plot_only(self, im, include=True):
         """Receive the event image and whether it's valid emitted from the 
         camera. Process the image array with the image handler and update
         the figure but without changing the threshold value.
         event_im: [image (np.ndarray), include? (bool)]"""
+        if self.pool is not None and self.pool.submit(self, im, include, 'fixed'):
+            return
         # add the count
         t1 = time.time()
         self.image_handler.process(im, include)
-        t2 = time.time()
-        self.int_time = t2 - t1
-        # display the name of the most recent file
-        self.recent_label.setText('Just processed image '
-                            + str(self.image_handler.fid))
-        self.plot_current_hist(self.image_handler.histogram, self.hist_canvas) # update the displayed plot
-        self.plot_time = time.time() - t2
+        hist = self.image_handler.histogram()
+        self.int_time = time.time() - t1
+        # display the name of the most recent file and the plot when it's redrawn
+        self.schedule_hist(hist, self.image_handler.fid)
 
-    def add_stats_to_plot(self, toggle=True):
+    def add_stats_to_plot(self, toggle=True, write=True):
         """Take the current histogram statistics from the Histogram Statistics labels
         and add the values to the variable plot, saving the parameters to the log
-        file at the same time. If any of the labels are empty, replace them with 0."""
+        file at the same time. If any of the labels are empty, replace them with 0.
+        Returns the line for the log file, which is only written if write=True."""
         # append current statistics to the histogram handler's list
         for key in self.stat_labels.keys():
             value = self.histo_handler.types[key](self.stat_labels[key].text()) if self.stat_labels[key].text() else 0
@@ -786,8 +866,11 @@ class main_window(QMainWindow):
         self.update_varplot_axes()  # update the plot with the new values
         self.histo_handler.ind = np.size(self.histo_handler.stats['File ID']) # index for histograms
         # append histogram stats to log file:
-        with open(self.log_file_name, 'a') as f:
-            f.write(','.join(list(map(str, self.histo_handler.temp_vals.values()))) + '\n')
+        line = ','.join(list(map(str, self.histo_handler.temp_vals.values()))) + '\n'
+        if write:
+            with open(self.log_file_name, 'a') as f:
+                f.write(line)
+        return line
 
     #### #### save and load data functions #### ####
 
@@ -815,7 +898,7 @@ class main_window(QMainWindow):
 
     def load_im_size(self):
         """Get the user to select an image file and then use this to get the image size"""
-        file_name = self.try_browse(file_type='Images (*.asc);;all (*)', default_path=self.image_storage_path)
+        file_name = self.try_browse(file_type='Images (*.asc *.pdx);;all (*)', default_path=self.image_storage_path)
         if file_name:
             width, height = self.image_handler.set_pic_size(file_name) # sets image handler's pic size
             self.pic_width_edit.setText(str(width)) # update loaded value
@@ -828,19 +911,8 @@ class main_window(QMainWindow):
             save_file_name = self.try_browse(title='Save File', file_type='csv(*.csv);;all (*)', 
                         open_func=QFileDialog.getSaveFileName)
         if save_file_name:
-            # don't update the threshold  - trust the user to have already set it
-            self.add_stats_to_plot()
-            warnmsg = ''
-            if not all(self.image_handler.stats['Include']):
-                warnmsg = 'The user should check histogram ' + save_file_name + \
-                    '\nAnalysis has flagged image %s as potentially mislabelled'%(
-                        self.image_handler.stats['File ID'][next(i for i, x in enumerate(
-                            self.image_handler.stats['Include']) if not x)])
-                warning(warnmsg)
-            # include most recent histogram stats as the top two lines of the header
-            self.image_handler.save(save_file_name,
-                         meta_head=list(self.histo_handler.temp_vals.keys()),
-                         meta_vals=map(str, self.histo_handler.temp_vals.values())) # save histogram
+            job, warnmsg = self.hist_save_job(save_file_name)
+            job()
             try: 
                 hist_num = self.histo_handler.stats['File ID'][-1]
             except IndexError: # if there are no values in the stats yet
@@ -854,6 +926,37 @@ class main_window(QMainWindow):
                 msg.setStandardButtons(QMessageBox.Ok)
                 msg.exec_()
 
+    def hist_save_job(self, save_file_name, im_handler=None):
+        """Add the histogram statistics to the plot, then return a function 
+        that appends them to the log file and saves the histogram data, and
+        the warning message if any images were flagged. The function only
+        uses copies of the data so it can run on another thread after the 
+        image handler has been reset.
+        Keyword arguments:
+        save_file_name -- the csv file to save the histogram data to
+        im_handler     -- image handler with the data, if not the current one"""
+        if im_handler is None: im_handler = self.image_handler
+        # don't update the threshold  - trust the user to have already set it
+        line = self.add_stats_to_plot(write=False)
+        warnmsg = ''
+        if not all(im_handler.stats['Include']):
+            warnmsg = 'The user should check histogram ' + save_file_name + \
+                '\nAnalysis has flagged image %s as potentially mislabelled'%(
+                    im_handler.stats['File ID'][next(i for i, x in enumerate(
+                        im_handler.stats['Include']) if not x)])
+            warning(warnmsg)
+        # include most recent histogram stats as the top two lines of the header
+        stats = im_handler.stats.copy() # reset_arrays replaces the columns
+        meta_head = list(self.histo_handler.temp_vals.keys())
+        meta_vals = list(map(str, self.histo_handler.temp_vals.values()))
+        log_file_name = self.log_file_name
+        def job():
+            with open(log_file_name, 'a') as f:
+                f.write(line)
+            im_handler.save(save_file_name, meta_head=meta_head, 
+                meta_vals=meta_vals, stats=stats) # save histogram
+        return job, warnmsg
+
     def save_varplot(self, save_file_name='', confirm=True):
         """Save the data in the current plot, which is held in the histoHandler's
         dictionary and saved in the log file, to a new file."""
@@ -899,26 +1002,29 @@ class main_window(QMainWindow):
             self.image_handler.reset_arrays() # get rid of old data
             self.hist_canvas.clear() # remove old histogram from display
 
-    def load_from_files(self, trigger=None, process=1):
+    def load_from_files(self, trigger=None, process=1, acc=None):
         """Prompt the user to select image files to process using the file
         browser.
         Keyword arguments:
             trigger:        Boolean passed from the QObject that triggers
                             this function.
             process:        1: process images and add to histogram.
-                            0: return list of image arrays."""
+                            0: return list of image arrays.
+            acc:            if process=0, add the images to this pixel_stats
+                            instead of returning them."""
         im_list = []
         if self.check_reset():
             file_list = self.try_browse(title='Select Files', 
-                    file_type='Images(*.asc);;all (*)', 
+                    file_type='Images(*.asc *.pdx);;all (*)', 
                     open_func=QFileDialog.getOpenFileNames, 
                     default_path=self.image_storage_path)
             self.recent_label.setText('Processing files...') # comes first otherwise not executed
-            for file_name in file_list:
-                try:
-                    im_vals = self.image_handler.load_full_im(file_name)
+            for file_name, im_vals in iter_images(file_list, self.image_handler.load_full_im):
+                try: # the next files are loaded in other threads while this one is processed
+                    if isinstance(im_vals, Exception): raise im_vals
                     if process:
                         self.image_handler.process(im_vals)
+                    elif acc is not None: acc.add(im_vals)
                     else: im_list.append(im_vals)
                     self.recent_label.setText( # only updates at end of loop
                         'Just processed: '+os.path.basename(file_name)) 
@@ -931,7 +1037,7 @@ class main_window(QMainWindow):
                 self.recent_label.setText('Finished Processing')
         return im_list
 
-    def load_from_file_nums(self, trigger=None, label='Im', process=1):
+    def load_from_file_nums(self, trigger=None, label='Im', process=1, acc=None):
         """Prompt the user to enter a range of image file numbers.
         Use these to select the image files from the current image storage path.
         Sequentially process the images then update the histogram
@@ -940,7 +1046,9 @@ class main_window(QMainWindow):
                             this function.
             label:        part of the labelling convention for image files
             process:        1: process images and add to histogram.
-                            0: return list of image arrays."""
+                            0: return list of image arrays.
+            acc:            if process=0, add the images to this pixel_stats
+                            instead of returning them."""
         im_list = []
         try: # which image in the sequence is being used
             imid = str(int(self.name.split('Im')[1].replace('.','')))
@@ -966,11 +1074,20 @@ class main_window(QMainWindow):
                         os.path.join(image_storage_path, label) + '_' + date + '_' + 
                         dfn + '_' + imid + '.asc' for dfn in list(map(str, 
                             range(int(minmax[0]), int(minmax[1]))))] 
-            for file_name in file_list:
+            archives = None
+            load = lambda f: self.image_handler.load_full_im(f) if os.path.isfile(f) else None
+            for file_name, im_vals in iter_images(map(find_image, file_list), load): # .asc or .pdx
                 try:
-                    im_vals = self.image_handler.load_full_im(file_name)
+                    if isinstance(im_vals, Exception): raise im_vals
+                    elif im_vals is None: # look for the image in the multirun archives
+                        if archives is None:
+                            archives = [ImageArchive(d, readonly=True) for d in find_archives(image_storage_path)]
+                        dfn = parse_name(file_name)[0]
+                        im_vals = next(a.get(dfn, int(imid)) for a in archives 
+                            if (dfn, int(imid)) in a).astype(float)
                     if process:
                         self.image_handler.process(im_vals)
+                    elif acc is not None: acc.add(im_vals)
                     else: im_list.append(im_vals)
                     self.recent_label.setText(
                         'Just processed: '+os.path.basename(file_name)) # only updates at end of loop
@@ -995,7 +1112,7 @@ class main_window(QMainWindow):
                     
     def load_image(self, trigger=None):
         """Prompt the user to select an image file to display"""
-        file_name = self.try_browse(file_type='Images (*.asc);;all (*)', 
+        file_name = self.try_browse(file_type='Images (*.asc *.pdx);;all (*)', 
                 default_path=self.image_storage_path)
         if file_name:  # avoid crash if the user cancelled
             im_vals = self.image_handler.load_full_im(file_name)
@@ -1003,18 +1120,14 @@ class main_window(QMainWindow):
         
     def make_ave_im(self):
         """Make an average image from the files selected by the user and 
-        display it."""
+        display it. The images are added to the average as they're loaded."""
+        ps = pixel_stats()
         if self.sender().text() == 'From Files':
-            im_list = self.load_from_files(process=0)
+            self.load_from_files(process=0, acc=ps)
         elif self.sender().text() == 'From File Numbers':
-            im_list = self.load_from_file_nums(process=0)
-        else: im_list = []
-        if len(im_list):
-            aveim = np.zeros(np.shape(im_list[0]))
-        else: return 0 # no images selected
-        for im in im_list:
-            aveim += im
-        self.update_im(aveim / len(im_list))
+            self.load_from_file_nums(process=0, acc=ps)
+        if not ps.n: return 0 # no images selected
+        self.update_im(ps.mean())
         return 1
 
     def load_from_log(self, trigger=None):
@@ -0,0 +1,133 @@
+"""Single Atom Image Analysis
+
+Fit a mixture of two peaks (background and atom signal) to the counts
+ - use expectation-maximisation on the counts themselves instead of least
+ squares on the binned histogram, so each iteration is just a couple of
+ vectorised passes over the counts and there's no dependence on the bins.
+ - each iteration can only increase the likelihood, and the number of
+ iterations is capped, so the fit always finishes in a fixed time.
+ - the fit starts from the parameters of the last fit if they match the
+ counts better than the peak estimates, so it usually only needs a few
+ iterations when the histograms in a multirun are similar.
+"""
+import numpy as np
+from scipy.special import gammaln
+
+class mixture:
+    """Fit two Gaussian or two Poissonian peaks to a set of counts.
+    The parameters are [w, mu0, sig0, mu1, sig1] for Gaussians or
+    [w, mu0, mu1] for Poissonians, where w is the fraction of counts in
+    the upper peak, mu0 < mu1 are the means and sig0, sig1 the widths.
+    Keyword arguments:
+    dist     -- 'gauss' or 'poisson'
+    max_iter -- maximum number of iterations for one fit
+    tol      -- stop when the fractional change in log likelihood is smaller
+    min_sig  -- smallest width allowed for a Gaussian peak, stops a peak
+        collapsing onto a single count"""
+    def __init__(self, dist='gauss', max_iter=200, tol=1e-8, min_sig=0.5):
+        self.dist = dist
+        self.max_iter = max_iter
+        self.tol = tol
+        self.min_sig = min_sig
+        self.ps = None     # best fit parameters, used to warm start the next fit
+        self.perrs = None  # estimated errors in the best fit parameters
+        self.n_iter = 0    # number of iterations used in the last fit
+        self.converged = False
+        self.ll = -np.inf  # log likelihood of the best fit
+
+    def logprobs(self, x, p):
+        """Return the log probability density of each count for the two
+        peaks, including the weights, (ignoring constant terms)."""
+        if self.dist == 'poisson':
+            w, mu0, mu1 = p
+            return [np.log(1-w) + x*np.log(mu0) - mu0 - gammaln(x+1),
+                np.log(w) + x*np.log(mu1) - mu1 - gammaln(x+1)]
+        w, mu0, sig0, mu1, sig1 = p
+        return [np.log(1-w) - np.log(sig0) - 0.5*((x-mu0)/sig0)**2,
+            np.log(w) - np.log(sig1) - 0.5*((x-mu1)/sig1)**2]
+
+    def loglike(self, x, p):
+        """Return the log likelihood and the probability that each count
+        belongs to the upper peak."""
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            l0, l1 = self.logprobs(x, p)
+            m = np.maximum(l0, l1)
+            ll = np.sum(m + np.log(np.exp(l0 - m) + np.exp(l1 - m)))
+            r1 = 1 / (1 + np.exp(l0 - l1))
+        return ll, r1
+
+    def valid(self, p):
+        p = np.asarray(p, dtype=float)
+        if not np.all(np.isfinite(p)) or not 0 < p[0] < 1: return False
+        return np.all(p[1:] > 0) if self.dist == 'poisson' else p[2] > 0 and p[4] > 0
+
+    def fit(self, counts, starts=[], thresh=None):
+        """Fit the peaks to the counts. Returns the best fit parameters, or
+        None if the fit failed.
+        Keyword arguments:
+        counts -- array of counts, one for each image
+        starts -- lists of initial parameters to try. The parameters from
+            the last fit are also tried, and the one with the highest
+            likelihood is used.
+        thresh -- if given, keep mu0 <= thresh <= mu1"""
+        x = np.asarray(counts, dtype=float)
+        if self.dist == 'poisson': x = np.clip(x, 0, None)
+        n = np.size(x)
+        if n < 4: return None
+        self.converged, self.n_iter = False, 0
+        cands = [np.array(p, dtype=float) for p in list(starts) + [self.ps]
+            if p is not None and np.size(p) == (3 if self.dist=='poisson' else 5)]
+        cands = [p for p in cands if self.valid(p)]
+        if not cands: return None
+        lls = [self.loglike(x, p)[0] for p in cands]
+        i = int(np.nanargmax(lls)) if np.any(np.isfinite(lls)) else 0
+        p, ll = cands[i], lls[i]
+        for self.n_iter in range(1, self.max_iter+1):
+            ll_old = ll
+            _, r1 = self.loglike(x, p)
+            r0 = 1 - r1
+            n1 = np.sum(r1)
+            n0 = n - n1
+            if n0 < 1 or n1 < 1 or not np.isfinite(n1): return None # a peak is empty
+            mu0, mu1 = np.dot(r0, x) / n0, np.dot(r1, x) / n1
+            if thresh is not None:
+                mu0, mu1 = min(mu0, thresh), max(mu1, thresh)
+            if self.dist == 'poisson':
+                p = np.array([n1/n, max(mu0, 1e-3), max(mu1, 1e-3)])
+            else:
+                sig0 = max(np.sqrt(np.dot(r0, (x - mu0)**2) / n0), self.min_sig)
+                sig1 = max(np.sqrt(np.dot(r1, (x - mu1)**2) / n1), self.min_sig)
+                p = np.array([n1/n, mu0, sig0, mu1, sig1])
+            p[0] = min(max(p[0], 1/n), 1 - 1/n) # keep both peaks in the fit
+            ll, _ = self.loglike(x, p)
+            if abs(ll - ll_old) <= self.tol * abs(ll):
+                self.converged = True
+                break
+        if not self.valid(p): return None
+        # put the background peak first
+        if self.dist == 'poisson' and p[1] > p[2]:
+            p = np.array([1-p[0], p[2], p[1]])
+        elif self.dist != 'poisson' and p[1] > p[3]:
+            p = np.array([1-p[0], p[3], p[4], p[1], p[2]])
+        self.ps, self.ll = p, ll
+        self.perrs = self.errors(p, n)
+        return p
+
+    def errors(self, p, n):
+        """Estimate the standard errors in the parameters, treating each
+        peak as a separate sample of n*w counts."""
+        w = p[0]
+        n0, n1 = max(n*(1-w), 1), max(n*w, 1)
+        if self.dist == 'poisson':
+            return np.array([np.sqrt(w*(1-w)/n), np.sqrt(p[1]/n0), np.sqrt(p[2]/n1)])
+        return np.array([np.sqrt(w*(1-w)/n), p[2]/np.sqrt(n0), p[2]/np.sqrt(2*n0),
+            p[4]/np.sqrt(n1), p[4]/np.sqrt(2*n1)])
+
+    def heights(self, n, width):
+        """Return the heights of the two peaks on a histogram of n counts
+        with bins of the given width."""
+        w = self.ps[0]
+        if self.dist == 'poisson':
+            return n*(1-w)*width, n*w*width
+        return (n*(1-w)*width / np.sqrt(2*np.pi) / self.ps[2],
+            n*w*width / np.sqrt(2*np.pi) / self.ps[4])
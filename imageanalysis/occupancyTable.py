@@ -0,0 +1,152 @@
+"""Single Atom Image Analysis
+
+Keep track of which ROIs had an atom in each shot
+ - one row per File ID, so a shot is looked up by indexing instead of
+ searching the File ID columns of every histogram.
+ - the occupancy of all of the ROIs in a shot is bit-packed into uint64
+ words: one bit per image handler for 'atom detected', and one bit for
+ 'an image was processed for this File ID'.
+ - update() only reads the rows added to each image handler since the
+ last update. A handler's bits are only recalculated when its threshold
+ changes or its stats are reset.
+ - conditions across ROIs are then bitwise operations on the table.
+"""
+import numpy as np
+
+def popcount(words):
+    """Return the number of set bits in each row of a 2D uint64 array."""
+    try: return np.bitwise_count(words).sum(axis=1, dtype=int) # numpy >= 2.0
+    except AttributeError:
+        words = np.ascontiguousarray(words)
+        return np.unpackbits(words.view(np.uint8), axis=1).sum(axis=1, dtype=int)
+
+class occupancy_table:
+    """Occupancy of each image handler's ROI indexed by File ID.
+    Keyword arguments:
+    handlers -- list of image_handlers to take 'File ID' and 'Counts' from,
+        compared to each handler's threshold."""
+    def __init__(self, handlers=[]):
+        self.handlers = []
+        self.set_handlers(handlers)
+
+    def set_handlers(self, handlers):
+        """Use a new list of image handlers. The table is only rebuilt if
+        the handlers are different."""
+        if len(handlers) == len(self.handlers) and all(
+                a is b for a, b in zip(handlers, self.handlers)):
+            return
+        self.handlers = list(handlers)
+        self.nwords = max((len(self.handlers) + 63) // 64, 1)
+        self.reset()
+
+    def reset(self):
+        """Empty the table."""
+        n = len(self.handlers)
+        self.id0   = 0 # File ID of the first row
+        self.size  = 0 # number of rows in use
+        self.atoms = np.zeros((0, self.nwords), dtype=np.uint64) # atom detected bits
+        self.seen  = np.zeros((0, self.nwords), dtype=np.uint64) # image processed bits
+        self.cols  = [None]*n # the Counts column read from each handler
+        self.done  = [0]*n    # number of rows read from each handler
+        self.threshs = [None]*n # threshold used for each handler
+        self.natoms  = np.zeros(n, dtype=int) # number of images with atoms for each handler
+        self.last  = [None]*n # largest File ID read from each handler
+        self.version = 0 # incremented whenever bits are cleared
+
+    def index(self, handler):
+        """Return the position of the handler in the table."""
+        return next(i for i, h in enumerate(self.handlers) if h is handler)
+
+    @staticmethod
+    def bit(i):
+        """Return the word and bit mask for handler i."""
+        return i // 64, np.uint64(1) << np.uint64(i % 64)
+
+    def masks(self, inds, conds=None):
+        """Return words with the bits for handlers inds set. If conds is
+        given, also return the words with bits set where the condition is True."""
+        m = np.zeros(self.nwords, dtype=np.uint64)
+        c = np.zeros(self.nwords, dtype=np.uint64)
+        for j, i in enumerate(inds):
+            w, b = self.bit(i)
+            m[w] |= b
+            if conds is not None and conds[j]: c[w] |= b
+        return m, c
+
+    def grow(self, lo, hi):
+        """Make sure there are rows for File IDs lo to hi."""
+        if self.size == 0: self.id0 = lo
+        start = min(lo, self.id0)
+        size = max(hi, self.id0 + self.size - 1) - start + 1
+        shift = self.id0 - start
+        if shift or size > len(self.atoms):
+            cap = max(size, 2*len(self.atoms)) if size > len(self.atoms) else len(self.atoms)
+            for key in ['atoms', 'seen']:
+                arr = np.zeros((cap, self.nwords), dtype=np.uint64)
+                arr[shift:shift+self.size] = getattr(self, key)[:self.size]
+                setattr(self, key, arr)
+            self.id0 = start
+        self.size = size
+
+    def clear(self, i):
+        """Remove the bits for handler i."""
+        w, b = self.bit(i)
+        self.atoms[:self.size, w] &= ~b
+        self.seen[:self.size, w] &= ~b
+        self.done[i], self.natoms[i], self.last[i] = 0, 0, None
+        self.version += 1
+
+    def update(self):
+        """Read the rows added to the image handlers since the last update."""
+        for i, h in enumerate(self.handlers):
+            counts, fids = h.stats['Counts'], h.stats['File ID']
+            n = min(len(counts), len(fids))
+            if (counts is not self.cols[i] or n < self.done[i] or
+                    h.thresh != self.threshs[i]):
+                self.clear(i)
+                self.cols[i], self.threshs[i] = counts, h.thresh
+            if n > self.done[i]:
+                ids = np.asarray(fids)[self.done[i]:n].astype(np.int64)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    atom = np.asarray(counts)[self.done[i]:n] // h.thresh > 0
+                self.grow(int(ids.min()), int(ids.max()))
+                rows = ids - self.id0
+                w, b = self.bit(i)
+                self.seen[rows, w] |= b
+                self.atoms[rows[atom], w] |= b
+                self.natoms[i] += np.count_nonzero(atom)
+                self.last[i] = int(ids.max()) if self.last[i] is None else max(self.last[i], int(ids.max()))
+                self.done[i] = n
+
+    def ids(self, sl=slice(None)):
+        """Return the File IDs of the rows in the slice."""
+        return self.id0 + np.arange(self.size)[sl]
+
+    def span(self, i):
+        """Return the slice of rows from the first to the last File ID
+        from handler i, or None if the handler is empty."""
+        w, b = self.bit(i)
+        rows = np.flatnonzero(self.seen[:self.size, w] & b)
+        if not rows.size: return None
+        return slice(rows[0], rows[-1]+1)
+
+    def rows(self, ids):
+        """Return the rows for the File IDs and a mask of which are in the table."""
+        rows = np.asarray(ids, dtype=np.int64) - self.id0
+        valid = (rows >= 0) & (rows < self.size)
+        return np.where(valid, rows, 0), valid
+
+    def has(self, i, ids, key='atoms'):
+        """Return a boolean array of whether handler i detected an atom
+        (key='atoms') or processed an image (key='seen') for each File ID."""
+        rows, valid = self.rows(ids)
+        w, b = self.bit(i)
+        return valid & ((getattr(self, key)[rows, w] & b) > 0)
+
+    def matches(self, inds, conds, sl=slice(None)):
+        """Return words with the bits set for handlers in inds that meet
+        their condition in each row of the slice: True for an atom, False
+        for an image without an atom."""
+        m, c = self.masks(inds, conds)
+        atoms, seen = self.atoms[:self.size][sl], self.seen[:self.size][sl]
+        return (atoms & c) | (seen & ~atoms & m & ~c)
@@ -0,0 +1,149 @@
+"""Single Atom Image Analysis
+
+Per-pixel statistics that are updated as each image arrives
+ - keeps the running mean and variance of each pixel (Welford's method),
+ and the fraction of images where each pixel was above a threshold.
+ - the memory used only depends on the image size, not the number of
+ images, so it can be left running on live data or scanning an archive.
+ - with a decay factor, the weight of old images falls off exponentially
+ so that the maps follow slow drifts (e.g. the atoms' positions).
+ - the maps can be saved and loaded back as a numpy .npz file.
+"""
+import sys
+import numpy as np
+if '.' not in sys.path: sys.path.append('.')
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info
+
+class pixel_stats:
+    """Accumulate the mean, variance, and above-threshold probability of
+    each pixel over a stream of images. The maps are reset if an image
+    with a different shape arrives.
+    Keyword arguments:
+    shape  -- (width, height) of the images. Taken from the first image if None.
+    decay  -- fraction of the weight of the previous images that is lost
+        with each new image. 0 gives equal weight to every image.
+    thresh -- count that a pixel must be above to be counted in the
+        probability map. None to not make the probability map."""
+    def __init__(self, shape=None, decay=0, thresh=None):
+        self.decay  = decay
+        self.thresh = thresh
+        self.reset(shape)
+
+    def reset(self, shape=None):
+        """Clear the maps, ready for images of the given shape."""
+        self.shape = tuple(shape) if shape is not None else None
+        self.n = 0     # number of images added
+        self.w = 0.    # total weight of the images (= n if there's no decay)
+        self.ave = np.zeros(self.shape) if self.shape else None # running mean
+        self.m2  = np.zeros(self.shape) if self.shape else None # weighted sum of squared deviations
+        self.above = np.zeros(self.shape) if self.shape else None # weighted count above threshold
+
+    def set_decay(self, decay):
+        """Set the fraction of the previous weight lost with each image.
+        The images that were already added keep their current weights."""
+        self.decay = min(max(decay, 0), 1)
+
+    def set_thresh(self, thresh):
+        """Set the threshold for the probability map, which is reset since
+        the previous counts were for a different threshold."""
+        self.thresh = thresh
+        if self.above is not None: self.above[:] = 0
+
+    def add(self, im, *args):
+        """Add an image to the maps. Extra arguments are ignored so that this
+        can be connected to signals that also send whether to include the image."""
+        im = np.asarray(im, dtype=float)
+        if im.shape != self.shape or not self.n:
+            return self.add_stack(im[np.newaxis])
+        lam = 1 - self.decay
+        self.w = self.w * lam + 1
+        delta = im - self.ave
+        self.ave += delta / self.w
+        if lam != 1: self.m2 *= lam
+        self.m2 += delta * (im - self.ave) # in place, to avoid new arrays
+        if self.thresh is not None:
+            if lam != 1: self.above *= lam
+            self.above += im > self.thresh
+        self.n += 1
+
+    def add_stack(self, ims):
+        """Add a 3D array of images, in the order they were taken. The stack
+        is reduced to one weighted mean and variance, then merged with the
+        running values (Chan's method)."""
+        ims = np.asarray(ims, dtype=float)
+        if ims.ndim != 3 or not len(ims): return
+        if ims.shape[1:] != self.shape:
+            if self.n: warning('Pixel stats reset: image shape changed from %s to %s'%(
+                self.shape, ims.shape[1:]))
+            self.reset(ims.shape[1:])
+        k = len(ims)
+        lam = 1 - self.decay
+        wts = lam**np.arange(k-1, -1, -1) # the last image has weight 1
+        wb = np.sum(wts)
+        ave_b = np.tensordot(wts, ims, axes=1) / wb
+        m2_b = np.tensordot(wts, (ims - ave_b)**2, axes=1)
+        w_old = self.w * lam**k # weight left from the previous images
+        w = w_old + wb
+        delta = ave_b - self.ave
+        self.ave += delta * (wb / w)
+        self.m2 = self.m2 * lam**k + m2_b + delta**2 * (w_old * wb / w)
+        if self.thresh is not None:
+            self.above = self.above * lam**k + np.tensordot(wts, ims > self.thresh, axes=1)
+        self.w = w
+        self.n += k
+
+    def add_archive(self, archive, run_min=0, run_max=None, imn=0, roi=None, chunk=50):
+        """Add the images from an ImageArchive, loading chunk images at a time.
+        The arguments select the images as in ImageArchive.select.
+        Returns the number of images added."""
+        inds = archive.select(run_min, run_max, imn, roi)
+        for i in range(0, len(inds), chunk):
+            self.add_stack([archive.load(j) for j in inds[i:i+chunk]])
+        return len(inds)
+
+    def mean(self):
+        """Return the mean image, or None if no images were added."""
+        return self.ave.copy() if self.n else None
+
+    def var(self):
+        """Return the weighted variance of each pixel, or None if there
+        aren't enough images. Without decay this is the sample variance."""
+        if self.n < 2: return None
+        return self.m2 / (self.w - 1) if self.decay == 0 else self.m2 / self.w
+
+    def std(self):
+        """Return the standard deviation of each pixel."""
+        v = self.var()
+        return None if v is None else np.sqrt(v)
+
+    def prob(self):
+        """Return the fraction of images where each pixel was above the
+        threshold, or None if there's no threshold."""
+        if not self.n or self.thresh is None: return None
+        return self.above / self.w
+
+    def save(self, file_name):
+        """Save the maps and settings to a numpy .npz file."""
+        if not self.n: return warning('No pixel stats to save to '+file_name)
+        try:
+            np.savez(file_name, ave=self.ave, m2=self.m2,
+                above=self.above if self.above is not None else np.zeros(0),
+                n=self.n, w=self.w, decay=self.decay,
+                thresh=np.nan if self.thresh is None else self.thresh)
+        except (OSError, PermissionError) as e:
+            error('Failed to save pixel stats to '+file_name+'\n'+str(e))
+
+    def load(self, file_name):
+        """Load the maps and settings saved with save(). Returns 1 on success."""
+        try:
+            with np.load(file_name) as f:
+                self.reset(f['ave'].shape)
+                self.ave[:], self.m2[:] = f['ave'], f['m2']
+                self.n, self.w, self.decay = int(f['n']), float(f['w']), float(f['decay'])
+                self.thresh = None if np.isnan(f['thresh']) else float(f['thresh'])
+                if f['above'].shape == self.shape: self.above[:] = f['above']
+            return 1
+        except (OSError, KeyError, ValueError) as e:
+            error('Failed to load pixel stats from '+file_name+'\n'+str(e))
+            return 0
@@ -0,0 +1,256 @@
+"""Single Atom Image Analysis
+
+Analyse the images from a finished multirun again without the GUI
+ - takes the image directory (or the image path, date, and measure prefix),
+ the analysis settings from default.config (image size, bias, ROIs and
+ thresholds), and the multirun parameters file saved in the measure folder.
+ - the runs are split into histograms the same way as in the multirun:
+ each histogram is '# omitted' runs that are skipped, then '# in hist' runs.
+ - each histogram is processed for all of the main analysis windows in a
+ worker process, so the histograms are analysed in parallel.
+ - writes the histogram csv files and the measure .dat logs with the same
+ names and layout as settings_window.multirun_save.
+ - images are loaded from ASCII or binary files named
+ [label]_[date]_[Dexter file #]_[image #], or from image archives.
+Usage:
+python reanalyse.py params.csv --images dir --config default.config --results dir
+python reanalyse.py params.csv --image_path dir --date 19/10/2021 --measure_prefix Measure0
+"""
+import os
+import sys
+import time
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from imageHandler import image_handler
+from histoHandler import histo_handler
+if '.' not in sys.path: sys.path.append('.')
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info, listlist
+from saveimages.imformat import load_image, parse_name, ASC_EXT, BIN_EXT
+from saveimages.imarchive import ImageArchive, find_archives
+
+# settings from default.config that are used here
+CONFIG_TYPES = {'pic_width':int, 'pic_height':int, 'ROIs':listlist, 'bias':int,
+    'image_path':str, 'results_path':str, 'num_images':int, 'num_saia':int}
+
+def load_config(file_name):
+    """Return the analysis settings from a config file saved by the
+    settings window, with lines key=value."""
+    stats = {'pic_width':512, 'pic_height':512, 'ROIs':[[1,1,1,1,1]], 'bias':697,
+        'image_path':'.', 'results_path':'.', 'num_images':2, 'num_saia':2}
+    with open(file_name, 'r') as f:
+        for line in f:
+            if len(line.split('=')) == 2:
+                key, val = line.replace('\n','').split('=')
+                if key in CONFIG_TYPES:
+                    stats[key] = CONFIG_TYPES[key](val)
+    return stats
+
+def load_params(file_name):
+    """Return the multirun values and parameters from the file saved
+    by the multirun editor's save_mr_params."""
+    with open(file_name, 'r') as f:
+        _ = f.readline()
+        vals = [x.split(',') for x in f.readline().replace('\n','').split(';')]
+        header = f.readline().replace('\n','').split(';')
+        params = f.readline().replace('\n','').split(';')
+    mr_param = OrderedDict(zip(header, params))
+    for key in ['measure', '1st hist ID', '# omitted', '# in hist']:
+        mr_param[key] = int(mr_param[key])
+    mr_param['runs included'] = listlist(mr_param.get('runs included', ''))
+    return vals, mr_param
+
+def find_images(dir_name, archives=True):
+    """Return a dict of (run #, image #): source for the images in dir_name.
+    The source is a file name, or the directory of an image archive."""
+    sources = {}
+    if archives:
+        for d in find_archives(dir_name):
+            a = ImageArchive(d, readonly=True)
+            index = a.get_index()
+            for run, imn in zip(index['run'], index['imn']):
+                sources[(int(run), int(imn))] = (d,)
+            a.close()
+    for fn in os.listdir(dir_name): # files take precedence over archives
+        if fn.lower().endswith((ASC_EXT, BIN_EXT)):
+            sources[parse_name(fn)] = os.path.join(dir_name, fn)
+    return sources
+
+def get_windows(stats, fixed=False):
+    """Return the settings for each of the main analysis windows, named
+    as in the settings window: ROI[j].Im[k]. for ROI j and image k.
+    If fixed, use the thresholds from the ROIs instead of fitting them."""
+    m = stats['num_images']
+    windows = []
+    for i in range(max(stats['num_saia'], m)):
+        try: xc, yc, w, h, t = stats['ROIs'][i//m]
+        except IndexError: break
+        windows.append({'name':'ROI%s.Im%s.'%(i//m, i%m), 'imn':i%m, 'roi':[xc, yc, w],
+            'thresh':t if fixed else None})
+    return windows
+
+def get_hists(vals, mr_param, first_run=None):
+    """Return a list of (histogram ID, user variable, [runs]) for the
+    histograms in the multirun, leaving out the omitted runs."""
+    if first_run is None:
+        try: first_run = min(mr_param['runs included'][0])
+        except (IndexError, ValueError):
+            raise ValueError('The first run number is not in the multirun parameters. Set it with --first_run.')
+    nomit, nhist = mr_param['# omitted'], mr_param['# in hist']
+    hists = []
+    for v in range(len(vals)):
+        start = first_run + v*(nomit + nhist) + nomit
+        hists.append((v + mr_param['1st hist ID'], vals[v][0], list(range(start, start + nhist))))
+    return hists
+
+####    ####    ####    ####
+
+_archives = {} # directory: ImageArchive, opened once in each worker process
+
+def get_image(source, run, imn, delim=' ', width=0):
+    """Load an image from a file, or from the archive if source is a tuple."""
+    if isinstance(source, tuple):
+        a = _archives.get(source[0])
+        if a is None:
+            a = _archives[source[0]] = ImageArchive(source[0], readonly=True)
+        return a.get(run, imn).astype(float)
+    return load_image(source, delim, width)
+
+def analyse_hist(job):
+    """Process the images for one histogram in each of the windows, then fit
+    and save the histograms. Runs in a worker process.
+    Keyword arguments:
+    job -- dict with the histogram 'ID', index 'v', user variable 'var',
+        'runs', image 'sources', 'windows' settings, 'stats' config,
+        'method' for the fit, and 'save_dir' for the csv files.
+    Returns (v, the lines for the measure logs, # images, messages)."""
+    stats, msgs = job['stats'], []
+    handlers = []
+    for w in job['windows']:
+        ih, hh = image_handler(), histo_handler()
+        ih.pic_width, ih.pic_height = stats['pic_width'], stats['pic_height']
+        ih.bias = stats['bias']
+        ih.set_roi(dimensions=w['roi'])
+        if w['thresh'] is not None: ih.thresh = w['thresh']
+        hh.ind = job['v']
+        handlers.append((w, ih, hh))
+    nims = 0
+    for run in job['runs']:
+        ims = {}
+        for w, ih, hh in handlers:
+            imn = w['imn']
+            if imn not in ims:
+                try: ims[imn] = get_image(job['sources'][(run, imn)], run, imn, width=ih.pic_width)
+                except KeyError:
+                    msgs.append('Missing image %s for run %s'%(imn, run))
+                    ims[imn] = None
+                except Exception as e:
+                    msgs.append('Failed to load image %s for run %s: %s'%(imn, run, e))
+                    ims[imn] = None
+                else: nims += 1
+            if ims[imn] is not None:
+                ih.fid = run
+                ih.process(ims[imn])
+    lines = OrderedDict()
+    for w, ih, hh in handlers:
+        fix = w['thresh'] is not None
+        for method in [job['method'], 'quick']:
+            success = hh.process(ih, job['var'], fix_thresh=fix, method=method)
+            success = hh.process(ih, job['var'], fix_thresh=fix, method=method)
+            if success: break
+        if not success:
+            msgs.append('Fit failed for %s in histogram %s'%(w['name'], job['ID']))
+        if not all(ih.stats['Include']):
+            msgs.append('The user should check histogram %s%s: image %s is potentially mislabelled'%(
+                w['name'], job['ID'], next(fid for fid, incl in zip(
+                    ih.stats['File ID'], ih.stats['Include']) if not incl)))
+        lines[w['name']] = ','.join(map(str, hh.temp_vals.values())) + '\n'
+        ih.save(os.path.join(job['save_dir'], w['name'] + str(job['ID']) + '.csv'),
+            meta_head=list(hh.temp_vals.keys()), meta_vals=list(map(str, hh.temp_vals.values())))
+    return job['v'], lines, nims, msgs
+
+####    ####    ####    ####
+
+def reanalyse(params_file, image_dir, config, save_dir, fixed=False,
+        method='quick', workers=None, first_run=None):
+    """Analyse all of the histograms in a multirun across a pool of worker
+    processes, writing the results to save_dir like the multirun does.
+    Keyword arguments:
+    params_file -- the multirun parameters csv file.
+    image_dir   -- directory containing the image files or archives.
+    config      -- dict of settings, from load_config.
+    save_dir    -- directory to save the histogram csv and measure .dat files.
+    fixed       -- use the thresholds from the ROIs instead of fitting them.
+    method      -- the fit method used on the histograms, as in the main window.
+    workers     -- number of worker processes. Default is the number of CPUs.
+    first_run   -- run number the multirun started at, if not in the params.
+    Returns the number of images processed."""
+    vals, mr_param = load_params(params_file)
+    measure_prefix = mr_param['measure_prefix']
+    hists = get_hists(vals, mr_param, first_run)
+    windows = get_windows(config, fixed)
+    sources = find_images(image_dir)
+    info('Reanalysing %s: %s histograms of %s runs in %s windows, %s images found in %s'%(
+        measure_prefix, len(hists), mr_param['# in hist'], len(windows), len(sources), image_dir))
+    os.makedirs(save_dir, exist_ok=True)
+    logs = OrderedDict()
+    for w in windows: # start the measure files like init_analysers_multirun
+        logs[w['name']] = os.path.join(save_dir, w['name'] + measure_prefix + '.dat')
+        if not os.path.isfile(logs[w['name']]):
+            histo_handler().save(logs[w['name']], meta_head=['SAIA Log file. Include:'])
+    jobs = [{'ID':hid, 'v':v, 'var':var, 'runs':runs, 'windows':windows, 'stats':config,
+        'method':method, 'save_dir':save_dir, 'sources':{k: src for k, src in sources.items()
+            if runs[0] <= k[0] <= runs[-1]}} for v, (hid, var, runs) in enumerate(hists)]
+    t0, nims, done = time.time(), 0, {}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(analyse_hist, job) for job in jobs]
+        for fut in as_completed(futures):
+            try: v, lines, n, msgs = fut.result()
+            except Exception as e:
+                error('Reanalysis failed for a histogram.\n'+str(e))
+                continue
+            for msg in msgs: warning(msg)
+            done[v] = lines
+            nims += n
+            dt = time.time() - t0
+            info('Finished %s / %s histograms, %s images in %.3g s (%.3g images/s)'%(
+                len(done), len(jobs), nims, dt, nims / dt if dt else 0))
+    for v in sorted(done.keys()): # append to the measure files in histogram order
+        for name, line in done[v].items():
+            with open(logs[name], 'a') as f:
+                f.write(line)
+    return nims
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Analyse the images from a multirun again.')
+    parser.add_argument('params', help='multirun parameters csv file, saved in the measure folder')
+    parser.add_argument('--images', default='', help='directory containing the images')
+    parser.add_argument('--image_path', default='',
+        help='base image directory, used with --date and --measure_prefix if --images is not given')
+    parser.add_argument('--date', default='', help='date the images were taken: dd/mm/yyyy')
+    parser.add_argument('--measure_prefix', default='', help='default: from the params file')
+    parser.add_argument('--config', default=os.path.join('imageanalysis', 'default.config'),
+        help='image analysis config file with the ROIs, pic size, and bias')
+    parser.add_argument('--results', default='',
+        help='directory to save results in. Default: the directory of the params file')
+    parser.add_argument('--fixed', action='store_true', help='use the ROI thresholds from the config')
+    parser.add_argument('--method', default='quick', help='fit method, e.g. "double gaussian"')
+    parser.add_argument('--workers', type=int, default=0, help='number of worker processes')
+    parser.add_argument('--first_run', type=int, default=None,
+        help='first run number of the multirun, if it is not in the params file')
+    args = parser.parse_args()
+    config = load_config(args.config)
+    image_dir = args.images
+    if not image_dir:
+        _, mr_param = load_params(args.params)
+        t = time.strptime(args.date, '%d/%m/%Y') if args.date else time.localtime()
+        date = time.strftime("%d %b %B %Y", t).split(" ") # day short_month long_month year
+        image_dir = os.path.join(args.image_path or config['image_path'], date[3], date[2], date[0])
+        prefix_dir = os.path.join(image_dir, args.measure_prefix or mr_param['measure_prefix'])
+        if os.path.isdir(prefix_dir): image_dir = prefix_dir # archives are saved in the measure folder
+    t0 = time.time()
+    n = reanalyse(args.params, image_dir, config,
+        args.results or os.path.dirname(os.path.abspath(args.params)), fixed=args.fixed,
+        method=args.method, workers=args.workers or None, first_run=args.first_run)
+    info('Reanalysed %s images from %s in %.3g s'%(n, image_dir, time.time() - t0))
@@ -7,6 +7,8 @@ For use in a re-imaging sequence.
  - Display the survival histogram - if there's an atom in the 
  first image, then take the second image.
  - Allow the user to display the two running instances of main.py
+ - The histogram is built up as images arrive, looking up whether the 
+ before image had an atom in an occupancy_table indexed by File ID.
 """
 import os
 import sys
@@ -18,6 +20,8 @@ from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtGui import QFont
 from PyQt5.QtWidgets import QLabel, QMessageBox
 from maingui import main_window, reset_slot
+from renderScheduler import get_scheduler # limit the rate of redrawing plots
+from occupancyTable import occupancy_table
 
 # main GUI window contains all the widgets                
 class reim_window(main_window):
@@ -46,6 +50,12 @@ class reim_window(main_window):
                         im_store_path=im_store_path, name=name)
         self.ih1, self.ih2 = imhandlers # used to get histogram data
         self.hh1, self.hh2 = histhandlers # get histogram fitting and stats
+        self.occ = occupancy_table([self.ih1]) # which before images had atoms
+        self.occ_version = -1  # occ.version when the histogram was last rebuilt
+        self.after_col = None  # the after Counts column that was read from
+        self.after_ind = 0     # number of after images that have been checked
+        self.reim_col  = None  # the Counts column that the histogram is kept in
+        self.reim_n    = 0     # number of images in the histogram
         self.adjust_UI() # adjust widgets from main_window
         
     def adjust_UI(self):
@@ -94,26 +104,34 @@ class reim_window(main_window):
 
     def get_histogram(self):
         """Take the histogram from the 'after' images where the 'before' images
-        contained an atom."""
+        contained an atom. Only the after images added since the last call
+        are checked, unless the histograms were reset or the threshold changed."""
         try:
             int(np.log(self.ih1.thresh)) # don't do anything if threshold is < 1
-            # make it more thread safe: take a copy of dictionaries at the start 
-            s1 = self.ih1.stats.copy() 
-            s2 = self.ih2.stats.copy()
-            atom = np.where(np.array(s1['Counts']) // self.ih1.thresh > 0, True, False)
-            idxs = np.arange(len(s2['File ID']))[np.isin(s2['File ID'], np.array(s1['File ID'])[atom])]
+            t1 = time.time()
+            self.occ.set_handlers([self.ih1])
+            self.occ.update()
+            s2, stats = self.ih2.stats, self.image_handler.stats
+            if (self.occ.version != self.occ_version or s2['Counts'] is not self.after_col
+                    or len(s2['Counts']) < self.after_ind or stats['Counts'] is not self.reim_col 
+                    or len(stats['Counts']) != self.reim_n):
+                for key in stats.keys(): # start again
+                    stats[key] = []
+                self.occ_version, self.after_col, self.after_ind = self.occ.version, s2['Counts'], 0
+                self.reim_col = stats['Counts']
+            n = min(len(s2[key]) for key in stats.keys()) # in case a row is being added
+            ids = np.asarray(s2['File ID'])[self.after_ind:n]
+            # wait for before images that haven't been processed yet
+            last = self.occ.last[0] if self.occ.last[0] is not None else -np.inf
+            waiting = np.flatnonzero(~self.occ.has(0, ids, 'seen') & (ids >= last))
+            if waiting.size: ids = ids[:waiting[0]]
             # take the after images when the before images contained atoms
-            t1 = time.time() # list comprehension is faster than np array for list length < 1500
-            self.image_handler.stats['Mean bg count'] = [s2['Mean bg count'][i] for i in idxs]
-            self.image_handler.stats['Bg s.d.']  = [s2['Bg s.d.'][i] for i in idxs]
-            self.image_handler.stats['Counts']   = [s2['Counts'][i] for i in idxs]
-            self.image_handler.stats['File ID']  = [s2['File ID'][i] for i in idxs]
-            self.image_handler.stats['ROI centre count'] = [s2['ROI centre count'][i] for i in idxs]
-            self.image_handler.stats['Max xpos'] = [s2['Max xpos'][i] for i in idxs]
-            self.image_handler.stats['Max ypos'] = [s2['Max ypos'][i] for i in idxs]
-            self.image_handler.ind = np.size(self.image_handler.stats['Counts'])
-            self.image_handler.stats['Atom detected'] = [s2['Atom detected'][i] for i in idxs]
-            self.image_handler.stats['Include']  = [s2['Include'][i] for i in idxs]
+            rows = self.after_ind + np.flatnonzero(self.occ.has(0, ids))
+            for key in stats.keys():
+                stats[key].extend(np.asarray(s2[key])[rows])
+            self.after_ind += len(ids)
+            self.reim_n = len(stats['Counts'])
+            self.image_handler.ind = self.reim_n
             self.image_handler.thresh = int(self.thresh_edit.text()) if self.thresh_edit.text() else self.ih2.thresh
             t2 = time.time()
             self.int_time = t2 - t1
@@ -154,28 +172,26 @@ class reim_window(main_window):
     def update_plot(self, im, include=True):
         """Same as update_plot_only because we want the threshold to be taken
         from the second histogram (after image), not calculated in this reimage histogram."""
-        t2 = self.get_histogram()
-        # display the name of the most recent file
-        if self.image_handler.ind > 1:
-            self.recent_label.setText('Just processed image '
-                        + str(self.image_handler.stats['File ID'][-1]))
-        for imh, hc in [[self.ih1.histogram, self.hist1], # thresh for ih1, ih2 set in main window
-                        [self.ih2.histogram, self.hist2], 
-                        [self.image_handler.histogram, self.hist_canvas]]:
-            self.plot_current_hist(imh, hc) # update the displayed plot
-        self.plot_time = time.time() - t2
+        self.get_histogram()
+        get_scheduler().mark((self, 'hist'), self.draw_hists, self)
 
     def update_plot_only(self, im, include=True):
         """Receive the event path emitted from the system event handler signal.
         Take the histogram from the 'after' images where the 'before' images
         contained an atom and then update the figure without changing the 
         threshold value."""
-        t2 = self.get_histogram()
+        self.get_histogram()
+        get_scheduler().mark((self, 'hist'), self.draw_hists, self)
+
+    def draw_hists(self):
+        """Plot the before, after, and survival histograms and display the 
+        file ID of the most recent image. Called by the render scheduler."""
+        t2 = time.time()
         # display the name of the most recent file
         if self.image_handler.ind > 1:
             self.recent_label.setText('Just processed image '
                         + str(self.image_handler.stats['File ID'][-1]))
-        for imh, hc in [[self.ih1.histogram, self.hist1], 
+        for imh, hc in [[self.ih1.histogram, self.hist1], # thresh for ih1, ih2 set in main window
                         [self.ih2.histogram, self.hist2], 
                         [self.image_handler.histogram, self.hist_canvas]]:
             self.plot_current_hist(imh, hc) # update the displayed plot
@@ -0,0 +1,105 @@
+"""Single Atom Image Analysis
+
+Limit how often the plots and images in the analysis windows are redrawn
+ - the processing functions mark a plot as needing to be redrawn by giving
+ the scheduler a function that draws it. They don't wait for the drawing.
+ - a timer redraws the marked plots at most fps times per second. If a plot
+ was marked several times since the last redraw, only the latest is drawn.
+ - plots in windows that are hidden or minimised aren't drawn until the
+ window is shown again.
+ - downsample() reduces long histories to fewer points for plotting,
+ keeping the min and max of each bin so that spikes are still visible.
+"""
+import sys
+import time
+import numpy as np
+from collections import OrderedDict
+from PyQt5.QtCore import QObject, QTimer
+if '.' not in sys.path: sys.path.append('.')
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info
+from networking.linkstats import get_link
+
+def downsample(y, n=500):
+    """Return x, y with at most n points to plot the history y. Each of
+    n//2 bins is replaced by its min and max values, in the order they
+    occurred, so that outliers still show up."""
+    y = np.asarray(y)
+    x = np.arange(len(y))
+    if len(y) <= n: return x, y
+    m = n // 2
+    edges = np.linspace(0, len(y), m+1).astype(int)
+    lo = np.minimum.reduceat(y, edges[:-1])
+    hi = np.maximum.reduceat(y, edges[:-1])
+    ilo = np.array([a + np.argmin(y[a:b]) for a, b in zip(edges[:-1], edges[1:])])
+    ihi = np.array([a + np.argmax(y[a:b]) for a, b in zip(edges[:-1], edges[1:])])
+    first = ilo <= ihi # the min came before the max in this bin
+    xs = np.empty(2*m, dtype=int)
+    ys = np.empty(2*m, dtype=y.dtype)
+    xs[0::2], xs[1::2] = np.where(first, ilo, ihi), np.where(first, ihi, ilo)
+    ys[0::2], ys[1::2] = np.where(first, lo, hi), np.where(first, hi, lo)
+    return xs, ys
+
+####    ####    ####    ####
+
+class render_scheduler(QObject):
+    """Redraw plots that have been marked as changed, at most fps times a
+    second. Use get_scheduler() to share one scheduler between windows.
+    Keyword arguments:
+    fps -- the maximum number of redraws per second."""
+    def __init__(self, fps=20):
+        super().__init__()
+        self.dirty = OrderedDict() # key: (draw function, window) waiting to be drawn
+        self.stats = get_link('Plot redraws')
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.redraw)
+        self.set_fps(fps)
+
+    def set_fps(self, fps):
+        """Set the maximum number of redraws per second."""
+        self.fps = max(fps, 0.1)
+        self.timer.setInterval(int(1000 / self.fps))
+
+    def mark(self, key, draw, window=None):
+        """Mark a plot as needing to be redrawn, replacing any draw that is
+        still waiting for the same key.
+        Keyword arguments:
+        key    -- identifies the plot, e.g. (window, 'hist').
+        draw   -- function with no arguments that redraws the plot.
+        window -- the plot is only drawn while this widget is visible."""
+        self.dirty[key] = (draw, window)
+        if not self.timer.isActive(): self.timer.start()
+
+    def redraw(self):
+        """Draw each of the marked plots in a visible window once."""
+        t0 = time.time()
+        for key, (draw, window) in list(self.dirty.items()):
+            try:
+                if window is not None and (not window.isVisible() or window.isMinimized()):
+                    continue # leave it marked until the window is shown
+            except RuntimeError: # the window was deleted
+                self.dirty.pop(key, None)
+                continue
+            self.dirty.pop(key, None)
+            try: draw()
+            except Exception as e: error('Failed to redraw plot %s: %s'%(key, e))
+        self.stats.record('redraw', time.time() - t0)
+        self.stats.set_queue_depth(len(self.dirty))
+        if not self.dirty: self.timer.stop()
+
+    def flush(self, window=None):
+        """Draw all the marked plots now, or only those for the given window."""
+        for key, (draw, win) in list(self.dirty.items()):
+            if window is None or win is window:
+                self.dirty.pop(key, None)
+                draw()
+
+_scheduler = None # shared between all of the windows
+
+def get_scheduler():
+    """Return the render_scheduler shared by the analysis windows. It's
+    made the first time, after there is a QApplication."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = render_scheduler()
+    return _scheduler
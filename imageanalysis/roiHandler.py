@@ -3,11 +3,14 @@ Stefan Spence 13/04/20
 
 Allocate ROIs on an image and assign thresholds to determine
 atom presence
+ - the ROI masks are compiled into one sparse matrix so that the counts
+ in every ROI come from a single matrix-vector product per image
 """
 import sys
 import time
 import numpy as np
 import pyqtgraph as pg
+from scipy.sparse import csr_matrix
 from skimage.filters import threshold_minimum
 from collections import OrderedDict
 from PyQt5.QtCore import pyqtSignal
@@ -17,6 +20,7 @@ from PyQt5.QtWidgets import QWidget, QLineEdit, QCheckBox
 if '.' not in sys.path: sys.path.append('.')
 if '..' not in sys.path: sys.path.append('..')
 from strtypes import error, warning, info
+from saveimages.imformat import load_image, image_shape
 from maingui import int_validator, nat_validator
 from fitCurve import fit
 
@@ -56,11 +60,31 @@ class ROI(QWidget):
             edit.textEdited[str].connect(self.set_vals) # only triggered by user, not setText
         self.autothresh = QCheckBox(self) # toggle whether to auto update threshold
         self.autothresh.setChecked(autothresh)
+        self.version = 0 # incremented when the mask changes
+        self._sparse = (-1, None, None) # version, indices, and weights of the mask
         self.create_rect_mask(imshape) # the values of the image included in ROI
         self.mask_type = 'rect' # what type of mask is being used
         self.ps = np.zeros(4) # parameters for gauss mask
         self.d = 3 # number of pixels around centre point to use for gauss mask
 
+    @property
+    def mask(self):
+        return self._mask
+
+    @mask.setter
+    def mask(self, mask):
+        self._mask = mask
+        self.version += 1 # so that the roi_handler recompiles this mask
+
+    def sparse(self):
+        """Return the flat indices and weights of the nonzero pixels in
+        the mask, only scanning the mask again if it has changed."""
+        if self._sparse[0] != self.version:
+            flat = self.mask.ravel()
+            inds = np.flatnonzero(flat)
+            self._sparse = (self.version, inds, flat[inds])
+        return self._sparse[1:]
+
     def create_rect_mask(self, image_shape=None):
         """Use the current ROI dimensions to create a mask for the image.
         The rect mask is zero outside the ROI and 1 inside the ROI."""
@@ -71,10 +95,13 @@ class ROI(QWidget):
                 self.y + self.h//2 < self.s[1] and 
                 self.y - self.h//2 >= 0):
             self.roi.maxBounds = QRect(0, 0, self.s[0]+1, self.s[1]+1)
-            self.mask = np.zeros(self.s)
-            self.mask[self.x - self.w//2 : (self.x + self.w//2 + self.w%2),
-                self.y - self.h//2 : (self.y + self.h//2 + self.h%2)
-                ] = np.ones((self.w, self.h))
+            xs = np.arange(self.x - self.w//2, self.x + self.w//2 + self.w%2)
+            ys = np.arange(self.y - self.h//2, self.y + self.h//2 + self.h%2)
+            mask = np.zeros(self.s)
+            mask[xs[0]:xs[-1]+1, ys[0]:ys[-1]+1] = np.ones((self.w, self.h))
+            self.mask = mask
+            inds = (xs[:,None]*self.s[1] + ys[None,:]).ravel() # no need to scan the mask
+            self._sparse = (self.version, inds, np.ones(inds.size))
             self.mask_type = 'rect'
         else: warning('ROI tried to create invalid mask.\n' + 
             'shape %s, x %s, y %s, w %s, h %s'%(self.s, self.x, self.y, self.w, self.h))
@@ -190,6 +217,9 @@ class roi_handler(QWidget):
         self.shape = im_shape # image dimensions in pixels
         self.bias  = 697      # bias offset to subtract from image counts
         self.delim = ' '      # delimiter used to save/load files
+        self.fast_send = None # function to send occupancy straight to the AWG
+        self._key = None      # ROIs and mask versions used to make the weight matrix
+        self.weights = None   # sparse matrix of ROI masks: (# ROIs, # pixels)
         
     def create_rois(self, n):
         """Change the list of ROIs to have length n"""
@@ -207,6 +237,16 @@ class roi_handler(QWidget):
             except (IndexError, ValueError) as e: warning(
                 "Failed to resize ROI "+str(i)+": %s\n"%roi + str(e))
 
+    def shift_rois(self, dx, dy, shape):
+        """Move all of the ROIs by (dx, dy) pixels when the image window
+        changes to the new (width, height), so that they cover the same
+        pixels on the camera. Each mask is only recreated once."""
+        self.shape = tuple(shape)
+        for r in self.ROIs:
+            r.s = self.shape
+            r.resize(r.x + dx, r.y + dy, r.w, r.h, create_sq_mask=False)
+            r.translate_mask(r.x, r.y) # keeps the type of mask
+
     def reset_count_lists(self, ids=[]):
         """Empty the lists of counts in the ROIs with the gives IDs"""
         for i in ids:
@@ -215,10 +255,44 @@ class roi_handler(QWidget):
                 self.ROIs[i].i = 0
             except IndexError: pass
 
+    def compile_masks(self):
+        """Combine the ROI masks into a sparse matrix with a row of weights
+        for each ROI. Only the masks that changed since the last call are
+        scanned again. Returns None if the masks aren't all the same shape."""
+        key = tuple((id(r), r.version) for r in self.ROIs)
+        if key != self._key:
+            shapes = set(np.shape(r.mask) for r in self.ROIs)
+            if len(shapes) != 1:
+                self.weights = None
+            else:
+                inds, vals = zip(*[r.sparse() for r in self.ROIs])
+                indptr = np.concatenate([[0], np.cumsum([len(x) for x in inds])])
+                self.weights = csr_matrix((np.concatenate(vals), np.concatenate(inds), 
+                    indptr), shape=(len(self.ROIs), int(np.prod(shapes.pop()))))
+            self._key = key
+        return self.weights
+
     def process(self, im, include=True):
         """Add the integrated counts in each ROI to their lists.
         emit success = 1 if all ROIs have an atom
         emit a string of which ROIs are occupied, e.g. '0110'"""
+        weights = self.compile_masks()
+        if weights is None or np.shape(im) != np.shape(self.ROIs[0].mask):
+            return self.process_rois(im, include)
+        wh = np.array([r.w * r.h for r in self.ROIs])
+        t = np.array([r.t for r in self.ROIs])
+        counts = weights.dot(np.ravel(im)) - self.bias * wh
+        occupied = np.abs(counts) > t
+        success = int(np.all(np.abs(counts) // t))
+        atomstring = (occupied.astype(np.uint8) + ord('0')).tobytes().decode() # e.g. '0110'
+        for r, c in zip(self.ROIs, counts):
+            r.c[r.i%1000] = c
+            r.i += 1
+        self.send_occupancy(success, atomstring)
+
+    def process_rois(self, im, include=True):
+        """Process the image one ROI at a time. Used when the image and 
+        ROI masks aren't the same shape, so that the errors are reported."""
         success = 1
         atomstring = ''
         for r in self.ROIs:
@@ -231,20 +305,23 @@ class roi_handler(QWidget):
             except ValueError as e:
                 error("Image was wrong shape %s for atom checker's ROI%s %s"%(
                     np.shape(im), r.id, r.s) + str(e))
+        self.send_occupancy(success, atomstring)
+
+    def send_occupancy(self, success, atomstring):
+        """Emit the trigger if all ROIs are occupied, and send the occupancy."""
         try:
             1 // (1 - success) # ZeroDivisionError if success = 1
         except ZeroDivisionError: 
             self.trigger.emit(success) # only emit if successful
-        self.rearrange.emit(atomstring)
+        if self.fast_send is None or not self.fast_send(atomstring):
+            self.rearrange.emit(atomstring) # fall back to TCP messages
         
     def set_pic_size(self, im_name):
         """Set the pic size by looking at the number of columns in a file
         First column is just the index of the row.
         Keyword arguments:
         im_name    -- absolute path to the image file to load"""
-        shape = np.genfromtxt(im_name, delimiter=self.delim).shape
-        try: self.cam_pic_size_changed(shape[1]-1, shape[0])
-        except IndexError: self.cam_pic_size_changed(shape[0]-1, 1)
+        self.cam_pic_size_changed(*image_shape(im_name, self.delim))
 
     def set_bias(self, bias):
         """Update the bias offset subtracted from all image counts."""
@@ -264,8 +341,7 @@ class roi_handler(QWidget):
         Keyword arguments:
         im_name    -- absolute path to the image file to load"""
         try: 
-            return np.loadtxt(im_name, delimiter=self.delim,
-                              usecols=range(1,self.shape[0]+1)).reshape(self.shape)
-        except IndexError as e:
+            return load_image(im_name, self.delim, self.shape[0]).reshape(self.shape)
+        except (IndexError, ValueError) as e:
             error('Image analysis failed to load image '+im_name+'\n'+str(e))
             return np.zeros(self.shape)
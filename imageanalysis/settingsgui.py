@@ -3,6 +3,10 @@ Stefan Spence 26/02/19
 
  - control the ROIs across all SAIA instances
  - update other image statistics like read noise, bias offset
+ - at the end of a histogram in a multirun, the main window data are moved
+ to copies that are fitted in a thread pool while the next histogram starts.
+ When the fits finish, the files are saved on a writer thread, then 
+ multirun_saved is emitted with the time taken for each window.
 """
 import os
 import sys
@@ -11,21 +15,27 @@ import socket
 import numpy as np
 import pyqtgraph as pg
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 # some python packages use PyQt4, some use PyQt5...
 from PyQt5.QtCore import pyqtSignal, QRegExp
 from PyQt5.QtGui import (QIcon, QRegExpValidator, QFont)
 from PyQt5.QtWidgets import (QActionGroup, QVBoxLayout, QMenu, 
         QFileDialog, QMessageBox, QLineEdit, QGridLayout, QWidget,
         QApplication, QPushButton, QAction, QMainWindow, QTabWidget,
-        QTableWidget, QTableWidgetItem, QLabel)
+        QTableWidget, QTableWidgetItem, QLabel, QInputDialog)
 if '.' not in sys.path: sys.path.append('.')
 if '..' not in sys.path: sys.path.append('..')
 from strtypes import intstrlist, listlist, error, warning, info
 from maingui import main_window, reset_slot, int_validator, double_validator, nat_validator
 from reimage import reim_window # analysis for survival probability
 from compimage import compim_window
+from analysisPool import analysis_pool
+from renderScheduler import get_scheduler
+from pixelStats import pixel_stats
 from roiHandler import ROI
-from networking.client import simple_msg
+from networking.influx import get_writer
+from networking.linkstats import get_link
+from saveimages.imformat import image_shape, iter_images
 
 ####    ####    ####    ####
 
@@ -42,6 +52,8 @@ class settings_window(QMainWindow):
     """
     m_changed = pyqtSignal(int) # gives the number of images per run
     bias_changed = pyqtSignal(int) # gives the bias offset to subtract from counts in images
+    multirun_saved = pyqtSignal(str, object) # hist ID and the times taken for each window once files are saved
+    fit_done = pyqtSignal() # a main window fit from multirun_save finished on the fit pool
 
     def __init__(self, results_path='', im_store_path='', config_settings={}):
         super().__init__()
@@ -54,6 +66,15 @@ class settings_window(QMainWindow):
             ('last_image', ''), ('window_pos', [550, 20, 10, 200, 600, 400]),
             ('num_images',2), ('num_saia',2), ('num_reim',1), ('num_coim', 0)])
         self.send_data = False
+        self.fit_pool = ThreadPoolExecutor(max_workers=max(os.cpu_count() or 1, 1), 
+            thread_name_prefix='hist_fit') # fit main window histograms in parallel
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hist_save') # save files in order
+        self.pending = [] # writes queued by multirun_save that haven't finished
+        self.fitting = [] # histograms from multirun_save waiting for their fits, in order
+        self.fit_done.connect(self.save_fits) # queued to the GUI thread
+        self.save_times = OrderedDict() # time (s) taken for each window in the last multirun_save
+        self.save_stats = get_link('Multirun save')
+        self.pool = None # analysis_pool of worker processes for the main windows
         self.load_settings(stats=config_settings) # load default
         self.date = time.strftime("%d %b %B %Y", time.localtime()).split(" ") # day short_month long_month year
         self.results_path = results_path if results_path else self.stats['results_path'] # used for saving results
@@ -157,6 +178,10 @@ class settings_window(QMainWindow):
         save_all.triggered.connect(self.all_hists)
         hist_menu.addAction(save_all)
 
+        self.worker_toggle = QAction('Process in worker processes', self, checkable=True)
+        self.worker_toggle.triggered.connect(self.set_workers)
+        hist_menu.addAction(self.worker_toggle)
+
         # image menubar allows you to display images
         im_menu = menubar.addMenu('Image')
         load_im = QAction('Load Image', self) # display a loaded image
@@ -172,6 +197,10 @@ class settings_window(QMainWindow):
         # make_im_menu.addAction(make_im_fn)
         im_menu.addMenu(make_im_menu)
 
+        plot_rate = QAction('Set plot refresh rate', self) # max redraws per second
+        plot_rate.triggered.connect(self.set_plot_rate)
+        im_menu.addAction(plot_rate)
+
         # central widget creates container for tabs
         self.centre_widget = QWidget()
         self.tabs = QTabWidget()       # make tabs for each main display 
@@ -581,10 +610,39 @@ class settings_window(QMainWindow):
         cw.reset_handlers([self.mw[self.mw_names.index(x)].image_handler for x in blist],
             [self.mw[self.mw_names.index(x)].image_handler for x in alist])
                 
+    def set_plot_rate(self, fps=0):
+        """Set the maximum number of times per second that the plots in the
+        analysis windows are redrawn. If fps isn't given, ask the user."""
+        sched = get_scheduler()
+        if not fps:
+            fps, ok = QInputDialog.getDouble(self, 'Plot refresh rate', 
+                'Maximum redraws per second:', sched.fps, 0.1, 200, 1)
+            if not ok: return
+        sched.set_fps(fps)
+
+    def set_workers(self, toggle=True, n=0):
+        """Process the images for the main windows in worker processes if
+        toggle is True, otherwise process them in the GUI.
+        Keyword arguments:
+        toggle -- whether to use worker processes.
+        n      -- the number of worker processes. Default: one fewer than 
+            the number of CPUs, but no more than the number of main windows."""
+        if toggle and self.pool is None:
+            n = n if n > 0 else max(min((os.cpu_count() or 2) - 1, self._a), 1)
+            self.pool = analysis_pool(n)
+            self.pool.assign(self.mw[:self._a])
+            info('Processing the images for %s analysers in %s worker processes.'%(self._a, n))
+        elif not toggle and self.pool is not None:
+            self.pool.sync() # keep the results that are pending
+            self.pool.close()
+            self.pool = None
+        self.worker_toggle.setChecked(self.pool is not None)
+
     #### #### multirun functions #### ####
     
     def end_multirun(self, *args, **kwargs):
         """Reconnect analyser event_im signals and display the empty histogram."""
+        self.wait_for_saves()
         for mw in self.rw + self.mw:
             # reconnect previous signals
             # mw.set_bins() # reconnects signal with given histogram binning settings
@@ -592,17 +650,30 @@ class settings_window(QMainWindow):
             mw.multirun = ''
     
     def multirun_save(self, results_path, measure_prefix, n=0, var='0', hist_id='0', *args, **kwargs):
-        """Save the histograms as part of the multirun.
+        """Save the histograms as part of the multirun. The reimage and 
+        comparison windows are fitted and saved first, since they use the 
+        main windows' data. Then the main window data are moved to copies 
+        and the histograms are reset straight away. The copies are fitted in 
+        parallel on the fit pool, and save_fits logs and saves them once 
+        the fits have finished. Files are written on the writer thread, and 
+        multirun_saved is emitted once all of the files have been saved.
         results_path   -- base directory results are saved in
         measure_prefix -- label for the subdirectory results are saved in
         n              -- the current run number
         var            -- the user variable associated with this histogram
         hist_id        -- unique ID for histogram"""
-        # get best fit on histograms, doing reimage last since their fits depend on the main hists
-        for mw in self.mw[:self._a] + self.rw[:len(self.rw_inds)] + self.cw: 
+        t0 = time.time()
+        times = OrderedDict()
+        if self.pool is not None: self.pool.sync() # make sure every image is in the hists
+        mws = self.mw[:self._a]
+        rws = self.rw[:len(self.rw_inds)]
+        for mw in mws + rws + self.cw: 
             mw.var_edit.setText(var) # also updates histo_handler temp vals
             mw.set_user_var() # just in case not triggered by the signal
             mw.bins_text_edit(text='reset') # set histogram bins 
+        # reimage and comparison fits use the main windows' histograms
+        for mw in rws + self.cw:
+            t = time.time()
             success = mw.display_fit(fit_method='check action') # get best fit
             success = mw.display_fit(fit_method='check action') # get best fit
             if not success:                   # if fit fails, use peak search
@@ -610,38 +681,106 @@ class settings_window(QMainWindow):
                 mw.display_fit(fit_method='quick')
             mw.update()
             # append histogram stats to measure log file:
-            with open(os.path.join(results_path, measure_prefix, 
-                    mw.objectName() + measure_prefix + '.dat'), 'a') as f:
-                f.write(','.join(list(map(str, mw.histo_handler.temp_vals.values()))) + '\n')
-        # save and reset the histograms, make sure to do reimage windows first!
-        for mw in self.rw[:len(self.rw_inds)] + self.mw[:self._a]: 
+            self.queue_write(self.append_line, os.path.join(results_path, measure_prefix, 
+                    mw.objectName() + measure_prefix + '.dat'), 
+                ','.join(list(map(str, mw.histo_handler.temp_vals.values()))) + '\n')
             if self.send_data: self.send_results(measure_prefix, hist_id, mw)
-            mw.save_hist_data(save_file_name=os.path.join(results_path, measure_prefix, 
-                    mw.objectName() + str(hist_id) + '.csv'), confirm=False) # save histogram
-            mw.image_handler.reset_arrays() # clear histogram
-        for mw in self.cw:
-            if self.send_data: self.send_results(measure_prefix, hist_id, mw)
-            mw.add_stats_to_plot()
+            if mw in rws: # save and reset the reimage histogram
+                job, _ = mw.hist_save_job(os.path.join(results_path, measure_prefix, 
+                        mw.objectName() + str(hist_id) + '.csv')) # copies the data to save
+                self.queue_write(job)
+                mw.image_handler.reset_arrays() # clear histogram
+            else: mw.add_stats_to_plot()
+            times[mw.objectName()] = time.time() - t
+        # move the main window data to copies and fit them on the pool
+        fits = []
+        for mw in mws:
+            job, ih, hh = mw.fit_job() # resets the main window's histogram
+            fits.append((mw, ih, hh, self.fit_pool.submit(self.run_fit, job)))
+        times['GUI'] = time.time() - t0
+        self.fitting.append((results_path, measure_prefix, str(hist_id), times, t0, fits))
+        for fit in fits:
+            fit[-1].add_done_callback(lambda f: self.fit_done.emit())
+
+    def run_fit(self, job):
+        """Run a fit job on the fit pool. Returns whether it was successful 
+        and the time taken."""
+        t = time.time()
+        return job(), time.time() - t
+
+    def save_fits(self):
+        """Show, log, and save the main window fits from multirun_save, in
+        the order of the histograms, once all of a histogram's fits have 
+        finished. Then multirun_saved is emitted from the writer thread."""
+        while self.fitting and all(fit[-1].done() for fit in self.fitting[0][-1]):
+            results_path, measure_prefix, hist_id, times, t0, fits = self.fitting.pop(0)
+            for mw, ih, hh, fut in fits:
+                t = time.time()
+                try: success, times[mw.objectName()] = fut.result()
+                except Exception as e:
+                    error('Fit failed for %s at end of histogram %s\n'%(mw.objectName(), hist_id)+str(e))
+                    success, times[mw.objectName()] = False, 0
+                mw.show_fit(success, ih, hh)
+                mw.update()
+                # append histogram stats to measure log file:
+                self.queue_write(self.append_line, os.path.join(results_path, measure_prefix, 
+                        mw.objectName() + measure_prefix + '.dat'), 
+                    ','.join(list(map(str, mw.histo_handler.temp_vals.values()))) + '\n')
+                if self.send_data: self.send_results(measure_prefix, hist_id, mw)
+                job, _ = mw.hist_save_job(os.path.join(results_path, measure_prefix, 
+                        mw.objectName() + hist_id + '.csv'), ih) # copies the data to save
+                self.queue_write(job)
+                times[mw.objectName()] += time.time() - t
+            self.queue_write(self.finish_save, hist_id, times, t0)
+
+    def append_line(self, file_name, line):
+        with open(file_name, 'a') as f:
+            f.write(line)
+
+    def queue_write(self, fn, *args):
+        """Run fn(*args) on the writer thread, after previously queued writes."""
+        self.pending = [f for f in self.pending if not f.done()]
+        self.pending.append(self.writer.submit(self.run_write, fn, *args))
+
+    def run_write(self, fn, *args):
+        try: fn(*args)
+        except Exception as e:
+            error('Settings window failed to save multirun data\n'+str(e))
+
+    def finish_save(self, hist_id, times, t0):
+        """Record the time taken to save each window, then let the GUI know
+        that all of the files for this histogram are saved."""
+        times['total'] = time.time() - t0
+        for key, val in times.items():
+            self.save_stats.record(key, val)
+        self.save_times = times
+        self.multirun_saved.emit(hist_id, times)
+
+    def wait_for_saves(self):
+        """Block until all of the multirun fits have finished and their 
+        files have been written."""
+        for fits in [h[-1] for h in self.fitting]:
+            for fit in fits: 
+                try: fit[-1].result()
+                except Exception: pass # save_fits reports the error
+        self.save_fits()
+        for f in self.pending: f.result()
+        self.pending = []
             
     def send_results(self, measure_prefix, hist_id, mw):
-        """Send a TCP message to influxdb with the data from the most recent measure.
+        """Queue the data from the most recent measure to be sent to influxdb.
+        The shared writer batches points and sends them in the background.
         measure_prefix -- label for the subdirectory results are saved in
         hist_id        -- unique ID for histogram
         mw             -- imageanalysis window storing results"""
         datastr = 'Experiment,SOURCE=imageanalysis,name="%s" measure=%s,'%(mw.objectName(), measure_prefix)
         datastr +=','.join(['%s=%s'%(key.replace(' ', '_'), val) for key, val in mw.histo_handler.temp_vals.items()
             if mw.histo_handler.types[key] == float]) 
-        datastr += ' ' + str(int(time.time()*1e9)) + '\n'
-        
-        msg = "POST /write?db=arduino HTTP/1.1\nHost: 129.234.190.191\n"
-        msg += "User-Agent: PyDex\nConnection: close\n"
-        msg += "Content-Type: application/x-www-form-urlencoded\n"
-        msg += "Content-Length: %s\n\n"%len(datastr)
-        msg += datastr
+        datastr += ' ' + str(int(time.time()*1e9))
         try:
-            _ = simple_msg('129.234.190.191', 8086, msg)
+            get_writer().add_point(datastr)
         except Exception as e:
-            error("Settings window failed to send results to influxdb\n"+str(e))
+            error("Settings window failed to queue results for influxdb\n"+str(e))
 
                 
     def init_analysers_multirun(self, results_path, measure_prefix, appending=False, *args, **kwargs):
@@ -688,7 +827,7 @@ class settings_window(QMainWindow):
 
     def load_image(self, trigger=None):
         """Prompt the user to select an image file to display."""
-        fname = self.try_browse(file_type='Images (*.asc);;all (*)')
+        fname = self.try_browse(file_type='Images (*.asc *.pdx);;all (*)')
         if fname:  # avoid crash if the user cancelled
             pic_width, pic_height = self.stats['pic_width'], self.stats['pic_height']
             try:
@@ -702,29 +841,29 @@ class settings_window(QMainWindow):
                 self.update_im(np.arange(pic_width*pic_height).reshape((pic_width, pic_height))+self.stats['bias'])
                 error("Settings window failed to load image file: "+fname+'\n'+str(e))
     
-    def load_images(self):
-        """Prompt the user to choose a selection of image files."""
+    def load_images(self, acc=None):
+        """Prompt the user to choose a selection of image files.
+        acc -- add the images to this pixel_stats instead of returning them."""
         im_list = []
         file_list = self.try_browse(title='Select Files', 
-                file_type='Images(*.asc);;all (*)', 
+                file_type='Images(*.asc *.pdx);;all (*)', 
                 open_func=QFileDialog.getOpenFileNames,
                 defaultpath=self.image_storage_path)
-        for fname in file_list:
-            try:
-                im_list.append(self.mw[0].image_handler.load_full_im(fname))
-            except Exception as e: # probably file size was wrong
-                error("Settings window failed to load image file: "+fname+'\n'+str(e))
+        for fname, im in iter_images(file_list, self.mw[0].image_handler.load_full_im):
+            if isinstance(im, Exception): # probably file size was wrong
+                error("Settings window failed to load image file: "+fname+'\n'+str(im))
+            elif acc is not None: acc.add(im)
+            else: im_list.append(im)
         return im_list
                 
     def make_ave_im(self):
         """Make an average image from the files selected by the user and 
-        display it."""
+        display it. The images are added to the average as they're loaded."""
+        ps = pixel_stats()
         if self.sender().text() == 'From Files':
-            im_list = self.load_images()
-        else: im_list = []
-        if np.size(np.shape(im_list)) == 3:
-            aveim = np.mean(im_list, axis=0)
-            self.update_im(aveim)
+            self.load_images(acc=ps)
+        if ps.n:
+            self.update_im(ps.mean())
             return 1
 
     def load_settings(self, toggle=True, stats={}, fname='.\\imageanalysis\\default.config'):
@@ -781,6 +920,7 @@ class settings_window(QMainWindow):
                     open_func=QFileDialog.getSaveFileName)
         else: fpath = 'notsaving'
         if fpath: # don't do anything if the user cancels
+            if self.pool is not None: self.pool.sync()
             fdir = os.path.dirname(fpath)
             fname = os.path.basename(fpath)
             for i in range(self._a): # fit main windows first
@@ -811,16 +951,12 @@ class settings_window(QMainWindow):
 
     def load_im_size(self):
         """Get the user to select an image file and then use this to get the image size"""
-        file_name = self.try_browse(file_type='Images (*.asc);;all (*)', defaultpath=self.image_storage_path)
+        file_name = self.try_browse(file_type='Images (*.asc *.pdx);;all (*)', defaultpath=self.image_storage_path)
         if file_name:
-            shape = np.genfromtxt(file_name, delimiter=' ').shape
+            width, height = image_shape(file_name)
             # update loaded value - changing the text edit triggers pic_size_text_edit()
-            try: 
-                self.pic_width_edit.setText(str(shape[1] - 1))
-                self.pic_height_edit.setText(str(shape[0]))
-            except IndexError: 
-                self.pic_width_edit.setText(str(shape[0] - 1))
-                self.pic_height_edit.setText('1')
+            self.pic_width_edit.setText(str(width))
+            self.pic_height_edit.setText(str(height))
 
     def check_reset(self):
         """Ask the user if they would like to reset the current data storfed"""
@@ -934,6 +1070,7 @@ class settings_window(QMainWindow):
         for mw in self.mw[self._a:]:
             mw.deleteLater() # remove unused windows
         self.mw = self.mw[:self._a]
+        if self.pool is not None: self.pool.assign(self.mw)
         self.mw_names = ['ROI' + str(i//self._m) + '.Im' + str(i%self._m) + '.' for i in range(self._a)]
         self.create_rois() # display ROIs on image
         self.reset_table() # display (xc, yc, size) of ROIs in table
@@ -1029,6 +1166,10 @@ class settings_window(QMainWindow):
             if reply == QMessageBox.Yes:
                 self.save_hist_data()   # save current state
             for mw in self.mw + self.rw + self.cw: mw.close()
+            self.set_workers(False)
+            self.wait_for_saves()
+            self.writer.shutdown()
+            self.fit_pool.shutdown()
             event.accept()
         else:
             event.ignore()        
@@ -36,6 +36,8 @@ from saveimages.imsaver import event_handler # saves images
 sys.path.append('./networking')
 from networking.runid import runnum # synchronises run number, sends signals
 from networking.networker import TCPENUM, reset_slot # enum for DExTer produce-consumer loop cases
+from networking.influx import close_writer # background influxdb export
+from networking.linkstats import StatsServer, links # TCP latency and rate stats
 sys.path.append('./sequences')
 from sequences.sequencePreviewer import Previewer
 sys.path.append('./dds')
@@ -144,6 +146,12 @@ class Master(QMainWindow):
             check = self.rn.cam.ApplySettingsFromConfig(self.stats['CameraConfig'])
         
         self.rn.server.dxnum.connect(self.Dx_label.setText) # synchronise run number
+        try: # serve TCP link stats as JSON at http://localhost:8630/
+            self.stats_server = StatsServer(port=8630)
+            self.stats_server.start()
+        except OSError as e:
+            self.stats_server = None
+            warning('Could not start TCP stats server on port 8630.\n'+str(e))
         self.rn.server.textin.connect(self.respond) # read TCP messages
         self.status_label.setText('Initialising...')
         QTimer.singleShot(0, self.idle_state) # takes a while for other windows to load
@@ -289,6 +297,16 @@ class Master(QMainWindow):
         self.rearr_rois.toggled[bool].connect(self.set_rearranging)
         sync_menu.addAction(self.rearr_rois) 
 
+        self.crop_rois = QAction('Crop camera to ROIs', sync_menu, 
+                checkable=True, checked=False)
+        self.crop_rois.triggered[bool].connect(self.crop_to_rois)
+        sync_menu.addAction(self.crop_rois) 
+
+        self.bus_toggle = QAction('Share frames in memory', sync_menu, 
+                checkable=True, checked=False)
+        self.bus_toggle.triggered[bool].connect(self.set_frame_bus)
+        sync_menu.addAction(self.bus_toggle) 
+
         reset_date = QAction('Reset date', sync_menu, checkable=False)
         reset_date.triggered.connect(self.reset_dates)
         sync_menu.addAction(reset_date)
@@ -378,7 +396,9 @@ class Master(QMainWindow):
         text=self.stats['SaveConfig'])
             if text and ok:
                 reset_slot(self.rn.im_save, self.rn.sv.add_item, False)
+                self.rn.sv.close() # finishes saving queued images
                 self.rn.sv = event_handler(text)
+                self.rn.sv.start()
                 if self.rn.sv.image_storage_path:
                     self.status_label.setText('Image Saver config: '+text)
                     reset_slot(self.rn.im_save, self.rn.sv.add_item, True)
@@ -407,6 +427,7 @@ class Master(QMainWindow):
                     info += '...\n'
             else:
                 info += "TCP server stopped."
+            info += '\n' + ''.join(l.text() for l in links.values())
             reply = QMessageBox.question(self, 'TCP Server Status', 
                 info+"\nDo you want to restart the server?", 
                 QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
@@ -444,8 +465,22 @@ class Master(QMainWindow):
         self.rn.rearranging = toggle
         reset_slot(self.rn.check.rh.rearrange, self.rn.check.get_rearrange, toggle)
         reset_slot(self.rn.check.rearr_msg, self.rn.send_rearr_msg, toggle)
+        self.rn.check.rh.fast_send = self.rn.occ.send if toggle else None # bypass signals if connected
         self.rn.set_m(self.rn.sw._m)
 
+    def crop_to_rois(self, toggle=True):
+        """Only read out the part of the camera sensor that covers the ROIs
+        so that the readout is faster, or go back to the full sensor."""
+        if self.rn.crop_to_rois(toggle) is False:
+            self.crop_rois.setChecked(not toggle)
+        else: self.status_label.setText('Camera window: (%s, %s, %s, %s)'%self.rn.cam.SensorWindow())
+
+    def set_frame_bus(self, toggle=True):
+        """Open or close the shared memory frame bus that other processes
+        can read the images from."""
+        if not self.rn.share_frames(toggle):
+            self.bus_toggle.setChecked(False)
+
     def browse_sequence(self, toggle=True):
         """Open the file browser to search for a sequence file, then insert
         the file path into the DExTer sequence file line edit
@@ -468,6 +503,9 @@ class Master(QMainWindow):
         """Close the camera and then start it up again with the new setting.
         Sometimes after being in crop mode the camera fails to reset the 
         ROI and so must be closed and restarted."""
+        if self.crop_rois.isChecked(): # move the ROIs back to the full sensor
+            self.crop_rois.setChecked(False)
+            self.rn.crop_to_rois(False)
         try:
             self.rn.cam.SafeShutdown()
         except: warning('Andor camera safe shutdown failed') # probably not initialised
@@ -661,7 +699,9 @@ class Master(QMainWindow):
             if self.date_reset: # reset dates at end of multirun
                 self.reset_dates()
         elif 'AWG ' in msg[:10]: # send command to AWG to set new data
-            self.rn.awgtcp.priority_messages([(self.rn._n, msg.replace('AWG ', '').split('||||||||')[0])])
+            cmd = msg.replace('AWG ', '').split('||||||||')[0]
+            if not self.rn.send_awg_cmd(cmd): # binary channel if connected, otherwise text
+                self.rn.awgtcp.priority_messages([(self.rn._n, cmd)])
         elif 'DDS ' in msg[:10]: # send command to DDS to set new data
             self.rn.ddstcp.priority_messages([(self.rn._n, msg.replace('DDS ', '').split('||||||||')[0])])
         elif 'SLM ' in msg[:10]: # send command to SLM to set new data
@@ -759,8 +799,14 @@ class Master(QMainWindow):
             # self.rn.check.send_rois() # give ROIs from atom checker to image analysis
             for obj in self.rn.sw.mw + self.rn.sw.rw + [self.rn.sw, self.rn.seq, 
                     self.rn.server, self.rn.trigger, self.rn.monitor, self.rn.awgtcp, 
-                    self.rn.check, self.mon_win, self.dds_win]:
+                    self.rn.awgcmd, self.rn.occ, self.rn.check, self.mon_win, self.dds_win]:
                 obj.close()
+            self.rn.sv.close() # save the images that are still queued
+            self.rn.share_frames(False)
+            self.rn.sv.wait(10000)
+            close_writer() # send any results still queued for influxdb
+            if self.stats_server: self.stats_server.close()
+            for l in links.values(): l.save() # keep the TCP stats from this session
             self.save_state('./state')
             event.accept()
         
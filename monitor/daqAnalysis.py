@@ -18,7 +18,7 @@ except ImportError:
     from PyQt5.QtCore import pyqtSignal, QThread
 from collections import OrderedDict
 from strtypes import strlist, listlist, BOOL, error, warning, info
-from networking.client import simple_msg
+from networking.influx import get_writer
 import sys
 
 def channel_stats(text):
@@ -51,10 +51,6 @@ class daqSlice:
         self.stats = OrderedDict([(chan, OrderedDict([
             ('mean',[]), ('stdv',[])])) for chan in channels.keys()])
 
-        self.blurbstr = "POST /write?db=arduino HTTP/1.1\nHost: 129.234.190.191\n"
-        self.blurbstr += "User-Agent: PyDex\nConnection: close\n"
-        self.blurbstr += "Content-Type: application/x-www-form-urlencoded\n"
-        self.blurbstr += "Content-Length: %s\n\n"
         self.datastr = 'Experiment,SOURCE=DAQmonitor,name="%s",channel0="%s" '%(name, list(self.channels.keys())[0])
                 
     def process(self, data, ind, send_data=False):
@@ -69,13 +65,12 @@ class daqSlice:
                     self.stats[chan]['mean'].append(np.mean(row[self.inds]))
                     self.stats[chan]['stdv'].append(np.std(row[self.inds], ddof=1))
                     if send_data:
-                        try: # send results via TCP to influxdb
+                        try: # queue results to be sent to influxdb in the background
                             datastr = self.datastr + "mean_V=%.6f,stdv_V=%.6f "%(self.stats[chan]['mean'][-1], self.stats[chan]['stdv'][-1])
-                            datastr += str(int(time.time()*1e9)) + '\n'
-                            msg = self.blurbstr%len(datastr) + datastr
-                            _ = simple_msg('129.234.190.191', 8086, msg)
+                            datastr += str(int(time.time()*1e9))
+                            get_writer().add_point(datastr)
                         except Exception as e:
-                            error("DAQ analysis failed to send results to influxdb\n"+str(e))
+                            error("DAQ analysis failed to queue results for influxdb\n"+str(e))
                 except IndexError as e:
                     error('Data wrong shape to take slice at %s.\n'%i + str(e))
             else: # just to keep them all the same length
@@ -0,0 +1,333 @@
+"""PyDex - binary command channel for the AWG
+
+ - A typed, versioned schema for AWG commands so that the AWG doesn't
+ have to eval strings. Each frame is a fixed header followed by a payload:
+    magic (2 bytes) | version (uint8) | command (uint8) | sequence # (uint32)
+    | payload length (uint32) | payload
+ - set_data and set_step take a whole table in one command
+ - rearrange sends the occupancy bit-packed
+ - AWGCommandLink (PyDex side) keeps a connection open and sends commands
+ - AWGCommandServer (AWG side) decodes the commands and calls the handlers
+ on its own thread. Every command is acknowledged with its status and how
+ long it waited and took to execute, so that a bad command returns an
+ error instead of stopping the AWG program.
+"""
+import json
+import time
+import socket
+import struct
+import sys
+from collections import OrderedDict
+from PyQt5.QtCore import QThread, pyqtSignal
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info
+
+VERSION = 1
+MAGIC   = b'AW'
+HEADER  = struct.Struct('!2sBBII') # magic, version, command, sequence #, payload length
+
+AWGCMD = OrderedDict([ # enum for AWG commands
+('ack', 0),
+('load', 1),        # path to load AWG data from
+('save', 2),        # path to save AWG data to
+('set_data', 3),    # table of [channel, segment, parameter, value, list index]
+('set_step', 4),    # table of [step, segment, # loops, next step, condition]
+('rearrange', 5),   # occupancy, e.g. '01101'
+('start_awg', 6),
+('stop_awg', 7),
+('reset_awg', 8),   # list of channels to activate
+('rearr_on', 9),    # path to rearrangement config file, can be empty
+('rearr_off', 10),
+('rload', 11),      # path to load AWG data from, replacing the original file
+('auto_plot', 12),  # bool
+])
+CMDNAME = {val: key for key, val in AWGCMD.items()}
+PATHCMDS = ['load', 'save', 'rearr_on', 'rload'] # commands that just take a string
+
+ACK = struct.Struct('!IBBdd') # sequence # acked, command, status, queue time, execution time
+DATA_ENTRY = struct.Struct('!BHB') # channel, segment, length of parameter name
+STEP_ENTRY = struct.Struct('!IIIII')
+
+####    ####    ####    ####
+
+def pack_str(text, fmt='!I'):
+    b = bytes(text, 'utf-8')
+    return struct.pack(fmt, len(b)) + b
+
+def unpack_str(buf, i, fmt='!I'):
+    n = struct.unpack_from(fmt, buf, i)[0]
+    i += struct.calcsize(fmt)
+    return str(buf[i:i+n], 'utf-8'), i + n
+
+def pack_occupancy(occ):
+    """Bit-pack an occupancy string '0110...' into # bits (uint16) + bytes.
+    The first ROI is the most significant bit of the first byte."""
+    n = len(occ)
+    val = int(occ, 2) << (-n % 8) if n else 0
+    return struct.pack('!H', n) + val.to_bytes((n + 7)//8, 'big')
+
+def unpack_occupancy(buf, i=0):
+    """Inverse of pack_occupancy, returns the occupancy string and next index."""
+    n = struct.unpack_from('!H', buf, i)[0]
+    nb = (n + 7)//8
+    val = int.from_bytes(buf[i+2:i+2+nb], 'big') >> (-n % 8)
+    return format(val, '0%sb'%n) if n else '', i + 2 + nb
+
+def pack_value(val):
+    """Pack a set_data value with a tag for its type, so that it arrives
+    with the same type as the text commands would give after eval:
+    'i' int, 'd' float, or 'j' JSON for anything else (lists, bools, str)."""
+    if isinstance(val, int) and not isinstance(val, bool):
+        return b'i' + struct.pack('!q', val)
+    elif isinstance(val, float):
+        return b'd' + struct.pack('!d', val)
+    return b'j' + pack_str(json.dumps(val))
+
+def encode_payload(cmd, arg=None):
+    """Encode the argument for the command name cmd into bytes."""
+    if cmd in PATHCMDS:
+        return bytes(arg if arg else '', 'utf-8')
+    elif cmd == 'set_data': # [[channel, segment, parameter, value, list index], ...]
+        out = [struct.pack('!H', len(arg))]
+        for ch, seg, key, val, *ind in arg:
+            k = bytes(key, 'utf-8')
+            out.append(DATA_ENTRY.pack(int(ch), int(seg), len(k)) + k)
+            out.append(pack_value(val))
+            out.append(struct.pack('!i', int(ind[0]) if ind else 0))
+        return b''.join(out)
+    elif cmd == 'set_step': # [[step, segment, # loops, next step, condition], ...]
+        return struct.pack('!H', len(arg)) + b''.join(
+            STEP_ENTRY.pack(*map(int, row)) for row in arg)
+    elif cmd == 'rearrange':
+        return pack_occupancy(arg)
+    elif cmd == 'reset_awg':
+        return struct.pack('!B', len(arg)) + bytes(map(int, arg))
+    elif cmd == 'auto_plot':
+        return struct.pack('!?', bool(arg))
+    return b''
+
+def decode_payload(cmd, buf):
+    """Decode the payload bytes of the command name cmd. Raises ValueError,
+    struct.error, or IndexError if the payload is malformed."""
+    if cmd in PATHCMDS:
+        return str(buf, 'utf-8')
+    elif cmd == 'set_data':
+        n, i, rows = struct.unpack_from('!H', buf)[0], 2, []
+        for j in range(n):
+            ch, seg, nk = DATA_ENTRY.unpack_from(buf, i)
+            i += DATA_ENTRY.size
+            key = str(buf[i:i+nk], 'utf-8')
+            tag, i = buf[i+nk:i+nk+1], i + nk + 1
+            if tag == b'd':
+                val = struct.unpack_from('!d', buf, i)[0]
+                i += 8
+            elif tag == b'i':
+                val = struct.unpack_from('!q', buf, i)[0]
+                i += 8
+            elif tag == b'j':
+                txt, i = unpack_str(buf, i)
+                val = json.loads(txt)
+            else: raise ValueError('Unknown value type %s in set_data entry %s'%(tag, j))
+            ind = struct.unpack_from('!i', buf, i)[0]
+            i += 4
+            rows.append([ch, seg, key, val, ind])
+        return rows
+    elif cmd == 'set_step':
+        n = struct.unpack_from('!H', buf)[0]
+        return [list(STEP_ENTRY.unpack_from(buf, 2 + j*STEP_ENTRY.size)) for j in range(n)]
+    elif cmd == 'rearrange':
+        return unpack_occupancy(buf)[0]
+    elif cmd == 'reset_awg':
+        return list(buf[1:1+buf[0]])
+    elif cmd == 'auto_plot':
+        return struct.unpack('!?', buf[:1])[0]
+    return None
+
+def encode(cmd, arg=None, seq=0):
+    """Return the frame for command name cmd with argument arg."""
+    payload = encode_payload(cmd, arg)
+    return HEADER.pack(MAGIC, VERSION, AWGCMD[cmd], seq, len(payload)) + payload
+
+def encode_ack(seq, cmd, ok, t_queue, t_exec, msg=''):
+    payload = ACK.pack(seq, cmd, 0 if ok else 1, t_queue, t_exec) + bytes(msg[:1000], 'utf-8')
+    return HEADER.pack(MAGIC, VERSION, AWGCMD['ack'], seq, len(payload)) + payload
+
+def decode_ack(buf):
+    """Return sequence #, command name, success, queue time, execution time, message"""
+    seq, cmd, status, tq, tx = ACK.unpack_from(buf)
+    return seq, CMDNAME.get(cmd, str(cmd)), status == 0, tq, tx, str(buf[ACK.size:], 'utf-8')
+
+def recv_frame(sock):
+    """Receive one frame, returns (version, command #, sequence #, payload).
+    Raises ConnectionResetError when the other end closes, ValueError
+    if the header is invalid."""
+    head = recv_all(sock, HEADER.size)
+    magic, version, cmd, seq, size = HEADER.unpack(head)
+    if magic != MAGIC:
+        raise ValueError('Invalid AWG command header %s'%head)
+    return version, cmd, seq, recv_all(sock, size)
+
+def recv_all(sock, size):
+    """Receive exactly size bytes from the socket."""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk: raise ConnectionResetError('connection closed')
+        data += chunk
+    return data
+
+####    ####    ####    ####
+
+class AWGCommandLink(QThread):
+    """PyDex side of the AWG command channel. Keeps a TCP connection open
+    to the AWG, sends commands, and receives the acknowledgements.
+    host -- address of the computer running the AWG.
+    port -- the port the AWGCommandServer listens on."""
+    acked = pyqtSignal(int, str, bool, str) # sequence #, command, success, message
+    stop  = False
+
+    def __init__(self, host='129.234.190.235', port=8628, name='AWG cmd'):
+        super().__init__()
+        self._name = name
+        self.server_address = (host, port)
+        self.sock = None
+        self.seq  = 0  # sequence # of the last command sent
+        self.sent = {} # time each unacknowledged command was sent
+        self.times = OrderedDict() # round trip, queue, and execution time of the last command
+
+    def connected(self):
+        return self.sock is not None
+
+    def connect_awg(self, timeout=1):
+        """Try to open the connection, return whether it succeeded."""
+        try:
+            self.sock = socket.create_connection(self.server_address, timeout=timeout)
+            self.sock.settimeout(None)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            self.sock = None
+        return self.sock is not None
+
+    def send(self, cmd, arg=None):
+        """Send a command to the AWG. Returns the sequence # to match with
+        the ack, or 0 if there's no connection."""
+        if self.sock is None: return 0
+        self.seq += 1
+        try:
+            self.sent[self.seq] = time.time()
+            self.sock.sendall(encode(cmd, arg, self.seq))
+            return self.seq
+        except OSError as e:
+            self.sent.pop(self.seq, None)
+            warning('%s: failed to send %s command.\n'%(self._name, cmd)+str(e))
+            self.disconnect()
+            return 0
+
+    def disconnect(self):
+        if self.sock is not None:
+            try: self.sock.close()
+            except OSError: pass
+            self.sock = None
+
+    def run(self):
+        """Receive acks, reconnecting if the connection drops."""
+        while not self.stop:
+            if self.sock is None:
+                if not self.connect_awg():
+                    time.sleep(1)
+                    continue
+            try:
+                version, cmd, seq, buf = recv_frame(self.sock)
+                if cmd != AWGCMD['ack']: continue
+                seq, name, ok, tq, tx, msg = decode_ack(buf)
+                t0 = self.sent.pop(seq, time.time())
+                self.times = OrderedDict([('command', name), ('round trip', time.time() - t0),
+                    ('queue', tq), ('execution', tx)])
+                if not ok: warning('AWG failed to %s: %s'%(name, msg))
+                self.acked.emit(seq, name, ok, msg)
+            except (OSError, ValueError, struct.error) as e:
+                if not self.stop:
+                    warning('%s: connection to AWG lost.\n'%self._name+str(e))
+                self.disconnect()
+
+    def close(self, args=None):
+        self.stop = True
+        self.disconnect()
+
+####    ####    ####    ####
+
+class AWGCommandServer(QThread):
+    """AWG side of the command channel. Accepts a connection from PyDex,
+    then decodes each command and calls the handler registered for it
+    on this thread, replying with an ack. Exceptions in the handlers are
+    caught and returned in the ack.
+    handlers -- dict of {command name: function(arg) -> str status}
+    host     -- '' to accept connections from any address.
+    port     -- the port to listen on."""
+    status = pyqtSignal(str) # message to display
+    stop   = False
+
+    def __init__(self, handlers={}, host='', port=8628):
+        super().__init__()
+        self.handlers = dict(handlers)
+        self.server_address = (host, port)
+        self.conn = None # the current connection
+        self.times = OrderedDict() # queue and execution time of the last command
+
+    def dispatch(self, cmd, seq, buf, t_recv):
+        """Decode and run a command, returning the ack frame."""
+        name = CMDNAME.get(cmd, str(cmd))
+        t0 = time.time()
+        try:
+            if name not in self.handlers:
+                raise KeyError('No handler for command %s'%name)
+            msg = self.handlers[name](decode_payload(name, buf))
+            ok = True
+            if msg: self.status.emit(msg)
+        except Exception as e:
+            ok, msg = False, '%s: %s'%(type(e).__name__, e)
+            self.status.emit('Failed to %s: %s'%(name, msg))
+        t1 = time.time()
+        self.times = OrderedDict([('command', name), ('queue', t0 - t_recv), ('execution', t1 - t0)])
+        return encode_ack(seq, cmd, ok, t0 - t_recv, t1 - t0, msg if msg else '')
+
+    def serve(self, conn):
+        """Respond to commands until the connection closes."""
+        while not self.stop:
+            version, cmd, seq, buf = recv_frame(conn)
+            t_recv = time.time()
+            if version != VERSION:
+                ack = encode_ack(seq, cmd, False, 0, 0,
+                    'Unsupported command version %s, expected %s'%(version, VERSION))
+            else: ack = self.dispatch(cmd, seq, buf, t_recv)
+            conn.sendall(ack)
+
+    def run(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            try:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                s.bind(self.server_address)
+                s.listen(1)
+                s.settimeout(0.5) # so that stop is checked
+            except OSError as e:
+                error('Failed to start AWG command server at address: ' +
+                    ', '.join(map(str, self.server_address)) + '\n' + str(e))
+                return
+            while not self.stop:
+                try: conn, addr = s.accept()
+                except socket.timeout: continue
+                with conn:
+                    self.conn = conn
+                    conn.settimeout(None)
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.status.emit('Command channel connected to %s'%addr[0])
+                    try: self.serve(conn)
+                    except (OSError, ValueError, struct.error) as e:
+                        self.status.emit('Command channel disconnected: %s'%e)
+                self.conn = None
+
+    def close(self, args=None):
+        self.stop = True
+        if self.conn is not None: # unblock the receive
+            try: self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
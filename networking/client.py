@@ -13,6 +13,7 @@ import time
 if '..' not in sys.path: sys.path.append('..')
 from mythread import reset_slot, enco
 from strtypes import error, warning, info
+from networking.linkstats import get_link
 
 def simple_msg(host, port, msg, encoding=enco, recv_buff_size=-1):
     """Open a socket and send a TCP message, then receive back a message."""
@@ -40,6 +41,7 @@ class PyClient(QThread):
         self._name = name
         self.server_address = (host, port)
         self.__mq = [] # message queue
+        self.stats = get_link(name if name else 'client %s'%port) # latencies, rates, queue depth
         self.app = QApplication.instance()
         self.finished.connect(self.reset_stop) # allow it to start again next time
         self.pause = pause
@@ -52,24 +54,29 @@ class PyClient(QThread):
         enum and message length are sent as unsigned long int (4 bytes)."""
         self.__mq.append([struct.pack("!L", int(enum)), # enum 
                                 struct.pack("!L", len(bytes(text, encoding))), # msg length 
-                                bytes(text, encoding)]) # message
+                                bytes(text, encoding), # message
+                                time.time()]) # time queued
+        self.stats.set_queue_depth(len(self.__mq))
                             
     def priority_messages(self, message_list, encoding=enco):
         """Add messages to the start of the message queue.
         message_list - list of [enum (int), text(str)] pairs."""
+        t = time.time()
         self.__mq = [[struct.pack("!L", int(enum)), # enum 
                             struct.pack("!L", len(bytes(text, encoding))), # msg length 
-                            bytes(text, encoding)] for enum, text in message_list] + self.__mq
+                            bytes(text, encoding), t] for enum, text in message_list] + self.__mq
+        self.stats.set_queue_depth(len(self.__mq))
     
     def get_queue(self):
         """Return a list of the queued messages."""
         return [(str(int.from_bytes(enum, 'big')), int.from_bytes(tlen, 'big'), 
-                str(text, enco)) for enum, tlen, text in self.__mq]
+                str(text, enco)) for enum, tlen, text, t in self.__mq]
                         
     def clear_queue(self):
         """Remove all of the messages from the queue."""
         reset_slot(self.textin, self.clear_queue, False) # only trigger clear_queue once
         self.__mq = []
+        self.stats.set_queue_depth(0)
     
     def echo(self, encoding=enco):
         """Receive and echo back 3 messages:
@@ -78,25 +85,37 @@ class PyClient(QThread):
         3) a message string"""
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             try:
+                t0 = time.time()
                 sock.connect(self.server_address) # connect to server
+                t1 = time.time()
                 # sock.setblocking(1) # don't continue until msg is transferred
                 # receive message
                 dxn = sock.recv(4) # 4 bytes
                 bytesize = sock.recv(4)# 4 bytes
                 size = int.from_bytes(bytesize, 'big')
                 msg = sock.recv(size)
+                t2 = time.time()
+                self.stats.record('connect', t1 - t0)
+                self.stats.record('remote', t2 - t1) # waiting for the server to send
+                self.stats.received(8 + size)
                 self.dxnum.emit(str(int.from_bytes(dxn, 'big')))
                 self.textin.emit(str(msg, encoding))
                 # send back
                 if self.pause: time.sleep(self.pause)
                 if len(self.__mq):
                     try:
-                        dxn, bytesize, msg = self.__mq.pop(0)
+                        dxn, bytesize, msg, tq = self.__mq.pop(0)
+                        self.stats.set_queue_depth(len(self.__mq))
+                        self.stats.record('queue', time.time() - tq)
                     except IndexError as e: 
                         error('Server %s msg queue was emptied before msg could be sent.\n'%self._name+str(e))
+                t3 = time.time()
                 sock.sendall(dxn)
                 sock.sendall(bytesize)
                 sock.sendall(msg)
+                self.stats.record('send', time.time() - t3)
+                self.stats.sent(8 + len(msg))
+                self.stats.check_rollover()
             except (ConnectionRefusedError, TimeoutError) as e:
                 pass
             except (ConnectionResetError, ConnectionAbortedError) as e:
@@ -0,0 +1,208 @@
+"""PyDex - DExTer emulator
+
+ - Stand in for DExTer so that PyDex can be tested without the lab
+ - Connects to the PyDex server (port 8620) as a client and speaks the same
+ protocol: receive [enum, length, text], reply [run number, length, text]
+ - TCP read messages are echoed back so that Master.respond sees 'start
+ acquisition', 'finished run', 'multirun run', 'end multirun', etc.
+ - Run sequence messages take a configurable duration (with jitter) and
+ increment the run number. Optionally trigger a camera during the run.
+ - Keeps timing stats to find the maximum sustainable rate of runs.
+ Usage: python emulator.py [host] [port] [duration (s)] [jitter (s)]
+ Or, from inside PyDex:
+    em = DExTerEmulator(duration=0.1, camera=master.rn.cam)
+    em.start()
+    queue_runs(master.rn.server, 100)
+"""
+import sys
+import time
+import random
+import socket
+import struct
+import threading
+if '..' not in sys.path: sys.path.append('..')
+from mythread import enco
+from strtypes import error, warning, info
+from networker import TCPENUM
+
+ENUMTCP = {val: key for key, val in TCPENUM.items()} # look up name from enum
+
+def queue_runs(server, nruns=100):
+    """Queue up nruns single runs on a PyDex server. Master.respond puts the
+    messages for each run at the front of the queue, so the runs follow
+    one after another as fast as PyDex and DExTer allow."""
+    for i in range(nruns):
+        server.add_message(TCPENUM['TCP read'], 'start acquisition\n'+'0'*2000)
+
+def recv_all(sock, size):
+    """Receive exactly size bytes from the socket."""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk: raise ConnectionResetError('connection closed after %s/%s bytes'%(len(data), size))
+        data += chunk
+    return data
+
+class DExTerEmulator(threading.Thread):
+    """Pretend to be DExTer in python mode. Repeatedly connect to the PyDex
+    server, receive a command, act on it, and send back the run number and
+    a message. Doesn't need a Qt event loop, so it can run headless in its
+    own process.
+    Keyword arguments:
+    host     -- address of the PyDex server.
+    port     -- port of the PyDex server, 8620 is DExTer's.
+    n        -- the initial run number.
+    duration -- time (s) taken to run a sequence.
+    jitter   -- s.d. (s) of the gaussian noise added to the duration.
+    nims     -- number of images triggered per run.
+    camera   -- optional camera to drive during a run: either an object with
+        an AcquireEnd signal (e.g. cameraHandler.camera) or a function that
+        takes the image array. A camera(simulate=True) is sent triggers.
+    im_shape -- (width, height) of simulated images.
+    pause    -- time (s) to wait between connection attempts."""
+    def __init__(self, host='localhost', port=8620, n=0, duration=0.5,
+            jitter=0.0, nims=1, camera=None, im_shape=(32,32), pause=0.01):
+        super().__init__(daemon=True)
+        self.server_address = (host, port)
+        self._n = n
+        self.duration = duration
+        self.jitter = jitter
+        self.nims = nims
+        self.camera = camera
+        self.im_shape = im_shape
+        self.pause = pause
+        self.seq_txt = '' # last sequence loaded from a string
+        self.stop = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Empty the counters for messages, runs, and timings."""
+        self.t0 = time.time()
+        self.stats = {'messages':0, 'runs':0, 'bytes in':0, 'bytes out':0,
+            'images':0, 'run time':0.0, 'idle time':0.0, 'max idle':0.0}
+        self.counts = {} # number of messages per enum
+        self._t_reply = 0 # time the last reply was sent
+
+    def get_stats(self):
+        """Return the counters with the elapsed time and the run rate. The idle
+        time is spent waiting for PyDex between replies: this is PyDex's
+        overhead, which limits the rate of runs."""
+        s = dict(self.stats)
+        s['elapsed'] = time.time() - self.t0
+        s['runs/s'] = s['runs'] / s['elapsed'] if s['elapsed'] else 0
+        s['mean idle'] = s['idle time'] / s['messages'] if s['messages'] else 0
+        s['enums'] = dict(self.counts)
+        return s
+
+    def print_stats(self):
+        s = self.get_stats()
+        info('DExTer emulator: %s runs in %.3g s = %.3g runs/s, %s images. '%(
+            s['runs'], s['elapsed'], s['runs/s'], s['images']) +
+            'Idle waiting for PyDex: mean %.3g ms, max %.3g ms'%(
+            s['mean idle']*1e3, s['max idle']*1e3))
+
+    #### #### simulated hardware #### ####
+
+    def make_image(self):
+        """Make a simulated camera image: a noisy background with atoms
+        present at random in a few spots."""
+        import numpy as np
+        w, h = self.im_shape
+        im = np.random.normal(1000, 10, (w, h))
+        for x, y in [(w//4, h//2), (w//2, h//2), (3*w//4, h//2)]:
+            if random.random() > 0.5:
+                im[x-1:x+2, y-1:y+2] += 300
+        return im.astype(int)
+
+    def trigger_camera(self):
+        """Send an image to the camera handler as if it was just acquired.
+        A simulated camera is triggered instead, so that the image goes
+        through the camera's acquisition loop."""
+        if getattr(getattr(self.camera, 'AF', None), 'simulated', False):
+            self.camera.AF.SendSoftwareTrigger()
+            self.stats['images'] += 1
+            return
+        im = self.make_image()
+        if hasattr(self.camera, 'AcquireEnd'):
+            self.camera.AcquireEnd.emit(im)
+        else: self.camera(im)
+        self.stats['images'] += 1
+
+    def run_sequence(self):
+        """Wait for the sequence duration, triggering the camera at evenly
+        spaced times during the run. Then the run number increments."""
+        t0 = time.time()
+        dt = max(random.gauss(self.duration, self.jitter), 0) if self.jitter else self.duration
+        if self.camera is not None:
+            for i in range(self.nims):
+                time.sleep(max(t0 + dt*(i+1)/(self.nims+1) - time.time(), 0))
+                self.trigger_camera()
+        time.sleep(max(t0 + dt - time.time(), 0))
+        self.stats['run time'] += time.time() - t0
+        self.stats['runs'] += 1
+        self._n += 1
+
+    def respond(self, enum, text):
+        """Carry out the command and return the text to send back."""
+        case = ENUMTCP.get(enum, str(enum))
+        self.counts[case] = self.counts.get(case, 0) + 1
+        if case == 'Run sequence' or case == 'Multirun run':
+            self.run_sequence()
+            return text
+        elif case == 'TCP read':
+            if 'python mode off' in text:
+                self.stop = True
+            return text
+        elif case == 'TCP load sequence from string':
+            self.seq_txt = text
+            return 'loaded sequence from string'
+        return case + ' done' # other cases only need acknowledging
+
+    #### #### TCP #### ####
+
+    def echo(self, encoding=enco):
+        """Make one connection to the server: receive a message, respond,
+        then send back the run number and the reply."""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.server_address)
+                enum = int.from_bytes(recv_all(sock, 4), 'big')
+                size = int.from_bytes(recv_all(sock, 4), 'big')
+                text = str(recv_all(sock, size), encoding)
+                if self._t_reply:
+                    idle = time.time() - self._t_reply
+                    self.stats['idle time'] += idle
+                    self.stats['max idle'] = max(idle, self.stats['max idle'])
+                self.stats['messages'] += 1
+                self.stats['bytes in'] += 8 + size
+                reply = bytes(self.respond(enum, text), encoding)
+                sock.sendall(struct.pack("!L", self._n) +
+                    struct.pack("!L", len(reply)) + reply)
+                self.stats['bytes out'] += 8 + len(reply)
+                self._t_reply = time.time()
+            except (ConnectionRefusedError, TimeoutError):
+                time.sleep(self.pause) # server isn't running yet
+            except (ConnectionResetError, ConnectionAbortedError) as e:
+                warning('DExTer emulator: server cancelled connection.\n'+str(e))
+
+    def run(self):
+        """Keep responding to the server until stop is set."""
+        self.reset_stats()
+        while not self.stop:
+            self.echo()
+
+    def close(self):
+        self.stop = True
+
+if __name__ == "__main__":
+    args = sys.argv[1:] + [None]*4
+    em = DExTerEmulator(host=args[0] or 'localhost', port=int(args[1] or 8620),
+        duration=float(args[2] or 0.5), jitter=float(args[3] or 0))
+    em.start()
+    try:
+        while em.is_alive():
+            time.sleep(10)
+            em.print_stats()
+    except KeyboardInterrupt:
+        em.close()
+    em.print_stats()
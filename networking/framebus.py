@@ -0,0 +1,373 @@
+"""PyDex - shared memory frame bus
+
+ - Share each camera image through a ring of fixed size frame slots in
+ shared memory, so that consumers (image saving, analysis, atom checking)
+ in this or other processes read the same pixels without copying them or
+ passing them through Qt signals (needs python >= 3.8).
+ - Block layout (little-endian, each section starts on 64 bytes):
+    header:  magic b'PDXB' | # slots | # readers | pixels per slot |
+             dtype code | seq # of the newest frame
+    slots:   seq # | run # | image # | rows | columns | flags | time published
+    readers: process ID | seq # held | last seq # read | # frames missed
+    data:    # slots x pixels per slot
+ - There is one publisher, and it never waits for the readers to finish
+ with a frame. A reader holds at most one frame at a time and the 
+ publisher skips the slots that are held, so there's always a free slot
+ when # slots > # readers. A slow reader misses frames instead of 
+ blocking the camera. Missed frames are counted for each reader.
+ - The number of readers holding a slot is its reference count. The
+ publisher checks the holds and invalidates a slot, and a reader checks
+ the slot and holds its frame, with a lock shared between the processes
+ (an OS lock on a file named after the block). So a frame that is in use
+ is never overwritten. The lock is only held for these few steps, not
+ while the frame is copied in or read.
+ - The flags tell readers what the frame is for, e.g. SAVE for frames 
+ that the image saver should save.
+ - Readers poll the seq # of the newest frame, like the shared memory
+ occupancy channel.
+"""
+import os
+import sys
+import time
+import threading
+import tempfile
+import numpy as np
+try: import fcntl
+except ImportError: fcntl = None # Windows uses msvcrt instead
+try: import msvcrt
+except ImportError: msvcrt = None
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info
+from saveimages.imformat import DTYPES
+from networking.linkstats import get_link
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None # shared memory needs python >= 3.8
+
+MAGIC  = b'PDXB'
+HEAD   = np.dtype([('magic','S4'), ('slots','<u4'), ('readers','<u4'), ('pixels','<u8'),
+    ('dtype','S1'), ('head','<u8')])
+SLOT   = np.dtype([('seq','<u8'), ('run','<i8'), ('imn','<i4'), ('rows','<u4'),
+    ('cols','<u4'), ('flags','<u4'), ('time','<f8')])
+SAVE   = 1 # flag for frames that the image saver should save
+READER = np.dtype([('pid','<i8'), ('held','<u8'), ('last','<u8'), ('dropped','<u8')])
+
+def _pad(n):
+    return (n + 63) // 64 * 64
+
+def layout(slots, readers, pixels, code):
+    """Return the offsets of the sections and the total size of the block."""
+    off_slots = _pad(HEAD.itemsize)
+    off_readers = off_slots + _pad(SLOT.itemsize * slots)
+    off_data = off_readers + _pad(READER.itemsize * readers)
+    return off_slots, off_readers, off_data, off_data + slots*pixels*DTYPES[code].itemsize
+
+def attach(name, create=False, size=0):
+    """Open a shared memory block. Blocks that are only attached aren't
+    registered with the resource tracker (python >= 3.13), which would
+    otherwise remove them when this process exits."""
+    if shared_memory is None:
+        raise OSError('The frame bus needs python >= 3.8 for shared memory')
+    if create: return shared_memory.SharedMemory(name=name, create=True, size=size)
+    try: return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: return shared_memory.SharedMemory(name=name)
+
+class _claim_lock:
+    """Lock used by the publisher and the readers of a frame bus to claim
+    slots. It's an OS lock on a file named after the block, so it works
+    between processes, and each instance has its own file handle so it
+    also works between readers in the same process."""
+    def __init__(self, name):
+        self.f = open(os.path.join(tempfile.gettempdir(), name + '.lock'), 'a+b')
+
+    def __enter__(self):
+        if fcntl is not None: 
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        else: # LK_LOCK retries once a second, so try without waiting instead
+            self.f.seek(0)
+            while True:
+                try: return msvcrt.locking(self.f.fileno(), msvcrt.LK_NBLCK, 1)
+                except OSError: time.sleep(0)
+
+    def __exit__(self, *args):
+        if fcntl is not None: 
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def close(self):
+        self.f.close()
+
+class _views:
+    """Numpy views of the sections of a frame bus block."""
+    def __init__(self, shm, slots=None, readers=None, pixels=None, code=None):
+        self.head = np.ndarray(1, HEAD, buffer=shm.buf)[0:1]
+        if slots is None: # read the layout from the header
+            if bytes(self.head['magic'][0]) != MAGIC:
+                raise ValueError('Shared memory %s is not a frame bus'%shm.name)
+            slots, readers = int(self.head['slots'][0]), int(self.head['readers'][0])
+            pixels, code = int(self.head['pixels'][0]), bytes(self.head['dtype'][0])
+        off_slots, off_readers, off_data, _ = layout(slots, readers, pixels, code)
+        self.slots = np.ndarray(slots, SLOT, buffer=shm.buf, offset=off_slots)
+        self.readers = np.ndarray(readers, READER, buffer=shm.buf, offset=off_readers)
+        self.data = np.ndarray((slots, pixels), DTYPES[code], buffer=shm.buf, offset=off_data)
+        self.nslots, self.nreaders, self.pixels, self.code = slots, readers, pixels, code
+
+    def release(self):
+        """Drop the views so that the shared memory can be closed."""
+        self.head = self.slots = self.readers = self.data = None
+
+class Frame:
+    """An image held in the frame bus. im is a read-only view of the
+    shared memory, valid until the reader releases the frame."""
+    def __init__(self, im, seq, run, imn, t, flags=0):
+        self.im = im
+        self.seq = seq
+        self.run = run
+        self.imn = imn
+        self.time = t
+        self.flags = flags
+
+####    ####    ####    ####
+
+class FrameBus:
+    """Publishing side of the frame bus. Creates the shared memory block.
+    Keyword arguments:
+    name    -- name of the shared memory block that readers attach to.
+    slots   -- number of frames kept. Must be more than the number of readers.
+    readers -- maximum number of readers.
+    pixels  -- maximum number of pixels in an image.
+    code    -- dtype code of the pixels from imformat.DTYPES. Camera
+        images are int32: b'i'"""
+    def __init__(self, name='pydex_frames', slots=16, readers=8, pixels=512*512, code=b'i'):
+        if slots <= readers:
+            raise ValueError('Frame bus needs more slots (%s) than readers (%s)'%(slots, readers))
+        size = layout(slots, readers, pixels, code)[-1]
+        try: self.shm = attach(name, True, size)
+        except FileExistsError: # left over from a program that crashed
+            old = attach(name)
+            old.close()
+            old.unlink()
+            self.shm = attach(name, True, size)
+        self.name = name
+        self.lock = _claim_lock(name)
+        self.v = _views(self.shm, slots, readers, pixels, code)
+        self.v.slots[:] = 0
+        self.v.readers[:] = 0
+        self.v.head[0] = (MAGIC, slots, readers, pixels, code, 0)
+        self.seq  = 0 # seq # of the last frame published
+        self.next = 0 # slot to try first for the next frame
+        self.counts = {'published':0, 'rejected':0}
+        self.stats = get_link('Frame bus')
+
+    def refs(self):
+        """Return the number of readers holding the frame in each slot."""
+        held = self.v.readers['held'][self.v.readers['pid'] != 0]
+        seqs = self.v.slots['seq']
+        return np.sum((held[:,None] == seqs[None,:]) & (seqs[None,:] > 0), axis=0)
+
+    def free_slot(self):
+        """Invalidate and return the next slot that no reader holds."""
+        n = self.v.nslots
+        with self.lock: # readers can't hold a frame while the slots are checked
+            held = self.v.readers['held']
+            for k in range(n):
+                i = (self.next + k) % n
+                s = self.v.slots['seq'][i]
+                if s and np.any(held == s): continue
+                self.v.slots['seq'][i] = 0 # readers can't hold it from now on
+                self.next = (i + 1) % n
+                return i
+        raise RuntimeError('Frame bus has no free slots') # only if there are more readers than slots
+
+    def publish(self, im, run=0, imn=0, flags=0):
+        """Copy the image into a free slot and make it available to the
+        readers. Never waits for the readers to read, only for the lock 
+        while a reader holds a frame. flags is a combination of e.g. SAVE.
+        Returns the seq # of the frame, or 0 if the image doesn't fit in 
+        the slots."""
+        t0 = time.time()
+        im = np.asarray(im)
+        if im.ndim != 2 or im.size > self.v.pixels:
+            self.counts['rejected'] += 1
+            if self.counts['rejected'] % 100 == 1: # don't flood the terminal
+                warning('Frame bus: image with shape %s does not fit in the slots (%s pixels)'%(
+                    np.shape(im), self.v.pixels))
+            return 0
+        i = self.free_slot()
+        self.v.data[i, :im.size].reshape(im.shape)[:] = im
+        self.v.slots[['run','imn','rows','cols','flags','time']][i] = (
+            run, imn, im.shape[0], im.shape[1], flags, t0)
+        self.seq += 1
+        self.v.slots['seq'][i] = self.seq # publish the slot, then the newest seq #
+        self.v.head['head'][0] = self.seq
+        self.counts['published'] += 1
+        self.stats.record('publish', time.time() - t0)
+        self.stats.sent(im.nbytes)
+        active = self.v.readers['pid'] != 0
+        if np.any(active): # how far behind the slowest reader is
+            self.stats.set_queue_depth(int(self.seq - self.v.readers['last'][active].min()))
+        return self.seq
+
+    def reader_status(self):
+        """Return a list of (process ID, last seq # read, # frames missed)
+        for the registered readers."""
+        return [(int(r['pid']), int(r['last']), int(r['dropped']))
+            for r in self.v.readers if r['pid']]
+
+    def close(self, args=None):
+        """Remove the shared memory. Readers keep their mapping until
+        they close it."""
+        if self.shm is not None:
+            self.v.release()
+            self.lock.close()
+            try: self.shm.close()
+            except BufferError: pass # frames still in use, unmapped when they're deleted
+            try: self.shm.unlink()
+            except FileNotFoundError: pass
+            self.shm = None
+
+####    ####    ####    ####
+
+class FrameReader:
+    """Reading side of the frame bus. Registers as a reader in the block
+    so that the frame it holds isn't overwritten. Several readers can be
+    in one process, e.g. one for each analysis window.
+    Keyword arguments:
+    name     -- name of the shared memory block made by the FrameBus.
+    from_now -- if True, start from the next frame published, otherwise
+        from the oldest frame still in the bus."""
+    def __init__(self, name='pydex_frames', from_now=True):
+        self.shm = attach(name)
+        self.v = _views(self.shm)
+        self.lock = _claim_lock(name)
+        with self.lock: # so that two readers don't take the same row
+            free = np.flatnonzero(self.v.readers['pid'] == 0)
+            if free.size:
+                self.ind = int(free[0])
+                head = int(self.v.head['head'][0])
+                self.v.readers[self.ind] = (os.getpid(), 0, head if from_now
+                    else max(head - self.v.nslots, 0), 0)
+        if not free.size:
+            nreaders = self.v.nreaders
+            self.v.release()
+            self.lock.close()
+            self.shm.close()
+            raise RuntimeError('Frame bus %s already has %s readers'%(name, nreaders))
+        self.r = self.v.readers[self.ind:self.ind+1] # view of this reader's row
+
+    @property
+    def last(self):
+        return int(self.r['last'][0])
+
+    @property
+    def dropped(self):
+        return int(self.r['dropped'][0])
+
+    def head(self):
+        """seq # of the newest frame published."""
+        return int(self.v.head['head'][0])
+
+    def hold(self, seq):
+        """Hold the frame with this seq # and return it, or None if it has
+        been overwritten. Releases the frame held before."""
+        with self.lock: # the publisher can't take the slot while it's checked
+            i = np.flatnonzero(self.v.slots['seq'] == seq)
+            if not i.size: return None
+            self.r['held'] = seq
+        s = self.v.slots[int(i[0])]
+        n = int(s['rows']) * int(s['cols'])
+        im = self.v.data[int(i[0]), :n].reshape(int(s['rows']), int(s['cols']))
+        im.flags.writeable = False
+        return Frame(im, seq, int(s['run']), int(s['imn']), float(s['time']), int(s['flags']))
+
+    def release(self):
+        """Let the publisher reuse the slot of the frame held."""
+        self.r['held'] = 0
+
+    def latest(self):
+        """Hold and return the newest frame, skipping the ones in between."""
+        head = self.head()
+        if head <= self.last: return None
+        frame = self.hold(head)
+        if frame is not None:
+            self.r['dropped'] += head - self.last - 1
+            self.r['last'] = head
+        return frame
+
+    def next(self, timeout=None, poll=1e-4):
+        """Hold and return the next frame in order, waiting up to timeout
+        seconds (None waits forever). If frames were overwritten before
+        they were read, skip to the oldest one still in the bus. Returns
+        None after the timeout."""
+        self.release()
+        t_end = None if timeout is None else time.time() + timeout
+        while self.shm is not None:
+            head = self.head()
+            if head > self.last:
+                seqs = self.v.slots['seq']
+                seqs = seqs[seqs > self.last]
+                want = int(seqs.min()) if seqs.size else head
+                frame = self.hold(want)
+                if frame is not None:
+                    self.r['dropped'] += want - self.last - 1
+                    self.r['last'] = want
+                    return frame
+                continue # overwritten meanwhile: look again
+            if t_end is not None and time.time() > t_end: return None
+            time.sleep(poll)
+
+    def close(self):
+        """Unregister the reader and close the shared memory."""
+        if self.shm is not None:
+            self.v.readers[self.ind] = (0, 0, 0, 0)
+            self.r = None
+            self.v.release()
+            self.lock.close()
+            try: self.shm.close()
+            except BufferError: pass # frames still in use, unmapped when they're deleted
+            self.shm = None
+
+class FrameListener(threading.Thread):
+    """Read frames from the bus and call handler(frame) for each one on
+    this thread. The frame is released when the handler returns, so the
+    handler must copy frame.im if it keeps it.
+    Keyword arguments:
+    handler  -- function taking a Frame.
+    name     -- name of the shared memory block made by the FrameBus.
+    poll     -- time (s) to sleep between polls of the bus."""
+    def __init__(self, handler, name='pydex_frames', poll=1e-4):
+        super().__init__(daemon=True)
+        self.handler = handler
+        self.reader = FrameReader(name)
+        self.poll = poll
+        self.stats = get_link('Frame bus recv %s'%self.reader.ind)
+        self.stop = False
+
+    def run(self):
+        try:
+            while not self.stop:
+                frame = self.reader.next(timeout=0.1, poll=self.poll)
+                if frame is None: continue
+                t0 = time.time()
+                self.stats.record('remote', t0 - frame.time) # same clock on one computer
+                try: self.handler(frame)
+                except Exception as e:
+                    error('Frame bus handler failed for frame %s\n'%frame.seq + str(e))
+                self.reader.release()
+                self.stats.record('execution', time.time() - t0)
+                self.stats.received(frame.im.nbytes)
+        finally:
+            self.reader.close()
+
+    def close(self, args=None, timeout=0):
+        """Stop reading frames. Wait up to timeout seconds for the frames
+        already published to be handled, and then for the thread to end."""
+        t_end = time.time() + timeout
+        while (self.is_alive() and not self.stop and time.time() < t_end
+                and self.reader.last < self.reader.head()):
+            time.sleep(self.poll)
+        self.stop = True
+        if timeout and self.is_alive(): self.join(max(t_end - time.time(), 0))
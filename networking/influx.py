@@ -0,0 +1,276 @@
+"""PyDex - buffered export to influxdb
+
+ - Queue line protocol points in the background so that the analysis
+ threads never wait on the network.
+ - Points are batched by number and by time into a single HTTP write
+ - The HTTP connection is kept alive between writes
+ - If the database can't be reached, batches are spooled to a local file
+ and resent when the connection comes back.
+ - get_stats() reports the queue depth and counts of sent/spooled points
+"""
+import os
+import sys
+import time
+import queue
+import threading
+import http.client
+from collections import deque
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info
+
+def line_protocol(measurement, tags, fields, t=None):
+    """Format a single point as an influxdb line protocol string.
+    measurement -- name of the measurement, e.g. 'Experiment'
+    tags        -- list of (key, value) pairs, already formatted as strings
+    fields      -- list of (key, value) pairs, already formatted as strings
+    t           -- timestamp in ns since epoch. Default: now."""
+    if t is None: t = int(time.time()*1e9)
+    head = ','.join([measurement] + ['%s=%s'%(k, v) for k, v in tags])
+    return head + ' ' + ','.join(['%s=%s'%(k, v) for k, v in fields]) + ' %s'%t
+
+class InfluxWriter(threading.Thread):
+    """Send line protocol points to influxdb from a background thread.
+    Points added with add_point() are collected into batches of up to
+    batch_size points, or whatever has arrived within flush_time seconds,
+    and sent as one POST request over a persistent HTTP connection.
+    Keyword arguments:
+    host       -- address of the influxdb server.
+    port       -- port the influxdb HTTP API listens on.
+    db         -- name of the database to write to.
+    batch_size -- max number of points to send in one request.
+    flush_time -- max time (s) a point waits in the queue before it's sent.
+    max_queue  -- max number of points held in memory. Beyond this, points
+        are moved into the spool file instead.
+    spool_file -- file to store points in while the database is down.
+    retry_time -- time (s) to wait between attempts to resend the spool.
+    timeout    -- socket timeout (s) for the HTTP connection."""
+    def __init__(self, host='129.234.190.191', port=8086, db='arduino',
+            batch_size=500, flush_time=1.0, max_queue=100000,
+            spool_file='influx_spool.txt', retry_time=10.0, timeout=5.0):
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.url  = '/write?db=%s'%db
+        self.batch_size = batch_size
+        self.flush_time = flush_time
+        self.spool_file = spool_file
+        self.retry_time = retry_time
+        self.timeout    = timeout
+        self._q = queue.Queue(maxsize=max_queue) # points waiting to be sent
+        self._overflow = deque() # points that didn't fit in the queue, to be spooled
+        self._conn = None    # persistent HTTP connection
+        self._closing = threading.Event()
+        self._lock = threading.Lock() # protect the stats and spool file
+        self._last_retry = 0 # time of the last attempt to empty the spool
+        self.stats = {'sent':0, 'batches':0, 'failed':0, 'spooled':0,
+            'resent':0, 'dropped':0, 'last_latency':0.0, 'max_latency':0.0}
+
+    def add_point(self, line):
+        """Queue a line protocol point to be sent. Never blocks: if the
+        queue is full, the writer thread moves the point into the spool
+        file, so that the caller doesn't wait on the disk."""
+        try:
+            self._q.put_nowait(line.strip())
+        except queue.Full:
+            self._overflow.append(line.strip())
+
+    def add(self, measurement, tags, fields, t=None):
+        """Format a point with line_protocol() and queue it."""
+        self.add_point(line_protocol(measurement, tags, fields, t))
+
+    def get_stats(self):
+        """Return a copy of the export metrics, including queue depth."""
+        with self._lock:
+            s = dict(self.stats)
+        s['queue_depth'] = self._q.qsize() + len(self._overflow)
+        s['spool_depth'] = self.spool_size()
+        return s
+
+    #### #### HTTP connection #### ####
+
+    def connect(self):
+        """Open the persistent connection if it isn't already open."""
+        if self._conn is None:
+            self._conn = http.client.HTTPConnection(self.host, self.port,
+                timeout=self.timeout)
+        return self._conn
+
+    def disconnect(self):
+        """Close the connection so that the next write opens a new one."""
+        if self._conn is not None:
+            try: self._conn.close()
+            except Exception: pass
+            self._conn = None
+
+    def post(self, lines):
+        """Send a batch of points in one write request. Returns True if
+        the database accepted them. Retries once on a stale connection."""
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        for attempt in range(2):
+            try:
+                t0 = time.time()
+                conn = self.connect()
+                conn.request('POST', self.url, body, {'User-Agent':'PyDex',
+                    'Content-Type':'application/x-www-form-urlencoded',
+                    'Connection':'keep-alive'})
+                resp = conn.getresponse()
+                resp.read() # must empty the response to reuse the connection
+                dt = time.time() - t0
+                with self._lock:
+                    self.stats['last_latency'] = dt
+                    self.stats['max_latency'] = max(dt, self.stats['max_latency'])
+                if resp.getheader('Connection', '').lower() == 'close':
+                    self.disconnect()
+                if resp.status < 300:
+                    return True
+                elif resp.status < 500: # the request itself is bad, don't retry
+                    error('influxdb rejected %s points: %s %s'%(len(lines),
+                        resp.status, resp.reason))
+                    with self._lock: self.stats['dropped'] += len(lines)
+                    return True
+                return False
+            except (http.client.HTTPException, OSError) as e:
+                self.disconnect()
+                if attempt:
+                    warning('Could not write to influxdb at %s:%s\n'%(
+                        self.host, self.port) + str(e))
+        return False
+
+    #### #### spool file #### ####
+
+    def spool(self, lines):
+        """Append points to the spool file to be resent later."""
+        with self._lock:
+            try:
+                with open(self.spool_file, 'a') as f:
+                    f.write('\n'.join(lines) + '\n')
+                self.stats['spooled'] += len(lines)
+            except OSError as e:
+                self.stats['dropped'] += len(lines)
+                error('Failed to spool influxdb points to %s\n'%self.spool_file + str(e))
+
+    def spool_size(self):
+        """Size of the spool file in bytes."""
+        try: return os.path.getsize(self.spool_file)
+        except OSError: return 0
+
+    def spool_overflow(self):
+        """Move the points that didn't fit in the queue into the spool file."""
+        lines = []
+        while self._overflow:
+            lines.append(self._overflow.popleft())
+        if lines: self.spool(lines)
+
+    def restore_spool(self, lines, sending):
+        """Put the unsent lines back in front of the spool file and remove
+        the file they were being sent from. Call with the lock held."""
+        if lines:
+            try:
+                with open(self.spool_file, 'r') as f: newer = f.read()
+            except OSError: newer = ''
+            with open(self.spool_file, 'w') as f:
+                f.write('\n'.join(lines) + '\n' + newer)
+        os.remove(sending)
+
+    def resend_spool(self):
+        """Try to send the points stored in the spool file. The file is
+        moved aside first so that points spooled meanwhile aren't lost.
+        Whatever isn't sent goes back in front of the spool, even if 
+        sending raises."""
+        self._last_retry = time.time()
+        sending = self.spool_file + '.sending'
+        with self._lock:
+            try:
+                if os.path.isfile(sending): # left by an attempt that failed to restore it
+                    with open(sending, 'r') as f:
+                        self.restore_spool([l for l in f.read().split('\n') if l], sending)
+                if not self.spool_size(): return True
+                os.replace(self.spool_file, sending)
+                with open(sending, 'r') as f:
+                    lines = [l for l in f.read().split('\n') if l]
+            except OSError as e:
+                warning('Failed to read the influxdb spool file %s\n'%self.spool_file + str(e))
+                return False
+        n = 0 # number of lines sent
+        try:
+            for i in range(0, len(lines), self.batch_size):
+                if not self.post(lines[i:i+self.batch_size]):
+                    return False
+                n = min(i + self.batch_size, len(lines))
+                with self._lock: self.stats['resent'] += len(lines[i:n])
+        finally:
+            with self._lock: 
+                try: self.restore_spool(lines[n:], sending)
+                except OSError as e:
+                    error('Failed to put %s points back in the influxdb spool file %s\n'%(
+                        len(lines) - n, self.spool_file) + str(e))
+        info('Resent %s spooled points to influxdb'%len(lines))
+        return True
+
+    #### #### thread #### ####
+
+    def get_batch(self):
+        """Collect up to batch_size points, waiting no more than flush_time
+        after the first point arrives."""
+        try: lines = [self._q.get(timeout=self.flush_time)]
+        except queue.Empty: return []
+        t_end = time.time() + self.flush_time
+        while len(lines) < self.batch_size:
+            try: lines.append(self._q.get(timeout=max(t_end - time.time(), 0)))
+            except queue.Empty: break
+        return lines
+
+    def send_batch(self, lines):
+        """Send the points, or spool them if the database can't be reached."""
+        if self.spool_size() and time.time() - self._last_retry > self.retry_time:
+            self.resend_spool()
+        if self.spool_size(): # keep the order: add behind the spooled points
+            self.spool(lines)
+        elif self.post(lines):
+            with self._lock:
+                self.stats['sent'] += len(lines)
+                self.stats['batches'] += 1
+        else:
+            with self._lock: self.stats['failed'] += 1
+            self.spool(lines)
+            self._last_retry = time.time()
+
+    def run(self):
+        """Send batches until close() is called, then flush the queue."""
+        while not self._closing.is_set():
+            lines = self.get_batch()
+            self.spool_overflow()
+            if lines: self.send_batch(lines)
+            elif self.spool_size() and time.time() - self._last_retry > self.retry_time:
+                self.resend_spool()
+        lines = []
+        while True:
+            try: lines.append(self._q.get_nowait())
+            except queue.Empty: break
+        self.spool_overflow()
+        for i in range(0, len(lines), self.batch_size):
+            self.send_batch(lines[i:i+self.batch_size])
+        self.disconnect()
+
+    def close(self, timeout=None):
+        """Stop the thread after sending the remaining points."""
+        self._closing.set()
+        if self.is_alive(): self.join(timeout)
+
+_writer = None  # shared instance so that all modules use one connection
+
+def get_writer(**kwargs):
+    """Return the shared InfluxWriter, starting it on first use. Keyword
+    arguments are only used when the writer is first created."""
+    global _writer
+    if _writer is None or not _writer.is_alive():
+        _writer = InfluxWriter(**kwargs)
+        _writer.start()
+    return _writer
+
+def close_writer(timeout=5):
+    """Flush and stop the shared InfluxWriter if it was started."""
+    global _writer
+    if _writer is not None:
+        _writer.close(timeout)
+        _writer = None
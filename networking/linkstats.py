@@ -0,0 +1,218 @@
+"""PyDex - TCP link statistics
+
+ - Bounded latency histograms for each TCP link (server or client)
+ - Log-spaced buckets with a fixed relative precision (like HDR histograms)
+ so memory doesn't grow however many messages are sent
+ - Count messages and bytes to get rates, and track the queue depth
+ - Periodically roll the statistics over to a file and reset them
+ - Serve the current statistics as JSON from a local HTTP server
+"""
+import os
+import json
+import math
+import time
+import threading
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+class LatencyHistogram:
+    """A histogram of latencies with log-spaced bins. Each power of 2 is
+    split into sub_buckets linear bins, giving a relative precision of
+    1/sub_buckets across the range from lowest to highest.
+    Keyword arguments:
+    lowest      -- smallest latency (s) that can be resolved.
+    highest     -- largest latency (s). Larger values go in the top bin.
+    sub_buckets -- number of bins per power of 2."""
+    def __init__(self, lowest=1e-6, highest=3600, sub_buckets=32):
+        self.lowest = lowest
+        self.sub_buckets = sub_buckets
+        self.nmags = max(int(math.ceil(math.log2(highest/lowest))), 1)
+        self.counts = [0] * (self.nmags * sub_buckets + 1)
+        self.reset()
+
+    def reset(self):
+        """Empty all of the bins."""
+        self.counts = [0] * len(self.counts)
+        self.n = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def index(self, value):
+        """Return the bin index for a latency value."""
+        if value < self.lowest: return 0
+        mag, frac = divmod(math.log2(value / self.lowest), 1)
+        i = int(mag) * self.sub_buckets + int((2**frac - 1) * self.sub_buckets)
+        return min(i, len(self.counts) - 1)
+
+    def value(self, i):
+        """Return the upper edge of bin i."""
+        mag, sub = divmod(i, self.sub_buckets)
+        return self.lowest * 2**mag * (1 + (sub + 1) / self.sub_buckets)
+
+    def record(self, value):
+        """Add a latency (s) to the histogram."""
+        self.counts[self.index(value)] += 1
+        self.n += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """Return the latency below which q % of the values lie."""
+        if not self.n: return 0.0
+        target = q / 100 * self.n
+        cumsum = 0
+        for i, c in enumerate(self.counts):
+            cumsum += c
+            if c and cumsum >= target:
+                return min(self.value(i), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        """Return a dictionary of the count, mean, min, max, and percentiles."""
+        s = OrderedDict([('count', self.n),
+            ('mean', self.total / self.n if self.n else 0.0),
+            ('min', self.min if self.n else 0.0), ('max', self.max)])
+        for q in percentiles:
+            s['p%s'%q] = self.percentile(q)
+        return s
+
+class LinkStats:
+    """Statistics for a single TCP link. Latencies are recorded in named
+    histograms, e.g. 'queue' (time a message waits in the queue), 'connect'
+    (time waiting for the other end to connect), 'send', and 'remote'
+    (time waiting for the reply). Also counts messages and bytes.
+    Keyword arguments:
+    name          -- label for the link, e.g. 'DExTer'.
+    rollover_time -- time (s) between saving the stats to file and resetting
+        them. 0 to never roll over.
+    save_dir      -- directory to save the rolled over stats to."""
+    keys = ['queue', 'connect', 'send', 'remote']
+
+    def __init__(self, name='', rollover_time=3600, save_dir='.'):
+        self.name = name
+        self.rollover_time = rollover_time
+        self.save_dir = save_dir
+        self.lock = threading.Lock()
+        self.hists = OrderedDict([(key, LatencyHistogram()) for key in self.keys])
+        self.queue_depth = 0
+        self.reset()
+
+    def reset(self):
+        """Empty the histograms and counters."""
+        with self.lock:
+            for h in self.hists.values(): h.reset()
+            self.t0 = time.time()
+            self.msgs_out = 0
+            self.msgs_in  = 0
+            self.bytes_out = 0
+            self.bytes_in  = 0
+            self.max_queue_depth = self.queue_depth
+
+    def record(self, key, value):
+        """Add a latency (s) to the histogram key."""
+        with self.lock:
+            if key not in self.hists:
+                self.hists[key] = LatencyHistogram()
+            self.hists[key].record(value)
+
+    def sent(self, nbytes):
+        """Count a message sent."""
+        with self.lock:
+            self.msgs_out += 1
+            self.bytes_out += nbytes
+
+    def received(self, nbytes):
+        """Count a message received."""
+        with self.lock:
+            self.msgs_in += 1
+            self.bytes_in += nbytes
+
+    def set_queue_depth(self, depth):
+        self.queue_depth = depth
+        self.max_queue_depth = max(depth, self.max_queue_depth)
+
+    def summary(self):
+        """Return the current stats as a dictionary."""
+        with self.lock:
+            dt = max(time.time() - self.t0, 1e-9)
+            return OrderedDict([('name', self.name), ('start', self.t0),
+                ('elapsed', dt), ('queue depth', self.queue_depth),
+                ('max queue depth', self.max_queue_depth),
+                ('msgs out', self.msgs_out), ('msgs in', self.msgs_in),
+                ('bytes out', self.bytes_out), ('bytes in', self.bytes_in),
+                ('msgs/s', (self.msgs_out + self.msgs_in) / dt),
+                ('bytes/s', (self.bytes_out + self.bytes_in) / dt),
+                *[(key, h.summary()) for key, h in self.hists.items()]])
+
+    def text(self):
+        """Return a short human readable summary of the latencies in ms."""
+        s = self.summary()
+        txt = '%s: %s msgs, %.3g msgs/s, queue %s (max %s)\n'%(self.name,
+            s['msgs out'], s['msgs/s'], s['queue depth'], s['max queue depth'])
+        for key in self.hists.keys():
+            if s[key]['count']:
+                txt += '   %s: p50 %.3g ms, p99 %.3g ms, max %.3g ms\n'%(key,
+                    s[key]['p50']*1e3, s[key]['p99']*1e3, s[key]['max']*1e3)
+        return txt
+
+    def save(self, file_name=''):
+        """Append the current stats to file as a line of JSON."""
+        if not file_name:
+            file_name = os.path.join(self.save_dir, 'tcp_stats_%s.txt'%self.name.replace(' ', '_'))
+        with open(file_name, 'a') as f:
+            f.write(json.dumps(self.summary()) + '\n')
+
+    def check_rollover(self):
+        """If the rollover time has passed, save the stats and reset them."""
+        if self.rollover_time and time.time() - self.t0 > self.rollover_time:
+            try: self.save()
+            except OSError: pass # don't hold up communication
+            self.reset()
+
+links = OrderedDict() # all of the links in this program, by name
+
+def get_link(name, **kwargs):
+    """Return the LinkStats for name, creating it if it doesn't exist."""
+    if name not in links:
+        links[name] = LinkStats(name, **kwargs)
+    return links[name]
+
+def all_stats():
+    """Return a dictionary of the stats for all links."""
+    return OrderedDict([(name, l.summary()) for name, l in list(links.items())])
+
+class StatsHandler(BaseHTTPRequestHandler):
+    """Reply to GET requests with the link stats as JSON.
+    /         -- all links
+    /<name>   -- a single link"""
+    def do_GET(self):
+        name = self.path.strip('/')
+        if not name: data = all_stats()
+        elif name in links: data = links[name].summary()
+        else:
+            self.send_error(404, 'No link named %s'%name)
+            return
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass # don't print every request
+
+class StatsServer(threading.Thread):
+    """Serve the link stats over HTTP at http://host:port/"""
+    def __init__(self, host='localhost', port=8630):
+        super().__init__(daemon=True)
+        self.httpd = HTTPServer((host, port), StatsHandler)
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
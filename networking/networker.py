@@ -18,6 +18,7 @@ from PyQt5.QtWidgets import QApplication
 import sys
 if '..' not in sys.path: sys.path.append('..')
 from strtypes import error, warning, info
+from networking.linkstats import get_link
 from mythread import enco
 
 TCPENUM = { # enum for DExTer's producer-consumer loop cases
@@ -79,8 +80,7 @@ class PyServer(QThread):
         self.server_address = (host, port)
         self.__mq = []
         self.__lock  = False # message queue is locked
-        self.ts = {label:[time.time()] for label in ['start', 'connect', 'waiting', 
-            'sent', 'received', 'disconnect']}
+        self.stats = get_link(name if name else 'port %s'%port) # latencies, rates, queue depth
         self.app = QApplication.instance() # the main application that's running
 
     def lockq(self):
@@ -100,24 +100,29 @@ class PyServer(QThread):
         if not self.__lock:
             self.__mq.append([struct.pack("!L", int(enum)), # enum 
                                 struct.pack("!L", len(bytes(text, encoding))), # msg length 
-                                bytes(text, encoding)]) # message
+                                bytes(text, encoding), # message
+                                time.time()]) # time queued
+            self.stats.set_queue_depth(len(self.__mq))
        
     def priority_messages(self, message_list, encoding=enco):
         """Add messages to the start of the message queue.
         message_list - list of [enum (int), text(str)] pairs."""
+        t = time.time()
         self.__mq = [[struct.pack("!L", int(enum)), # enum 
                             struct.pack("!L", len(bytes(text, encoding))), # msg length 
-                            bytes(text, encoding)] for enum, text in message_list] + self.__mq
+                            bytes(text, encoding), t] for enum, text in message_list] + self.__mq
+        self.stats.set_queue_depth(len(self.__mq))
         
     def get_queue(self):
         """Return a list of the queued messages."""
         return [(str(int.from_bytes(enum, 'big')), int.from_bytes(tlen, 'big'), 
-                str(text, enco)) for enum, tlen, text in self.__mq]
+                str(text, enco)) for enum, tlen, text, t in self.__mq]
                         
     def clear_queue(self):
         """Remove all of the messages from the queue."""
         reset_slot(self.textin, self.clear_queue, False) # only trigger clear_queue once
         self.__mq = []
+        self.stats.set_queue_depth(0)
         self.unlockq()
 
     def run(self, encoding=enco):
@@ -130,7 +135,6 @@ class PyServer(QThread):
          1) the run number as int32 (4 bytes).
          2) the length of the message to come as int32 (4 bytes).
          3) the sent message as str."""
-        self.ts['start'] = time.time() 
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             try: 
                 s.bind(self.server_address)
@@ -147,42 +151,45 @@ class PyServer(QThread):
                 if self.check_stop():
                     break # toggle
                 elif len(self.__mq):
+                    t0 = time.time()
                     conn, addr = s.accept() # create a new socket
                     self.connected = True
                     with conn: # close the connection after this code is executed:
                         try:
-                            enum, mes_len, message = self.__mq.pop(0)
-                            self.ts['connect'].append(time.time())
-                            self.ts['waiting'].append(time.time() - self.ts['disconnect'][-1])
+                            enum, mes_len, message, tq = self.__mq.pop(0)
+                            self.stats.set_queue_depth(len(self.__mq))
+                            t1 = time.time()
+                            self.stats.record('queue', t0 - tq)
+                            self.stats.record('connect', t1 - t0)
                             try:
                                 conn.sendall(enum) # send enum
                                 conn.sendall(mes_len) # send text length
                                 conn.sendall(message) # send text
+                                self.stats.sent(8 + len(message))
                             except (ConnectionResetError, ConnectionAbortedError) as e:
-                                self.__mq.insert(0, [enum, mes_len, message]) # check this doesn't infinitely add the message back
+                                self.__mq.insert(0, [enum, mes_len, message, tq]) # check this doesn't infinitely add the message back
                                 error('Python server %s: client terminated connection before message was sent.'%self._name +
                                     ' Re-inserting message at front of queue.\n'+str(e))
-                            self.ts['sent'].append(time.time() - self.ts['connect'][-1])
+                            t2 = time.time()
+                            self.stats.record('send', t2 - t1)
                             try:
                                 # receive current run number from DExTer as 4 bytes
                                 self.dxnum.emit(str(int.from_bytes(conn.recv(4), 'big'))) # long int
                                 # receive message from DExTer
                                 buffer_size = int.from_bytes(conn.recv(4), 'big')
                                 self.textin.emit(str(conn.recv(buffer_size), encoding))
+                                self.stats.received(8 + buffer_size)
                             except (ConnectionResetError, ConnectionAbortedError) as e:
                                 warning('Python server %s: client terminated connection before receive.\n'%self._name+str(e))
-                            self.ts['received'].append(time.time() - self.ts['connect'][-1] - self.ts['sent'][-1])
-                            self.ts['disconnect'].append(time.time())
+                            self.stats.record('remote', time.time() - t2)
+                            self.stats.check_rollover()
                         except IndexError as e: 
                             error('Server %s msg queue was emptied before msg could be sent.\n'%self._name+str(e))
                     self.connected = False
                         
-    def save_times(self):
-        """Print the timings between messages."""
-        with open('networker_timings.txt', 'w') as f:
-            f.write('waiting, sent, received\n')
-            for i in range(len(self.ts['sent'])):
-                f.write(','.join(['%.4g'%(self.ts[key][i]*1e3) for key in ['waiting', 'sent', 'received']])+'\n')
+    def save_times(self, file_name='networker_timings.txt'):
+        """Append the latency histograms and message rates to file."""
+        self.stats.save(file_name)
 
     def check_stop(self):
         """Check the value of stop - must be a function in order to work in
@@ -0,0 +1,230 @@
+"""PyDex - fast occupancy channel for rearrangement
+
+ - Send the occupancy of the ROIs straight from the atom checker to the AWG
+ without going through Qt signals or the polling PyServer message queue.
+ - The occupancy is bit-packed into a small frame on a TCP connection that
+ is opened in advance, with Nagle's algorithm turned off:
+    sequence # (uint32) | time sent (float64) | # ROIs (uint16) | bits
+ - On the AWG side, a thread receives the frame and calls the rearrangement
+ handler directly, then sends back an ack with the handler timing.
+ - If both programs are on the same computer, shared memory can be used
+ instead of TCP (needs python >= 3.8). The frame follows a write count,
+ which is odd while the frame is being written. The reader copies the
+ frame and checks that the count didn't change, otherwise it reads again.
+ - Latencies are recorded in linkstats under 'Occupancy'
+"""
+import sys
+import time
+import socket
+import struct
+import threading
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info
+from networking.awgcmd import pack_occupancy, unpack_occupancy, recv_all
+from networking.linkstats import get_link
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None # shared memory mode needs python >= 3.8
+
+OCC_HEAD = struct.Struct('!Id')   # sequence #, time sent
+OCC_ACK  = struct.Struct('!Idd')  # sequence #, wait before handling, handler time
+SHM_GEN  = struct.Struct('!I')    # write count at the start of shared memory
+SHM_SIZE = 1024 # bytes: enough for 8000 ROIs
+
+class OccupancyLink(threading.Thread):
+    """PyDex side of the occupancy channel. Holds a connection open to the
+    AWG so that send() only has to write a few bytes. A background thread
+    reconnects when needed and receives the acks.
+    host     -- address of the computer running the AWG.
+    port     -- port the OccupancyListener listens on.
+    shm_name -- name of a shared memory block to use instead of TCP, if
+        the AWG program runs on the same computer. '' to use TCP."""
+    def __init__(self, host='129.234.190.235', port=8629, shm_name=''):
+        super().__init__(daemon=True)
+        self.server_address = (host, port)
+        self.sock = None
+        self.shm = None
+        self.shm_name = shm_name
+        self.gen = 0 # write count in shared memory
+        self.seq = 0
+        self.sent = {} # time that each unacknowledged frame was sent
+        self.stats = get_link('Occupancy')
+        self.stop = False
+
+    def connected(self):
+        return self.sock is not None or self.shm is not None
+
+    def connect(self):
+        """Open shared memory or the TCP connection."""
+        if self.shm_name and shared_memory is not None:
+            try:
+                self.shm = shared_memory.SharedMemory(name=self.shm_name)
+                self.gen = SHM_GEN.unpack_from(self.shm.buf)[0] // 2 * 2 # carry on from the last write
+                return True
+            except (FileNotFoundError, OSError): self.shm = None
+        try:
+            self.sock = socket.create_connection(self.server_address, timeout=1)
+            self.sock.settimeout(None)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            self.sock = None
+        return self.sock is not None
+
+    def send(self, occupancy):
+        """Send the occupancy string, e.g. '0110'. Returns True if it was
+        sent on the fast channel, False if the caller should fall back."""
+        if not self.connected(): return False
+        self.seq += 1
+        t = time.time()
+        frame = OCC_HEAD.pack(self.seq, t) + pack_occupancy(occupancy)
+        if self.shm is not None and SHM_GEN.size + len(frame) > SHM_SIZE:
+            warning('Occupancy of %s ROIs is too large for shared memory, '%len(occupancy)
+                + 'falling back to TCP messages.')
+            return False
+        try:
+            if self.shm is not None: # the reader polls the write count
+                self.gen = (self.gen + 1) % 2**32 # odd while writing
+                SHM_GEN.pack_into(self.shm.buf, 0, self.gen)
+                self.shm.buf[SHM_GEN.size:SHM_GEN.size+len(frame)] = frame
+                self.gen = (self.gen + 1) % 2**32
+                SHM_GEN.pack_into(self.shm.buf, 0, self.gen)
+            else:
+                self.sent[self.seq] = t
+                self.sock.sendall(frame)
+            self.stats.record('send', time.time() - t)
+            self.stats.sent(len(frame))
+            return True
+        except (OSError, ValueError) as e:
+            warning('Occupancy channel failed to send, falling back to TCP messages.\n'+str(e))
+            self.disconnect()
+            return False
+
+    def disconnect(self):
+        if self.sock is not None:
+            try: self.sock.close()
+            except OSError: pass
+            self.sock = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+    def run(self):
+        """Keep the connection open and record the round trip time from acks."""
+        while not self.stop:
+            if not self.connected():
+                if not self.connect():
+                    time.sleep(1)
+                    continue
+            if self.shm is not None: # acks aren't used with shared memory
+                time.sleep(0.1)
+                continue
+            try:
+                seq, wait, dt = OCC_ACK.unpack(recv_all(self.sock, OCC_ACK.size))
+                self.stats.received(OCC_ACK.size)
+                t0 = self.sent.pop(seq, None)
+                if t0 is not None:
+                    self.stats.record('remote', time.time() - t0) # round trip
+                self.stats.record('queue', wait)
+                self.stats.record('execution', dt)
+            except (OSError, struct.error) as e:
+                if not self.stop:
+                    warning('Occupancy channel to AWG lost.\n'+str(e))
+                self.disconnect()
+
+    def close(self, args=None):
+        self.stop = True
+        self.disconnect()
+
+####    ####    ####    ####
+
+class OccupancyListener(threading.Thread):
+    """AWG side of the occupancy channel. Receives occupancy frames and calls
+    handler(occupancy) straight away on this thread.
+    handler  -- function taking the occupancy string, e.g. '0110'.
+    host     -- '' to accept connections from any address.
+    port     -- the port to listen on.
+    shm_name -- if given, create a shared memory block with this name and
+        poll it instead of listening on TCP.
+    poll     -- time (s) to sleep between polls of shared memory."""
+    def __init__(self, handler, host='', port=8629, shm_name='', poll=1e-5):
+        super().__init__(daemon=True)
+        self.handler = handler
+        self.server_address = (host, port)
+        self.shm_name = shm_name
+        self.poll = poll
+        self.conn = None
+        self.stats = get_link('Occupancy recv')
+        self.stop = False
+
+    def handle(self, seq, t_sent, buf):
+        """Call the handler, return the time waited and handler time."""
+        t0 = time.time()
+        occ, _ = unpack_occupancy(buf)
+        try: self.handler(occ)
+        except Exception as e:
+            error('Occupancy handler failed for %s\n'%occ + str(e))
+        t1 = time.time()
+        self.stats.record('execution', t1 - t0)
+        self.stats.received(OCC_HEAD.size + len(buf))
+        return t1 - t0
+
+    def run_shm(self):
+        """Poll the shared memory for a new sequence #."""
+        shm = shared_memory.SharedMemory(name=self.shm_name, create=True, size=SHM_SIZE)
+        SHM_GEN.pack_into(shm.buf, 0, 0)
+        last = 0
+        try:
+            while not self.stop:
+                gen = SHM_GEN.unpack_from(shm.buf)[0]
+                if gen == last or gen % 2: # nothing new, or the frame is being written
+                    time.sleep(self.poll)
+                    continue
+                frame = bytes(shm.buf[SHM_GEN.size:])
+                if SHM_GEN.unpack_from(shm.buf)[0] != gen:
+                    continue # overwritten while it was copied
+                t_recv = time.time()
+                last = gen
+                seq, t_sent = OCC_HEAD.unpack_from(frame)
+                self.stats.record('remote', t_recv - t_sent) # same clock on one computer
+                self.handle(seq, t_sent, frame[OCC_HEAD.size:])
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def run(self):
+        if self.shm_name and shared_memory is not None:
+            return self.run_shm()
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            try:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                s.bind(self.server_address)
+                s.listen(1)
+                s.settimeout(0.5) # so that stop is checked
+            except OSError as e:
+                error('Failed to start occupancy listener at address: ' +
+                    ', '.join(map(str, self.server_address)) + '\n' + str(e))
+                return
+            while not self.stop:
+                try: conn, addr = s.accept()
+                except socket.timeout: continue
+                self.conn = conn
+                with conn:
+                    conn.settimeout(None)
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    try:
+                        while not self.stop:
+                            seq, t_sent = OCC_HEAD.unpack(recv_all(conn, OCC_HEAD.size))
+                            t_recv = time.time()
+                            nb = recv_all(conn, 2)
+                            buf = nb + recv_all(conn, (int.from_bytes(nb, 'big') + 7)//8)
+                            dt = self.handle(seq, t_sent, buf)
+                            conn.sendall(OCC_ACK.pack(seq, time.time() - t_recv - dt, dt))
+                    except (OSError, struct.error): pass # PyDex disconnected
+                self.conn = None
+
+    def close(self, args=None):
+        self.stop = True
+        if self.conn is not None: # unblock the receive
+            try: self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
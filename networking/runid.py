@@ -7,14 +7,20 @@ Stefan Spence 11/10/19
 """
 import time
 import os
+import ast
+import struct
 import numpy as np
 from PyQt5.QtCore import QThread, pyqtSignal, QTimer
 from PyQt5.QtWidgets import QMessageBox
 from networker import PyServer, reset_slot, TCPENUM
 from client import PyClient
+from awgcmd import AWGCommandLink, encode_payload, decode_payload
+from occupancy import OccupancyLink
+from framebus import FrameBus, SAVE
 import sys
 if '..' not in sys.path: sys.path.append('..')
 from strtypes import error, warning, info
+from andorcamera.AndorFunctions import ERROR_CODE
 
 class runnum(QThread):
     """Take ownership of the run number that is
@@ -84,6 +90,13 @@ class runnum(QThread):
         self.client = PyClient(host='129.234.190.235', port=8626, name='AWG recv') # incoming from AWG
         self.client.start()
         self.client.textin.connect(self.add_mr_msgs)
+        self.awgcmd = AWGCommandLink(host='129.234.190.235', port=8628) # binary commands to AWG
+        self.awgcmd.acked.connect(self.awg_acked)
+        self.awgcmd.start()
+        self.awg_data = {} # set_data tables for the AWG, keyed by the equivalent text command
+        self.occ = OccupancyLink(host='129.234.190.235', port=8629) # fast path for rearrangement
+        self.occ.start()
+        self.bus = None # shared memory frame bus for readers in other processes
             
     def reset_server(self, force=False):
         """Check if the server is running. If it is, don't do anything, unless 
@@ -119,6 +132,7 @@ class runnum(QThread):
         imn = self._k % self._m # ID number of image in sequence
         if self.rearranging: imn -= 1 # for rearranging, the 1st image doesn't go to analysis
         self.sv.imn = str(imn) 
+        if self.bus is not None: self.bus.publish(im, self._n, imn, SAVE)
         self.im_save.emit(im)
         if imn < 0:
             self.check.event_im.emit(im)
@@ -145,6 +159,7 @@ class runnum(QThread):
         imn = self._k % self._m # ID number of image in sequence
         if self.rearranging: imn -= 1 # for rearranging, the 1st image doesn't go to analysis
         self.sv.imn = str(imn) 
+        if self.bus is not None: self.bus.publish(im, self._n, imn, SAVE)
         self.im_save.emit(im)
         if imn < 0:
             self.check.event_im.emit(im)
@@ -157,8 +172,26 @@ class runnum(QThread):
 
     def check_receive(self, im=0):
         """Receive image for atom checker, don't save but just pass on"""
+        if self.bus is not None: self.bus.publish(im, self._n, -1)
         self.check.event_im.emit(im)
 
+    def share_frames(self, toggle=True, name='pydex_frames'):
+        """Publish every image to a shared memory frame bus so that other
+        processes can read them without copying (toggle=True), or close it.
+        The image saver and the analysis windows in this process still get
+        the images through signals, so the bus is only for other processes."""
+        if self.bus is not None:
+            self.bus.close()
+            self.bus = None
+        if toggle:
+            pixels = (self.cam.AF.DetectorWidth * self.cam.AF.DetectorHeight
+                if self.cam.initialised > 1 else 512*512)
+            try: self.bus = FrameBus(name, pixels=pixels)
+            except (OSError, ValueError) as e:
+                error('Failed to open the frame bus '+name+'\n'+str(e))
+                return False
+        return True
+
     def reset_dates(self, t0):
         """Make sure that the dates in the image saving and analysis 
         programs are correct."""
@@ -173,6 +206,40 @@ class runnum(QThread):
         self.check.rh.cam_pic_size_changed(self.sw.stats['pic_width'], self.sw.stats['pic_height'])
         self.check.rh.resize_rois(self.sw.stats['ROIs'])
 
+    def roi_boxes(self):
+        """Return (x0, y0, x1, y1) for the pixels covered by the image
+        analysis ROIs and the atom checker ROIs. The end includes one
+        more pixel since a mask needs xc + w//2 < image width."""
+        boxes = []
+        for x, y, w, h, t in self.sw.stats['ROIs']:
+            l = max(w, h) # image handlers use a square ROI of width w
+            boxes.append((x - l//2, y - l//2, x + l//2 + 1, y + l//2 + 1))
+        for r in self.check.rh.ROIs:
+            boxes.append((r.x - r.w//2, r.y - r.h//2, r.x + r.w//2 + 1, r.y + r.h//2 + 1))
+        return boxes
+
+    def crop_to_rois(self, toggle=True, margin=4):
+        """Crop the camera readout to the ROIs plus a margin (toggle=True)
+        or go back to the full sensor (toggle=False). The ROIs in image
+        analysis and the atom checker are moved so that they still cover
+        the same pixels, and the image saver records the sensor window.
+        Returns False if the window couldn't be set, in which case the
+        camera keeps the previous window and the ROIs aren't moved."""
+        if self.cam.initialised < 2 or self.cam.isRunning():
+            warning('Camera must be connected and not acquiring to change the crop.')
+            return False
+        self.cam.blockSignals(True) # move the ROIs before the masks are remade
+        try: err, (dx, dy) = self.cam.CropToROIs(self.roi_boxes() if toggle else [], margin)
+        finally: self.cam.blockSignals(False)
+        if ERROR_CODE.get(err) != 'DRV_SUCCESS':
+            return False
+        shape = (self.cam.AF.ROIwidth, self.cam.AF.ROIheight)
+        self.check.rh.shift_rois(dx, dy, shape)
+        self.cam.ROIChanged.emit(*shape)
+        self.sw.set_rois([[x+dx, y+dy, w, h, t] for x, y, w, h, t in self.sw.stats['ROIs']])
+        self.sv.window = self.cam.SensorWindow()
+        return True
+
     def send_rearr_msg(self, msg=''):
         """Send the command to the AWG for rearranging traps"""
         self.awgtcp.priority_messages([(self._n, 'rearrange='+msg+'#'*2000)])
@@ -194,20 +261,50 @@ class runnum(QThread):
 
     #### multirun ####
 
-    def get_params(self, v, module='AWG'):
-        """Reformat the multirun paramaters into a string to be sent to the AWG, DDS, or SLM"""
-        msg = module+' set_data=['
-        col = -1  # in case the for loop doesn't execute
+    def send_awg_cmd(self, msg):
+        """Send the AWG command on the binary channel if it's connected and 
+        the command has a table stored in awg_data. Returns False if the 
+        text command needs to be sent instead."""
+        if self.awgcmd.connected() and msg in self.awg_data:
+            return self.awgcmd.send('set_data', self.awg_data[msg]) > 0
+        return False
+
+    def awg_acked(self, seq, cmd, success, msg):
+        """The AWG finished a command. After set_data, continue the multirun
+        (replaces the 'go' message sent by the AWG for text commands)."""
+        if cmd == 'set_data':
+            self.add_mr_msgs()
+
+    def get_awg_data(self, v):
+        """Return the table of multirun AWG parameters for row v:
+        [[channel, segment, argument, value, list index], ...]"""
+        rows = []
         for col in range(len(self.seq.mr.mr_param['Type'])):
-            if 'AWG' in self.seq.mr.mr_param['Type'][col] and module == 'AWG':
+            if 'AWG' in self.seq.mr.mr_param['Type'][col]:
                 try: # argument: value
                     for n in self.seq.mr.mr_param['Time step name'][col]: # index of chosen AWG channel, segment 
                         for m in self.seq.mr.mr_param['Analogue channel'][col]:
-                            msg += '[%s, %s, "%s", %s, %s],'%(n%2, n//2, 
-                                self.seq.mr.awg_args[m], self.seq.mr.mr_vals[v][col], 
-                                self.seq.mr.mr_param['list index'][col])
+                            rows.append([n%2, n//2, self.seq.mr.awg_args[m], 
+                                self.seq.mr.mr_vals[v][col], self.seq.mr.mr_param['list index'][col]])
                 except Exception as e: error('Invalid AWG parameter at (%s, %s)\n'%(v,col)+str(e))
-            elif 'DDS' in self.seq.mr.mr_param['Type'][col] and module == 'DDS':
+        return rows
+
+    def get_params(self, v, module='AWG'):
+        """Reformat the multirun paramaters into a string to be sent to the AWG, DDS, or SLM"""
+        msg = module+' set_data=['
+        col = -1  # in case the for loop doesn't execute
+        if module == 'AWG':
+            table = ','.join('[%s, %s, "%s", %s, %s]'%tuple(row) for row in self.get_awg_data(v))
+            msg += table + ']'
+            try: # the AWG evaluates the text command, so send the same values on the binary channel
+                rows = ast.literal_eval('['+table+']')
+                if decode_payload('set_data', encode_payload('set_data', rows)) == rows:
+                    self.awg_data[msg.replace('AWG ', '')] = rows
+            except (ValueError, SyntaxError, TypeError, struct.error):
+                pass # not a literal, or can't be packed: only send the text command
+            return msg
+        for col in range(len(self.seq.mr.mr_param['Type'])):
+            if 'DDS' in self.seq.mr.mr_param['Type'][col] and module == 'DDS':
                 try: # argument: value
                     for n in self.seq.mr.mr_param['Time step name'][col]: # index of chosen DDS COM port, profile
                         for m in self.seq.mr.mr_param['Analogue channel'][col]:
@@ -263,6 +360,8 @@ class runnum(QThread):
                 self.seq.mr.save_mr_params(os.path.join(results_path, self.seq.mr.mr_param['measure_prefix'] + 
                     'params' + str(self.seq.mr.mr_param['1st hist ID']) + '.csv'))
                 self.sw.init_analysers_multirun(results_path, str(self.seq.mr.mr_param['measure_prefix']), self.seq.mr.appending)
+                self.sv.open_archive(os.path.join(self.sv.image_storage_path, # images for this measure
+                    self.seq.mr.mr_param['measure_prefix']))
             except FileNotFoundError as e:
                 error('Multirun could not start because of invalid directory %s\n'%results_path+str(e))
                 return 0
@@ -277,6 +376,7 @@ class runnum(QThread):
             self.ddstcp.priority_messages([[self._n, 'save_all='+os.path.join(results_path,'DDSparam'+str(self.seq.mr.mr_param['1st hist ID'])+'.txt')]])
             self.slmtcp.priority_messages([[self._n, 'save_all='+os.path.join(results_path,'SLMparam'+str(self.seq.mr.mr_param['1st hist ID'])+'.txt')]])
             mr_queue = []
+            self.awg_data = {} # binary AWG commands for this multirun
             #print('make msg')
             for v in range(len(self.seq.mr.mr_vals)): # use different last time step during multirun
                 if any('AWG' in x for x in self.seq.mr.mr_param['Type']): # send AWG parameters by TCP
@@ -320,6 +420,7 @@ class runnum(QThread):
             if not stillrunning: 
                 self.seq.mr.ind = 0
                 self._k = 0
+                self.sv.close_archive()
                 for mw in self.sw.mw + self.sw.rw:
                     mw.multirun = ''
             status = ' paused.' if stillrunning else ' ended.'
@@ -0,0 +1,155 @@
+"""PyDex - tests for the buffered influxdb export
+
+ - Run a local http.server in place of influxdb and check that points are
+ batched, that failed writes are retried, and that the spool is replayed.
+ - Run from the PyDex directory with:
+    python -m unittest networking.test_influx
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+if '..' not in sys.path: sys.path.append('..')
+from networking.influx import InfluxWriter
+
+class influx_handler(BaseHTTPRequestHandler):
+    """Respond to writes like influxdb, recording the lines in each one.
+    The server's fail attribute is the number of writes to refuse."""
+    protocol_version = 'HTTP/1.1' # keep the connection alive
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            if self.server.fail > 0:
+                self.server.fail -= 1
+                status = 503
+            else:
+                self.server.writes.append(body.decode('utf-8').split('\n')[:-1])
+                status = 204
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class test_influx(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), influx_handler)
+        self.server.lock = threading.Lock()
+        self.server.writes = []
+        self.server.fail = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.dir = tempfile.mkdtemp()
+        self.spool = os.path.join(self.dir, 'spool.txt')
+        self.writer = None
+
+    def tearDown(self):
+        if self.writer is not None:
+            self.writer.close(timeout=5)
+            self.writer.disconnect()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def make_writer(self, start=True, **kwargs):
+        args = dict(host='127.0.0.1', port=self.server.server_address[1],
+            batch_size=10, flush_time=0.2, spool_file=self.spool,
+            retry_time=0.1, timeout=2)
+        args.update(kwargs)
+        self.writer = InfluxWriter(**args)
+        if start: self.writer.start()
+        return self.writer
+
+    def points(self, n, start=0):
+        return ['test,tag=a value=%s %s'%(i, i) for i in range(start, start+n)]
+
+    def wait_for(self, n, timeout=5):
+        """Wait until the server has received n points in total."""
+        t_end = time.time() + timeout
+        while time.time() < t_end:
+            with self.server.lock:
+                if sum(map(len, self.server.writes)) >= n: return True
+            time.sleep(0.01)
+        return False
+
+    def received(self):
+        with self.server.lock:
+            return [line for w in self.server.writes for line in w]
+
+    def test_batching(self):
+        """Points arriving together are sent in batches of batch_size."""
+        w = self.make_writer(start=False)
+        for line in self.points(25): w.add_point(line)
+        w.start()
+        self.assertTrue(self.wait_for(25))
+        self.assertEqual([len(b) for b in self.server.writes], [10, 10, 5])
+        self.assertEqual(self.received(), self.points(25))
+        self.assertEqual(w.get_stats()['batches'], 3)
+
+    def test_flush_time(self):
+        """A part batch is sent once flush_time has passed."""
+        w = self.make_writer()
+        for line in self.points(3): w.add_point(line)
+        self.assertTrue(self.wait_for(3, timeout=2))
+        self.assertEqual(self.received(), self.points(3))
+
+    def test_retry(self):
+        """A refused write is spooled, then resent after retry_time."""
+        self.server.fail = 1
+        w = self.make_writer()
+        for line in self.points(5): w.add_point(line)
+        self.assertTrue(self.wait_for(5))
+        self.assertEqual(self.received(), self.points(5))
+        stats = w.get_stats()
+        self.assertEqual((stats['failed'], stats['spooled'], stats['resent']), (1, 5, 5))
+        self.assertEqual(w.spool_size(), 0)
+
+    def test_spool_replay(self):
+        """Points left in the spool are sent before new points."""
+        with open(self.spool, 'w') as f:
+            f.write('\n'.join(self.points(15)) + '\n')
+        w = self.make_writer()
+        for line in self.points(5, 15): w.add_point(line)
+        self.assertTrue(self.wait_for(20))
+        self.assertEqual(self.received(), self.points(20))
+        self.assertFalse(os.path.exists(self.spool + '.sending'))
+
+    def test_failed_resend(self):
+        """If the resend stops part way, even by raising, the rest goes 
+        back in the spool in front of points spooled meanwhile."""
+        with open(self.spool, 'w') as f:
+            f.write('\n'.join(self.points(25)) + '\n')
+        w = self.make_writer(start=False)
+        post = w.post
+        def post_once(lines):
+            if self.received(): raise RuntimeError('connection lost')
+            w.spool(self.points(1, 25)) # arrives while the spool is sent
+            return post(lines)
+        w.post = post_once
+        self.assertRaises(RuntimeError, w.resend_spool)
+        self.assertEqual(self.received(), self.points(10))
+        with open(self.spool) as f:
+            self.assertEqual(f.read().split('\n')[:-1], self.points(16, 10))
+        self.assertFalse(os.path.exists(self.spool + '.sending'))
+        w.post = post
+        self.assertTrue(w.resend_spool())
+        self.assertEqual(self.received(), self.points(26))
+
+    def test_full_queue(self):
+        """add_point doesn't write to the disk when the queue is full, the
+        writer thread spools the extra points."""
+        w = self.make_writer(start=False, max_queue=5)
+        for line in self.points(8): w.add_point(line)
+        self.assertEqual(w.spool_size(), 0)
+        self.assertEqual(w.get_stats()['queue_depth'], 8)
+        w.start()
+        self.assertTrue(self.wait_for(8))
+        self.assertEqual(sorted(self.received()), sorted(self.points(8)))
+
+if __name__ == "__main__":
+    unittest.main()
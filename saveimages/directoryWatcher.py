@@ -10,17 +10,31 @@ Assuming that image files are ASCII
 watchdog creates an observer that waits for file creation events
 the observer must be initiated and shut down properly to ensure that there isn't
 one running behind the scenes which might overwrite previously saved files.
+
+On Linux, dir_watcher(inotify=True) uses inotify_event_handler instead, which
+reacts to files being closed after writing, renames them into the storage
+directory, and keeps the DExTer file number up to date from notifications
+that the sync file changed. Per-file latency is recorded in linkstats under
+'Directory watcher'.
 """
 import numpy as np
 import os
+import sys
 import time
 import shutil
 try:
     from PyQt4.QtCore import QThread, pyqtSignal, QEvent
 except ImportError:
     from PyQt5.QtCore import QThread, pyqtSignal, QEvent
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError: # the inotify watcher doesn't need watchdog
+    Observer = None
+    class FileSystemEventHandler: pass
+if '..' not in sys.path: sys.path.append('..')
+from saveimages.inotifyWatch import Inotify, available, IN_CLOSE_WRITE, IN_MOVED_TO, IN_Q_OVERFLOW
+from networking.linkstats import get_link
 
 ####    ####    ####    ####
     
@@ -150,6 +164,130 @@ class silent_event_handler(system_event_handler):
         self.event_t = self.end_t - t0 # duration of event
 
 ####    ####    ####    ####   
+
+# an event handler that uses inotify on Linux instead of watchdog
+class inotify_event_handler(system_event_handler):
+    """Watch the image read directory with inotify and move new images
+    into the image storage directory.
+    
+    Files are handled once they're closed after writing (or moved into the
+    directory), so there's no need to wait for the file size to settle.
+    All of the events that arrive together are processed as a batch. Files
+    are renamed into the storage directory if it's on the same file system,
+    otherwise copied then deleted. The DExTer file number is read when the
+    sync file changes rather than for every image.
+    Keyword arguments:
+    image_storage_path    -- the directory to save the new images to
+    dexter_sync_file_name -- the absolute path to the file with the DExTer sync number
+    date                  -- today's date in string format [day][short month][year]
+    image_read_path       -- the directory that new images are written to
+    """
+    event_path = pyqtSignal(str)
+    
+    def __init__(self, image_storage_path, dexter_sync_file_name, date, image_read_path):
+        system_event_handler.__init__(self, image_storage_path, dexter_sync_file_name, date)
+        # inotify gives back the path that was watched, so normalise them for the comparisons
+        self.image_read_path = os.path.abspath(image_read_path)
+        self.sync_dir, self.sync_name = os.path.split(os.path.abspath(dexter_sync_file_name))
+        self.sync_num = None      # the file number last read from the sync file
+        self.watching = False     # the thread runs while this is True
+        self.latency = 0          # time from noticing the last file to emitting its path
+        self.stats = get_link('Directory watcher') # per-file latency and burst size
+        self.inotify = Inotify()
+        self.inotify.add_watch(self.image_read_path, IN_CLOSE_WRITE | IN_MOVED_TO)
+        if self.sync_dir != self.image_read_path:
+            self.inotify.add_watch(self.sync_dir, IN_CLOSE_WRITE | IN_MOVED_TO)
+        self.read_sync_file()
+
+    def read_sync_file(self):
+        """Update the cached DExTer file number from the sync file. If the file
+        is empty then DExTer is still writing it, and there will be another
+        event when it's finished."""
+        try:
+            with open(self.dexter_sync_file_name, 'r') as sync_file:
+                text = sync_file.read()
+            self.sync_num = int(text)
+        except (OSError, ValueError): pass
+
+    def sync_dexter(self, dt=1e-3):
+        """Set the Dexter file number from the cached sync number. As before, 
+        if it hasn't changed since the last image then DExTer hasn't updated 
+        the file yet, so the next number is used."""
+        if self.sync_num is None: # haven't had a valid sync file yet
+            return system_event_handler.sync_dexter(self, dt)
+        if self.dfn != str(self.sync_num):
+            self.dfn = str(self.sync_num)
+        else: self.dfn = str(self.sync_num + 1)
+
+    def move_file(self, src, dst):
+        """Rename src to dst if they're on the same file system, otherwise 
+        copy it and delete the original."""
+        try: os.rename(src, dst)
+        except OSError: # e.g. different file systems
+            shutil.copyfile(src, dst)
+            os.remove(src)
+
+    def process_batch(self, names, t_event):
+        """Move each of the new files in names into the storage directory with 
+        a synced label and emit the new file names in order.
+        t_event is the time that the events were read."""
+        self.stats.set_queue_depth(len(names)) # size of the burst
+        for name in names:
+            t0 = time.time()
+            src = os.path.join(self.image_read_path, name)
+            if not os.path.isfile(src): continue # already moved or deleted
+            self.idle_t = t0 - self.end_t
+            self.sync_dexter()
+            ext = name.split('.')[-1]
+            new_file_name = os.path.join(self.image_storage_path, self.species)+'_'+self.date+'_'+self.dfn+'.'+ext
+            if os.path.isfile(new_file_name): # don't overwrite files
+                new_file_name = os.path.join(self.image_storage_path, self.species)+'_'+self.date+'_'+self.dfn+'_'+str(self.nfn)+'.'+ext
+                self.nfn += 1 # always a unique number
+            try:
+                self.move_file(src, new_file_name)
+            except OSError as e:
+                print('WARNING: directory watcher could not move %s to %s\n'%(src, new_file_name)+str(e))
+                continue
+            self.copy_t = time.time() - t0
+            self.last_event_path = new_file_name
+            self.event_path.emit(new_file_name)
+            self.end_t = time.time()
+            self.event_t = self.end_t - t0
+            self.latency = self.end_t - t_event
+            self.stats.record('latency', self.latency)
+
+    def run(self):
+        """Read batches of inotify events until stop() is called. The events
+        are handled in order, so images that arrived before the sync file
+        changed are labelled with the previous file number."""
+        self.watching = True
+        while self.watching:
+            events = self.inotify.read(timeout=0.2)
+            if not events: continue
+            t_event = time.time()
+            names = []
+            for path, mask, name in events:
+                if mask & IN_Q_OVERFLOW: # lost events: pick up any files left behind
+                    print('WARNING: directory watcher event queue overflowed.')
+                    names += sorted(os.listdir(self.image_read_path))
+                    self.process_batch(names, t_event)
+                    names = []
+                    self.read_sync_file()
+                elif path == self.sync_dir and name == self.sync_name:
+                    self.process_batch(names, t_event)
+                    names = []
+                    self.read_sync_file()
+                elif path == self.image_read_path and name and name not in names:
+                    names.append(name)
+            self.process_batch(names, t_event)
+
+    def stop(self):
+        """Stop the thread and remove the inotify watches."""
+        self.watching = False
+        self.wait()
+        self.inotify.close()
+
+####    ####    ####    ####   
     
 # setup up a watcher to detect changes in the image read directory
 class dir_watcher(QThread):
@@ -170,8 +308,12 @@ class dir_watcher(QThread):
         image_read_path       -- directory that new image creation
                 events will occur in.
         results_path          -- directory for results to be stored in
+    active  -- whether the event handler moves the new files, or only 
+        emits their paths.
+    inotify -- on Linux, use inotify_event_handler instead of watchdog.
+        Only for the active event handler.
     """
-    def __init__(self, config_file='./config/config.dat', active=True):
+    def __init__(self, config_file='./config/config.dat', active=True, inotify=False):
         super().__init__()
         # load paths used from config.dat
         self.dirs_dict = self.get_dirs(config_file)  # handy dict contains them all
@@ -180,7 +322,18 @@ class dir_watcher(QThread):
         self.dexter_sync_file_name = self.dirs_dict['Dexter Sync File: ']
         self.image_read_path = self.dirs_dict['Image Read Path: ']
         self.results_path = self.dirs_dict['Results Path: ']
-        if self.image_storage_path: # =0 if get_dirs couldn't find config.dat, else continue
+        self.observer = None
+        if self.image_storage_path and inotify and active and available():
+            self.date = time.strftime("%d %b %B %Y", time.localtime()).split(" ") # day short_month long_month year
+            self.image_storage_path = os.path.join(self.image_storage_path, 
+                self.date[3], self.date[2], self.date[0])
+            os.makedirs(self.image_storage_path, exist_ok=True)
+            self.event_handler = inotify_event_handler(self.image_storage_path,
+                self.dexter_sync_file_name, self.date[0]+self.date[1]+self.date[3],
+                self.image_read_path)
+            self.event_handler.start()
+        elif self.image_storage_path: # =0 if get_dirs couldn't find config.dat, else continue
+            if inotify: print('WARNING: inotify is not available, using watchdog.')
             # create the watchdog object
             self.observer = Observer()
             # get the date to be used for file labeling
@@ -240,6 +393,14 @@ class dir_watcher(QThread):
     
     def run(self):
         pass
+
+    def stop_watching(self):
+        """Stop the watchdog observer or the inotify event handler."""
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        elif hasattr(self, 'event_handler'):
+            self.event_handler.stop()
         
     def save_config(self, config_file='./config/config.dat'):
         """Write the directories currently in use into a new config file."""
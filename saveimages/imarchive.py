@@ -0,0 +1,243 @@
+"""PyDex - image archive
+
+ - Append the images from a multirun into one archive per measure directory
+ instead of thousands of small files.
+ - The pixel data is appended to chunk files, archive_00000.dat, ... which
+ are read back through memory maps, so loading an image doesn't copy it.
+ - Each image has a fixed size record in archive_index.dat:
+    run # | image # | ROI window (x0, y0, x1, y1) | chunk # | offset |
+    rows | columns | dtype code | CRC32 of the data | time saved
+ - Appends are crash-safe: the data is written before its index record, so
+ a record only exists for complete data. When an archive is opened, a torn
+ index record, records pointing past the end of the data, and data without
+ a record are all cut off.
+ - Images are looked up by (run #, image #, ROI) or selected by a range of
+ run numbers with vectorised queries on the index.
+"""
+import os
+import sys
+import time
+import zlib
+import threading
+import numpy as np
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info
+from saveimages.imformat import choose_dtype, DTYPES
+
+INDEX_FILE = 'archive_index.dat'
+CHUNK_FILE = 'archive_%05d.dat'
+INDEX = np.dtype([('run','<u4'), ('imn','<i4'), ('roi','<i4',(4,)), ('chunk','<u4'),
+    ('offset','<u8'), ('rows','<u4'), ('cols','<u4'), ('dtype','S1'), ('crc','<u4'),
+    ('time','<f8')])
+
+def find_archives(dir_name):
+    """Return the directories in dir_name (including itself) that contain
+    an image archive."""
+    dirs = []
+    for root, _, files in os.walk(dir_name):
+        if INDEX_FILE in files: dirs.append(root)
+    return dirs
+
+class ImageArchive:
+    """An append-only store of images, indexed by run number, image number,
+    and the ROI window that was saved.
+    Keyword arguments:
+    dir_name   -- directory to keep the archive files in. Created if needed.
+    readonly   -- if True, don't allow appends or recover the files.
+    chunk_size -- start a new chunk file when the current one reaches
+        this size in bytes.
+    sync       -- if True, fsync the data and index after every append.
+        Slower, but safe against power loss as well as crashes."""
+    def __init__(self, dir_name, readonly=False, chunk_size=2**30, sync=False):
+        self.dir = dir_name
+        self.readonly = readonly
+        self.chunk_size = chunk_size
+        self.sync = sync
+        self.lock = threading.Lock()
+        self._maps = {}   # memory maps of the chunk files
+        self._new = []    # records appended since the index was last built
+        self._data = None # open file for the current chunk
+        self._ind  = None # open index file
+        if not readonly: os.makedirs(dir_name, exist_ok=True)
+        self.index = self.load_index()
+        self.keys = {}   # position in the index by (run #, image #, ROI)
+        self.frames = {} # position in the index by (run #, image #)
+        for i, r in enumerate(self.index): self.add_key(r, i)
+        if not readonly: self.open_files()
+
+    @staticmethod
+    def key(record):
+        return (int(record['run']), int(record['imn']), tuple(map(int, record['roi'])))
+
+    def add_key(self, r, i):
+        k = self.key(r)
+        self.keys[k] = i
+        self.frames[k[:2]] = i
+
+    def path(self, chunk):
+        return os.path.join(self.dir, CHUNK_FILE%chunk)
+
+    def nbytes(self, r):
+        """Size of the data for an index record."""
+        return int(r['rows']) * int(r['cols']) * DTYPES[r['dtype']].itemsize
+
+    def load_index(self):
+        """Read the index file, recovering from an interrupted append."""
+        fn = os.path.join(self.dir, INDEX_FILE)
+        try:
+            with open(fn, 'rb') as f: buf = f.read()
+        except FileNotFoundError: return np.zeros(0, dtype=INDEX)
+        n = len(buf) // INDEX.itemsize
+        index = np.frombuffer(buf[:n*INDEX.itemsize], dtype=INDEX).copy()
+        while n: # drop records whose data is missing or corrupted
+            r = index[n-1]
+            try: size = os.path.getsize(self.path(r['chunk']))
+            except OSError: size = 0
+            if size >= int(r['offset']) + self.nbytes(r) and r['crc'] == self.crc(r):
+                break
+            n -= 1
+        if n < len(index) or len(buf) % INDEX.itemsize:
+            if n < len(index):
+                warning('Image archive %s: dropped %s incomplete images'%(self.dir, len(index)-n))
+            index = index[:n]
+            if not self.readonly:
+                with open(fn, 'r+b') as f: f.truncate(n*INDEX.itemsize)
+        return index
+
+    def crc(self, r):
+        """CRC32 of the data on disk for an index record."""
+        with open(self.path(r['chunk']), 'rb') as f:
+            f.seek(int(r['offset']))
+            return zlib.crc32(f.read(self.nbytes(r)))
+
+    def open_files(self):
+        """Open the current chunk and the index for appending. Data written
+        after the last index record is from an interrupted append: cut it off."""
+        if len(self.index):
+            last = self.index[-1]
+            self.chunk, self.offset = int(last['chunk']), int(last['offset']) + self.nbytes(last)
+        else: self.chunk, self.offset = 0, 0
+        while os.path.isfile(self.path(self.chunk+1)): # a new chunk was started
+            self.chunk += 1
+            self.offset = 0
+        fn = self.path(self.chunk)
+        if os.path.isfile(fn) and os.path.getsize(fn) > self.offset:
+            with open(fn, 'r+b') as f: f.truncate(self.offset)
+        self._data = open(fn, 'ab')
+        self._ind  = open(os.path.join(self.dir, INDEX_FILE), 'ab')
+
+    def append(self, im, run, imn=0, roi=None):
+        """Append an image to the archive.
+        Keyword arguments:
+        im  -- 2D array of pixel counts
+        run -- the run number (Dexter file #)
+        imn -- the image number in the sequence
+        roi -- (x0, y0, x1, y1) if im is the window im[x0:x1, y0:y1] of
+            a full image. Default: the full image."""
+        if self.readonly: raise PermissionError('Image archive %s is read only'%self.dir)
+        im = np.atleast_2d(im)
+        code = choose_dtype(im)
+        data = np.ascontiguousarray(im, dtype=DTYPES[code]).tobytes()
+        if roi is None: roi = (0, 0, im.shape[0], im.shape[1])
+        with self.lock:
+            if self.offset and self.offset + len(data) > self.chunk_size:
+                self._data.close()
+                self.chunk += 1
+                self.offset = 0
+                self._data = open(self.path(self.chunk), 'ab')
+            self._data.write(data)
+            self._data.flush()
+            if self.sync: os.fsync(self._data.fileno())
+            r = np.array([(run, imn, roi, self.chunk, self.offset, im.shape[0],
+                im.shape[1], code, zlib.crc32(data), time.time())], dtype=INDEX)
+            self._ind.write(r.tobytes())
+            self._ind.flush()
+            if self.sync: os.fsync(self._ind.fileno())
+            self.offset += len(data)
+            self.add_key(r[0], len(self.index) + len(self._new))
+            self._new.append(r)
+
+    def get_index(self):
+        """Return the index of all records as a structured array."""
+        with self.lock:
+            if self._new:
+                self.index = np.concatenate([self.index] + self._new)
+                self._new = []
+            return self.index
+
+    def __len__(self):
+        return len(self.index) + len(self._new)
+
+    def __contains__(self, key):
+        return self.find(*key) is not None
+
+    def find(self, run, imn=0, roi=None):
+        """Return the position in the index of an image, or None. If roi is
+        None, match any window saved for this run and image number (the last appended)."""
+        if roi is not None:
+            return self.keys.get((int(run), int(imn), tuple(map(int, roi))))
+        return self.frames.get((int(run), int(imn)))
+
+    def load(self, i):
+        """Return the image at position i in the index as a read-only
+        view of the memory mapped chunk."""
+        r = self.get_index()[i]
+        c, start = int(r['chunk']), int(r['offset'])
+        end = start + self.nbytes(r)
+        mm = self._maps.get(c)
+        if mm is None or len(mm) < end: # map the chunk again if it has grown
+            mm = np.memmap(self.path(c), dtype=np.uint8, mode='r')
+            self._maps[c] = mm
+        return mm[start:end].view(DTYPES[r['dtype']]).reshape(int(r['rows']), int(r['cols']))
+
+    def get(self, run, imn=0, roi=None):
+        """Return the image for this run and image number, or None."""
+        i = self.find(run, imn, roi)
+        return None if i is None else self.load(i)
+
+    def select(self, run_min=0, run_max=None, imn=None, roi=None):
+        """Return the positions in the index of the images with run numbers
+        run_min <= run < run_max, in order of run number.
+        imn -- only select this image number. None for all.
+        roi -- only select this ROI window. None for all."""
+        index = self.get_index()
+        mask = index['run'] >= run_min
+        if run_max is not None: mask &= index['run'] < run_max
+        if imn is not None: mask &= index['imn'] == imn
+        if roi is not None: mask &= np.all(index['roi'] == roi, axis=1)
+        inds = np.flatnonzero(mask)
+        return inds[np.argsort(index['run'][inds], kind='stable')]
+
+    def query(self, run_min=0, run_max=None, imn=None, roi=None):
+        """Generator of (run #, image # , image) for the selected images."""
+        index = self.get_index()
+        for i in self.select(run_min, run_max, imn, roi):
+            yield int(index['run'][i]), int(index['imn'][i]), self.load(i)
+
+    def stack(self, run_min=0, run_max=None, imn=0, roi=None):
+        """Return (runs, images): the run numbers and a 3D array of the
+        selected images, which must all have the same shape."""
+        index = self.get_index()
+        inds = self.select(run_min, run_max, imn, roi)
+        if not len(inds): return np.zeros(0, dtype=int), np.zeros((0,0,0))
+        ims = np.empty((len(inds), int(index['rows'][inds[0]]), int(index['cols'][inds[0]])),
+            dtype=DTYPES[index['dtype'][inds[0]]])
+        for j, i in enumerate(inds):
+            ims[j] = self.load(i)
+        return index['run'][inds].astype(int), ims
+
+    def fsync(self):
+        """Make sure that everything appended so far is on disk."""
+        with self.lock:
+            for f in [self._data, self._ind]:
+                if f is not None: os.fsync(f.fileno())
+
+    def close(self):
+        """Close the files. The archive can be opened again to append."""
+        with self.lock:
+            for f in [self._data, self._ind]:
+                if f is not None:
+                    if self.sync: os.fsync(f.fileno())
+                    f.close()
+            self._data, self._ind = None, None
+        self._maps = {}
@@ -0,0 +1,247 @@
+"""PyDex - binary image format
+
+ - Save images as raw binary with a small header instead of ASCII text.
+ Writing and reading are just a copy of the array, rather than formatting
+ and parsing every pixel as text.
+ - Header (little-endian, 32 bytes):
+    magic b'PDXI' | version (uint8) | dtype code (char) | 2 bytes padding |
+    rows (uint32) | columns (uint32) | Dexter file # (uint32) |
+    image # (int32) | time saved (float64)
+ - The pixel data follows in C order. Camera counts are stored as uint16
+ when they fit, otherwise int32 or float64.
+ - load_image() and image_shape() accept either the binary format or the
+ ASCII format (where the first column is the row number), so the readers
+ don't need to know which was used.
+ - ASCII images of whole numbers are parsed from the raw bytes with numpy
+ (parse_asc) instead of loadtxt. Other ASCII files fall back to loadtxt.
+ - iter_images() loads a list of files in parallel threads, so that the
+ next files are read while the current one is processed.
+ - Convert an existing directory of .asc files with:
+    python imformat.py [directory] [--remove]
+"""
+import os
+import sys
+import time
+import struct
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+if '..' not in sys.path: sys.path.append('..')
+from strtypes import error, warning, info
+
+MAGIC   = b'PDXI'
+VERSION = 1
+HEADER  = struct.Struct('<4sBc2xIIIid')
+BIN_EXT = '.pdx' # extension for the binary format
+ASC_EXT = '.asc' # extension for the ASCII format
+DTYPES  = {b'H':np.dtype('<u2'), b'i':np.dtype('<i4'), b'd':np.dtype('<f8')}
+
+def choose_dtype(im):
+    """Return the code for the smallest dtype that holds the image exactly."""
+    if np.issubdtype(im.dtype, np.integer) or np.all(np.mod(im, 1) == 0):
+        if im.size == 0 or (im.min() >= 0 and im.max() < 2**16): return b'H'
+        elif im.min() >= -2**31 and im.max() < 2**31: return b'i'
+    return b'd'
+
+def is_binary(file_name):
+    """Check the extension, or the magic bytes if the extension is unknown."""
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext == BIN_EXT: return True
+    elif ext == ASC_EXT: return False
+    try:
+        with open(file_name, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError: return False
+
+def find_image(file_name):
+    """Return the name of the image file that exists, trying the binary
+    extension if the ASCII file isn't found (and vice versa)."""
+    if os.path.isfile(file_name): return file_name
+    base, ext = os.path.splitext(file_name)
+    other = base + (ASC_EXT if ext.lower() == BIN_EXT else BIN_EXT)
+    return other if os.path.isfile(other) else file_name
+
+def write_image(file_name, im, dfn=0, imn=0):
+    """Save the image array in the binary format.
+    Keyword arguments:
+    file_name -- the path to save to, usually ending in .pdx
+    im        -- 2D array of pixel counts
+    dfn       -- Dexter file number, stored in the header
+    imn       -- image number in the sequence, stored in the header"""
+    im = np.atleast_2d(im)
+    code = choose_dtype(im)
+    head = HEADER.pack(MAGIC, VERSION, code, im.shape[0], im.shape[1],
+        int(dfn), int(imn), time.time())
+    with open(file_name, 'wb') as f:
+        f.write(head)
+        f.write(np.ascontiguousarray(im, dtype=DTYPES[code]).tobytes())
+
+def read_header(file_name):
+    """Return a dictionary of the values in the header of a binary image."""
+    with open(file_name, 'rb') as f:
+        buf = f.read(HEADER.size)
+    magic, version, code, rows, cols, dfn, imn, t = HEADER.unpack(buf)
+    if magic != MAGIC:
+        raise ValueError('Not a PyDex binary image: '+file_name)
+    return {'version':version, 'dtype':DTYPES[code], 'rows':rows,
+        'columns':cols, 'File ID':dfn, 'Image #':imn, 'Time':t}
+
+def read_image(file_name):
+    """Load a binary image as an array with the shape it was saved with."""
+    head = read_header(file_name)
+    im = np.fromfile(file_name, dtype=head['dtype'],
+        count=head['rows']*head['columns'], offset=HEADER.size)
+    return im.reshape(head['rows'], head['columns'])
+
+ASC_CHARS = b'0123456789. \t\r\n' # the only characters parse_asc accepts
+
+def parse_asc(buf, delim=' '):
+    """Parse the bytes of an ASCII image, where each line is the row number
+    followed by the pixel counts as whole numbers (e.g. 697 or 697.0).
+    Returns a float array including the row number column, or None if the
+    text has any other characters (signs, exponents, decimals or another
+    delimiter) or the rows aren't all the same length.
+    The digits of all the numbers are combined at once: the n-th digit
+    from the end of every number is read in one step."""
+    if delim.strip() or buf.translate(None, ASC_CHARS): return None
+    if not buf.endswith(b'\n'): buf += b'\n'
+    c = np.frombuffer(buf, np.uint8)
+    d = c - np.uint8(48) # digits, anything else wraps around to >= 10
+    isd = d < 10
+    if b'.' in buf: # savetxt writes the float images as 697.0
+        dot = c[:-2] == ord('.')
+        if c[0] == ord('.') or np.any(dot & (c[1:-1] != ord('0'))) or np.any(dot & isd[2:]
+                ) or np.any(dot[1:] & ~isd[:-3]):
+            return None # not a whole number
+        isd[1:-1] &= ~dot # end the number at the decimal point
+    e = np.flatnonzero(isd[1:] != isd[:-1]) + 1 # where each number starts and ends
+    if isd[0]: e = np.concatenate(([0], e))
+    ends = e[1::2]
+    if not ends.size: return None
+    lens = ends - e[0::2]
+    vals = d[ends-1].astype(float)
+    for k in range(2, int(lens.max())+1):
+        vals += d[ends-k] * (lens >= k) * 10.0**(k-1) # don't take digits from the previous number
+    newlines = np.flatnonzero(c == ord('\n'))
+    ncols = np.searchsorted(ends, newlines[0], 'right') # from the first line
+    rows = vals.size // ncols if ncols > 1 else 0
+    if rows*ncols != vals.size or len(newlines) != rows or np.any(
+            np.searchsorted(ends, newlines, 'right') != np.arange(1, rows+1)*ncols):
+        return None # blank lines or rows of different lengths
+    return vals.reshape(rows, ncols)
+
+def read_asc(file_name, delim=' ', width=0):
+    """Load an ASCII image, dropping the first column which is the row number.
+    width -- number of columns of pixels to load. 0 loads all of them."""
+    with open(file_name, 'rb') as f:
+        im = parse_asc(f.read(), delim)
+    if im is not None and width < im.shape[1]:
+        return im[:, 1:width+1 if width else None]
+    if width:
+        return np.loadtxt(file_name, delimiter=delim, usecols=range(1,width+1), ndmin=2)
+    return np.loadtxt(file_name, delimiter=delim, ndmin=2)[:,1:]
+
+def load_image(file_name, delim=' ', width=0):
+    """Load an image saved in either the binary or the ASCII format. Returns
+    an array with the same shape as the array that was saved.
+    Keyword arguments:
+    file_name -- absolute path to the image file
+    delim     -- delimiter used in ASCII files
+    width     -- for ASCII files, the number of columns of pixels to load."""
+    if is_binary(file_name): # as float like the ASCII images, so that subtracting a bias can't overflow
+        return read_image(file_name).astype(float)
+    return read_asc(file_name, delim, width)
+
+def image_shape(file_name, delim=' '):
+    """Return the (width, height) of an image file, where the width is the
+    number of columns of pixels and the height the number of rows. Only
+    the header or the first line is parsed."""
+    if is_binary(file_name):
+        head = read_header(file_name)
+        return head['columns'], head['rows']
+    with open(file_name, 'r') as f:
+        width = len(f.readline().strip().split(delim)) - 1 # first column is row number
+        height = 1 + sum(1 for line in f if line.strip())
+    return width, height
+
+def iter_images(file_names, load=None, workers=4):
+    """Load the image files in a pool of threads, yielding (file name, image) 
+    in the same order as file_names while the next files are loading. If a 
+    file fails to load, the exception is yielded in place of the image.
+    Keyword arguments:
+    file_names -- list of paths to the image files.
+    load       -- function that takes a file name and returns the image.
+        Default load_image.
+    workers    -- number of threads loading files at once."""
+    load = load if load else load_image
+    def try_load(file_name):
+        try: return load(file_name)
+        except Exception as e: return e
+    file_names = list(file_names)
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='image_load') as pool:
+        futures = [pool.submit(try_load, fn) for fn in file_names[:2*workers]]
+        for i, fn in enumerate(file_names): # keep a few files ahead of the one being used
+            if i + 2*workers < len(file_names):
+                futures.append(pool.submit(try_load, file_names[i + 2*workers]))
+            yield fn, futures[i].result()
+            futures[i] = None
+
+def load_dir(dir_name, ext=ASC_EXT, delim=' ', workers=4):
+    """Load all of the images with extension ext in dir_name, sorted by
+    their Dexter file number and image number. Returns lists of the file
+    names and the image arrays. Files that fail to load are left out."""
+    names = sorted((fn for fn in os.listdir(dir_name) if fn.lower().endswith(ext)),
+        key=lambda fn: (parse_name(fn), fn))
+    file_names, ims = [], []
+    for fn, im in iter_images([os.path.join(dir_name, fn) for fn in names],
+            lambda f: load_image(f, delim), workers):
+        if isinstance(im, Exception):
+            warning('Failed to load image '+fn+'\n'+str(im))
+        else:
+            file_names.append(fn)
+            ims.append(im)
+    return file_names, ims
+
+####    ####    ####    ####
+
+def parse_name(file_name):
+    """Get the Dexter file number and image number from an image file name
+    [label]_[date]_[Dexter file #]_[image #](_[n]).asc"""
+    parts = os.path.splitext(os.path.basename(file_name))[0].split('_')
+    try: return int(parts[2]), int(parts[3])
+    except (IndexError, ValueError): return 0, 0
+
+def asc_to_binary(file_name, remove=False):
+    """Convert an ASCII image file to the binary format, saved with the same
+    name but the binary extension. Returns the new file name.
+    remove -- delete the ASCII file once the binary file is saved."""
+    new_name = os.path.splitext(file_name)[0] + BIN_EXT
+    im = read_asc(file_name)
+    write_image(new_name, im, *parse_name(file_name))
+    if not np.array_equal(read_image(new_name), im):
+        raise ValueError('Converted image does not match the original: '+file_name)
+    if remove: os.remove(file_name)
+    return new_name
+
+def convert_dir(dir_name, remove=False):
+    """Convert all of the ASCII images in dir_name and its subdirectories
+    to the binary format. Files that already have a binary copy are
+    skipped. Returns the number of files converted."""
+    n = 0
+    for root, dirs, files in os.walk(dir_name):
+        for fn in files:
+            if fn.lower().endswith(ASC_EXT):
+                asc_name = os.path.join(root, fn)
+                if os.path.isfile(os.path.splitext(asc_name)[0] + BIN_EXT):
+                    continue
+                try:
+                    asc_to_binary(asc_name, remove)
+                    n += 1
+                except (OSError, ValueError) as e:
+                    warning('Failed to convert image '+asc_name+'\n'+str(e))
+    return n
+
+if __name__ == "__main__":
+    dir_name = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != '--remove' else '.'
+    t0 = time.time()
+    n = convert_dir(dir_name, remove='--remove' in sys.argv)
+    info('Converted %s images in %s to binary in %.3g s'%(n, dir_name, time.time() - t0))
@@ -2,21 +2,38 @@
 Stefan Spence 09/09/19
 
  - receive an image array through a signal
- - add the received image array to a list to save
- - run a thread saving images from the list into a dated 
-    subdirectory under image_storage_path
+ - add the received image array to a bounded queue to save, fixing its
+    file name from the current Dexter file # and image #
+ - run a thread taking batches of images from the queue and saving them
+    with a pool of writer threads into a dated subdirectory under
+    image_storage_path
+ - if the queue is full, block, drop, or spool images to local disk
+ - queue depth, write latency and bytes/s are recorded in linkstats
+    under 'Image saver'
+ - images are saved as ASCII (.asc) by default, or in the binary format
+    from imformat (.pdx) if the config file has the line
+    image format = binary
+ - with 'image format = archive', images from a multirun are appended to
+    an ImageArchive in the measure directory, and others saved as binary.
  
-Assuming that image files are ASCII.
 This runs as a QThread in parallel to other tasks
 """
 import numpy as np
 import os
 import sys
 import time
-from PyQt5.QtCore import pyqtSignal
+import queue
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import QThread, pyqtSignal
 if '..' not in sys.path: sys.path.append('..')
-from mythread import PyDexThread
+from mythread import reset_slot
 from strtypes import error, warning, info
+from saveimages.imformat import write_image, BIN_EXT, ASC_EXT
+from saveimages.imarchive import ImageArchive
+from networking.linkstats import get_link
 
 def checkdir(text):
     """Shorthand for extracting a directory from the config file"""
@@ -26,14 +43,15 @@ def checkdir(text):
 ####    ####    ####    ####
     
 # set up an event handler that is also a QObject through inheritance of QThread
-class event_handler(PyDexThread):
+class event_handler(QThread):
     """Save the image array that is passed through a signal to a file.
     
-    The event handler responds to a signal by appending the array to a
-    list. When the thread is running it will pop images from the list
-    and save the image array to a new directory, and then emit a 
-    signal to confirm the saving has finished. The Dexter file number 
-    and image number should be synced externally.
+    The event handler responds to a signal by adding the array to a
+    queue. When the thread is running it will take batches of images
+    from the queue and save them to a new directory using a pool of 
+    writer threads, and then emit a signal for each saved file in the
+    order they were queued. The Dexter file number and image number 
+    should be synced externally before an image is queued.
     Use a config file to load the directories.
     Wait for events and process them with the event_handler.
     Keyword arguments:
@@ -42,11 +60,24 @@ class event_handler(PyDexThread):
         image_storage_path    -- directory that new images will 
                 be written to.
         dexter_sync_file_name -- absolute path to DExTer currentfile.txt
+        image format          -- 'binary' to save in the binary format,
+                'archive' to also use an archive during multiruns
+    n_workers  -- number of threads writing files in parallel.
+    max_queue  -- max number of images waiting to be saved.
+    policy     -- what to do when the queue is full: 'block', 'spool', 'drop'
+    block_time -- max time (s) an image waits for space in the queue with 
+        'block'. The saver thread does the waiting, not the caller.
+    batch_size -- max number of images saved in one batch.
+    flush_time -- max time (s) to wait for a batch to fill up.
+    sync       -- whether to fsync files after writing them.
+    spool_dir  -- directory to spool images in when the queue is full.
     """
     event_path = pyqtSignal(str)        # the name of the saved file
     new_im     = pyqtSignal(np.ndarray) # the new incoming image array
             
-    def __init__(self, config_file='./config/config.dat'):
+    def __init__(self, config_file='./config/config.dat', n_workers=2,
+            max_queue=200, policy='spool', block_time=0.5, batch_size=8,
+            flush_time=0.02, sync=False, spool_dir='.'):
         super().__init__()
         self.dfn     = "0"         # dexter file number
         self.imn     = "0"         # ID # for when there are several images in a sequence
@@ -58,6 +89,25 @@ class event_handler(PyDexThread):
         self.end_t   = time.time() # time at end of event
         self.idle_t  = 0           # time between events
         self.write_t = 0           # time taken to watch a file being written
+        self.archive = None        # ImageArchive for the current multirun
+        self.old_archives = []     # archives to close once their images are saved
+        self.window  = None        # sensor window (x0, y0, x1, y1) of the images. None: full image
+        self.stop    = False       # toggle to stop the thread running
+        self.policy  = policy
+        self.block_time = block_time
+        self.batch_size = batch_size
+        self.flush_time = flush_time
+        self.sync    = sync
+        self.queue   = queue.Queue(maxsize=max_queue) # images waiting to be saved
+        self.pool    = ThreadPoolExecutor(max_workers=n_workers) # writer threads
+        self.spool_dir = spool_dir
+        self.spool   = None        # ImageArchive holding images when the queue is full
+        self.spooled = deque()     # jobs for the images in the spool, in order
+        self.spool_lock = threading.Lock()
+        self.blocked = deque()     # jobs waiting for space in the queue with policy 'block'
+        self.block_lock = threading.Lock()
+        self.counts  = {'saved':0, 'spooled':0, 'dropped':0, 'failed':0}
+        self.stats   = get_link('Image saver') # queue and write latencies, bytes/s
         self.config_fn = config_file  # remember which file was last used for config settings 
         self.reset_dates(config_file) # create the required directories
 
@@ -69,9 +119,10 @@ class event_handler(PyDexThread):
         self.dexter_sync_file_name = self.dirs_dict['Dexter Sync File: ']
         self.results_path = self.dirs_dict['Results Path: ']
         self.sequences_path = self.dirs_dict['Sequences path: ']
+        self.im_format = self.dirs_dict.get('Image Format: ', 'asc')
+        self.date = date # day short_month long_month year
         if self.image_storage_path: # =0 if get_dirs couldn't find config.dat, else continue
             # get the date to be used for file labeling
-            self.date = date # day short_month long_month year
             datepath = r'\%s\%s\%s'%(self.date[3],self.date[2],self.date[0])
             self.image_storage_path = self.check_path(self.image_storage_path, datepath)
             self.results_path = self.check_path(self.results_path, datepath)
@@ -96,6 +147,7 @@ class event_handler(PyDexThread):
         it can't be found"""
         image_storage_path, dexter_sync_file_name = '', ''
         sequences_path, results_path = '', ''
+        image_format = 'asc'
         # load config file for directories or prompt user if first time setup
         try:
             with open(config_file, 'r') as config_file:
@@ -112,10 +164,13 @@ class event_handler(PyDexThread):
                 results_path = checkdir(row)   # where csv files and histograms will be saved
             elif 'sequences path' in row:
                 sequences_path = checkdir(row) # where sequence xml files will be saved
+            elif 'image format' in row:
+                image_format = row.split('=')[-1].strip() # 'asc', 'binary', or 'archive'
         return {'Image Storage Path: ':image_storage_path,
                 'Dexter Sync File: ':dexter_sync_file_name,
                 'Results Path: ':results_path,
-                'Sequences path: ':sequences_path}
+                'Sequences path: ':sequences_path,
+                'Image Format: ':image_format}
         
     @staticmethod
     def print_dirs(dict_items):
@@ -142,32 +197,244 @@ class event_handler(PyDexThread):
             last_file_size = os.path.getsize(file_name)
             time.sleep(dt) # deliberately add pause so we don't loop too many times
 
-    def process(self, im_array, label='Im'):
-        """On a new image signal being emitted, save it to a file with a 
-        synced label into the image storage dir. File name format:
-        [label]_[date]_[Dexter file #].asc
-        """
-        self.t0 = time.time()
-        self.idle_t = self.t0 - self.end_t   # duration between end of last event and start of current event
-        # copy file with labeling: [label]_[date]_[Dexter file #]
-        new_file_name = os.path.join(self.image_storage_path, 
-                '_'.join([label, 
-                        self.date[0]+self.date[1]+self.date[3], 
-                        self.dfn, self.imn]) + '.asc')
-        self.write_t = time.time()
-        if os.path.isfile(new_file_name): # don't overwrite files
-            new_file_name = os.path.join(self.image_storage_path, 
-                '_'.join([label, 
-                        self.date[0]+self.date[1]+self.date[3], 
-                        self.dfn, self.imn, str(self.nfn)]) + '.asc')
+    def open_archive(self, dir_name):
+        """Append images to an archive in dir_name instead of saving them 
+        to separate files. Only used with the archive image format."""
+        if self.im_format == 'archive':
+            self.close_archive()
+            try:
+                self.archive = ImageArchive(dir_name)
+            except OSError as e:
+                error('Image saver could not open archive in '+dir_name+'\n'+str(e))
+
+    def close_archive(self):
+        """Go back to saving images as separate files. Images already queued
+        still go to the archive, which is closed once they're written."""
+        if self.archive is not None:
+            self.old_archives.append(self.archive)
+            self.archive = None
+
+    #### #### queue #### ####
+
+    def add_item(self, im_array, label='Im'):
+        """Queue an image to be saved. The file name is fixed by the Dexter
+        file number, image number, and directory at the time it's queued.
+        If the queue is full, apply the policy:
+        'block' -- hold the image until there's space in the queue, or drop
+            it after block_time. This never blocks the caller: the images
+            are moved into the queue from the saver thread.
+        'spool' -- write the image to the spool on local disk. Until the 
+            spool is empty, all new images go there to keep their order.
+        'drop'  -- drop the image.
+        Returns True if the image will be saved, or might still be with
+        'block'."""
+        job = [im_array, label, self.dfn, self.imn, self.image_storage_path,
+            self.date[0]+self.date[1]+self.date[3], self.archive, time.time(), self.window]
+        if not self.spooled and not self.blocked:
+            try:
+                self.queue.put_nowait(job)
+                self.stats.set_queue_depth(self.queue.qsize())
+                return True
+            except queue.Full: pass
+        if self.policy == 'block':
+            with self.block_lock:
+                self.drop_blocked(job[7]) # don't hold on to images that are already late
+                self.blocked.append(job)
+            return True
+        if self.policy == 'spool' and self.spool_job(job):
+            return True
+        self.drop()
+        return False
+
+    def drop(self, n=1):
+        """Count images that couldn't be saved."""
+        self.counts['dropped'] += n
+        if (self.counts['dropped'] - 1) % 100 < n: # don't flood the terminal
+            warning('Image saver queue is full: dropped %s images so far.'%self.counts['dropped'])
+
+    def drop_blocked(self, t):
+        """Drop the held images that have waited longer than block_time at
+        time t. Call with block_lock held."""
+        n = 0
+        while self.blocked and t - self.blocked[0][7] > self.block_time:
+            self.blocked.popleft()
+            n += 1
+        if n: self.drop(n)
+
+    def unblock(self):
+        """Move held images into the queue while it has space. Runs on the
+        saver thread."""
+        with self.block_lock:
+            self.drop_blocked(time.time())
+            while self.blocked:
+                try: self.queue.put_nowait(self.blocked[0])
+                except queue.Full: break
+                self.blocked.popleft()
+
+    def spool_job(self, job):
+        """Append the image to the spool archive and keep the rest of the job."""
+        with self.spool_lock:
+            try:
+                if self.spool is None:
+                    self.spool = ImageArchive(os.path.join(self.spool_dir, 
+                        'image_spool_%s'%int(time.time())))
+                    warning('Image saver queue is full: spooling images to '+self.spool.dir)
+                self.spool.append(job[0], int(job[2]), int(job[3]))
+                job[0] = len(self.spool) - 1 # position of the image in the spool
+                self.spooled.append(job)
+                self.counts['spooled'] += 1
+                return True
+            except (OSError, ValueError) as e:
+                error('Image saver failed to spool image %s_%s\n'%(job[2], job[3])+str(e))
+                return False
+
+    def next_job(self, timeout=0.1):
+        """Return the next job in order, or None. Take from the queue first, 
+        since anything in the spool arrived after the queue was full."""
+        if self.blocked: self.unblock()
+        try: return self.queue.get_nowait()
+        except queue.Empty: pass
+        with self.spool_lock:
+            if self.spooled:
+                job = self.spooled.popleft()
+                job[0] = np.array(self.spool.load(job[0])) # copy out of the memory map
+                if not self.spooled: # spool is empty, delete it
+                    self.spool.close()
+                    try: shutil.rmtree(self.spool.dir)
+                    except OSError as e: warning('Could not delete image spool.\n'+str(e))
+                    self.spool = None
+                return job
+        try: return self.queue.get(timeout=timeout)
+        except queue.Empty: return None
+
+    def get_batch(self):
+        """Collect up to batch_size images, waiting no more than flush_time
+        after the first one."""
+        job = self.next_job()
+        if job is None: return []
+        batch = [job]
+        t_end = time.time() + self.flush_time
+        while len(batch) < self.batch_size:
+            job = self.next_job(max(t_end - time.time(), 0))
+            if job is None: break
+            batch.append(job)
+        self.stats.set_queue_depth(self.queue.qsize() + len(self.spooled) + len(self.blocked))
+        return batch
+
+    def get_stats(self):
+        """Return the queue depth, counts of saved/spooled/dropped images,
+        write latency, and bytes/s."""
+        s = self.stats.summary()
+        s['spool depth'] = len(self.spooled)
+        s['blocked'] = len(self.blocked)
+        s.update(self.counts)
+        return s
+
+    #### #### writing #### ####
+
+    def file_name(self, label, dfn, imn, path, date, taken=()):
+        """Choose the name for a new file without overwriting. File name format:
+        [label]_[date]_[Dexter file #]_[image #].asc
+        or with the .pdx extension if using the binary format.
+        taken -- names already given to images that aren't written yet."""
+        ext = BIN_EXT if self.im_format in ['binary', 'archive'] else ASC_EXT
+        new_file_name = os.path.join(path, '_'.join([label, date, dfn, imn]) + ext)
+        if new_file_name in taken or os.path.isfile(new_file_name): # don't overwrite files
+            new_file_name = os.path.join(path, 
+                '_'.join([label, date, dfn, imn, str(self.nfn)]) + ext)
             self.nfn += 1 # always a unique number
-        out_arr = np.empty((im_array.shape[0],im_array.shape[1]+1))
-        out_arr[:,1:] = im_array
-        out_arr[:,0]  = np.arange(im_array.shape[0])
-        np.savetxt(new_file_name, out_arr, fmt='%s', delimiter=' ')
-
-        self.write_t = time.time() - self.write_t
-        self.last_event_path = new_file_name  # update last event path
-        self.event_path.emit(new_file_name)  # emit signal
-        self.end_t = time.time()       # time at end of current event
-        self.event_t = self.end_t - self.t0 # duration of event
+        return new_file_name
+
+    def write_file(self, file_name, im_array, dfn, imn):
+        """Save the image to a file. Runs in the writer pool.
+        Returns the number of bytes written and the time taken."""
+        t0 = time.time()
+        if file_name.endswith(BIN_EXT):
+            write_image(file_name, im_array, dfn, imn)
+        else:
+            out_arr = np.empty((im_array.shape[0],im_array.shape[1]+1))
+            out_arr[:,1:] = im_array
+            out_arr[:,0]  = np.arange(im_array.shape[0])
+            np.savetxt(file_name, out_arr, fmt='%s', delimiter=' ')
+        if self.sync:
+            fd = os.open(file_name, os.O_RDWR)
+            try: os.fsync(fd)
+            finally: os.close(fd)
+        return os.path.getsize(file_name), time.time() - t0
+
+    def write_batch(self, batch):
+        """Save a batch of images: files are written in parallel by the 
+        writer pool, archive appends in order on this thread. Then emit the
+        names of the saved files in the order the images were queued."""
+        self.t0 = time.time()
+        self.idle_t = self.t0 - self.end_t # time between end of last batch and start of this one
+        results, names, archives = [], set(), set()
+        for im_array, label, dfn, imn, path, date, archive, t_queued, window in batch:
+            self.stats.record('queue', self.t0 - t_queued)
+            if archive is not None: # multirun: append to the measure's archive
+                try:
+                    archive.append(im_array, int(dfn), int(imn), window)
+                    archives.add(archive)
+                    results.append((archive.dir, im_array.nbytes))
+                except (OSError, ValueError) as e:
+                    error('Image saver failed to append image %s_%s to archive\n'%(dfn, imn)+str(e))
+                    results.append(('', 0))
+            else:
+                file_name = self.file_name(label, dfn, imn, path, date, names)
+                names.add(file_name)
+                results.append((file_name, self.pool.submit(self.write_file, 
+                    file_name, im_array, dfn, imn)))
+        if self.sync:
+            for archive in archives: archive.fsync() # one fsync per batch
+        for file_name, result in results:
+            try:
+                if hasattr(result, 'result'): # wait for the writer
+                    nbytes, dt = result.result()
+                    self.stats.record('write', dt)
+                else: nbytes = result
+                if not file_name: raise OSError('not saved')
+                self.stats.sent(nbytes)
+                self.counts['saved'] += 1
+                self.last_event_path = file_name  # update last event path
+                self.event_path.emit(file_name)  # emit signal
+            except Exception as e:
+                self.counts['failed'] += 1
+                error('Image saver failed to save '+file_name+'\n'+str(e))
+        self.end_t = time.time()       # time at end of current batch
+        self.write_t = self.end_t - self.t0 # duration of batch
+        self.event_t = self.write_t / len(batch) # mean time per image
+        self.stats.check_rollover()
+
+    def process(self, im_array, label='Im'):
+        """Save an image straight away with a synced label into the image 
+        storage dir, or append it to the archive if one is open."""
+        self.write_batch([[im_array, label, self.dfn, self.imn, self.image_storage_path,
+            self.date[0]+self.date[1]+self.date[3], self.archive, time.time(), self.window]])
+
+    def close_old_archives(self):
+        """Close archives that have no more images queued for them."""
+        while self.old_archives:
+            self.old_archives.pop(0).close()
+
+    def run(self):
+        """Save batches of images from the queue until close() is called,
+        then save whatever is left in the queue and spool."""
+        while True:
+            batch = self.get_batch()
+            if batch: self.write_batch(batch)
+            elif self.stop: break
+            elif self.queue.empty() and not self.spooled and not self.blocked:
+                self.close_old_archives() # everything queued has been written
+        self.close_old_archives()
+        self.close_archive()
+        self.close_old_archives()
+
+    def reset_stop(self):
+        """Reset the stop toggle so that the thread can run again."""
+        self.stop = False
+
+    def close(self):
+        """Stop the thread once the queue is empty. Once the thread has 
+        stopped, reset the stop toggle so that it can be started again."""
+        reset_slot(self.finished, self.reset_stop)
+        self.stop = True
@@ -0,0 +1,89 @@
+"""Single Atom Image Analysis
+
+Watch directories for files being closed after writing, using the Linux
+inotify API through ctypes so that there are no extra dependencies.
+ - each read returns all of the events that have queued up, so that a
+   burst of files can be processed together
+ - inotify only exists on Linux: check available() before using it
+"""
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008 # a file opened for writing was closed
+IN_MOVED_TO    = 0x00000080 # a file was moved into the directory
+IN_Q_OVERFLOW  = 0x00004000 # events were lost because the queue was full
+IN_IGNORED     = 0x00008000 # the watch was removed
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+EVENT = struct.Struct('iIII') # wd, mask, cookie, length of name
+
+_libc = None
+
+def _lib():
+    """Load libc the first time it's needed."""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return _libc
+
+def available():
+    """Return True if inotify can be used on this system."""
+    if not sys.platform.startswith('linux'):
+        return False
+    try: return hasattr(_lib(), 'inotify_init1')
+    except OSError: return False
+
+####    ####    ####    ####
+
+class Inotify:
+    """A set of inotify watches on directories.
+    Use read() to get the events as (directory, mask, file name) tuples."""
+    def __init__(self):
+        self.fd = _lib().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, 'inotify_init1 failed: ' + os.strerror(e))
+        self.paths = {} # watch descriptor: directory
+
+    def add_watch(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        """Watch the directory at path for the events in mask."""
+        wd = _lib().inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, 'inotify_add_watch failed: ' + os.strerror(e), path)
+        self.paths[wd] = path
+        return wd
+
+    def read(self, timeout=None):
+        """Wait up to timeout (s) for events, then return all of the events
+        that are queued as a list of (directory, mask, file name)."""
+        if self.fd < 0: return []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready: return []
+        buf = b''
+        while True: # drain everything that has queued up
+            try: chunk = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK): break
+                raise
+            if not chunk: break
+            buf += chunk
+        events, i = [], 0
+        while i + EVENT.size <= len(buf):
+            wd, mask, cookie, n = EVENT.unpack_from(buf, i)
+            name = buf[i+EVENT.size : i+EVENT.size+n].rstrip(b'\0')
+            i += EVENT.size + n
+            events.append((self.paths.get(wd, ''), mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        """Remove the watches by closing the inotify file descriptor."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1